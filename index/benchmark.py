@@ -0,0 +1,183 @@
+import argparse
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import blockfile
+import contracts
+import extract
+import index_content
+from partitions import partition_files
+from synthetic_chain import SyntheticChain, StubNode
+
+STUB_BIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_bin")
+DATABASE_FILES = ["novo_blocks.db", "content.db", "contracts.db"]
+
+# Metrics where a higher value is better, everything else numeric is a cost
+HIGHER_IS_BETTER = {"blocks_per_sec"}
+
+
+# The stub node runs in its own process so the generated chain does not count towards the indexer's RSS
+def serve_chain(num_blocks, txs_per_block, num_addresses, seed, blocks_dir, queue):
+    start = time.perf_counter()
+    chain = SyntheticChain(num_blocks, txs_per_block, num_addresses, seed)
+    if blocks_dir:
+        chain.write_block_files(blocks_dir)
+    url = StubNode(chain).start()
+    queue.put((url, time.perf_counter() - start, len(chain.transactions)))
+    while True:
+        time.sleep(3600)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def database_size(path):
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+
+def count_rows(path, table):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix="novo_benchmark_")
+    blocks_dir = os.path.join(workdir, "blocks") if args.block_files else None
+
+    queue = multiprocessing.Queue()
+    node = multiprocessing.Process(target=serve_chain, args=(args.blocks, args.txs_per_block, args.addresses, args.seed, blocks_dir, queue), daemon=True)
+    node.start()
+    url, generate_seconds, num_transactions = queue.get()
+
+    extract.NODE_URL = url
+    os.environ["NOVO_STUB_URL"] = url
+    os.environ["PATH"] = STUB_BIN + os.pathsep + os.environ["PATH"]
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            conn = extract.create_database()
+            # With block files the initial sync reads them directly and RPC only covers the handoff
+            imported, import_seconds = timed(blockfile.import_block_files, conn, blocks_dir) if blocks_dir else (0, 0)
+            synced, sync_seconds = timed(extract.sync_blocks, conn)
+            synced += imported
+            extract_seconds = import_seconds + sync_seconds
+            conn.close()
+
+            _, content_seconds = timed(index_content.main)
+            _, contracts_seconds = timed(contracts.main)
+
+            # A second pass with no new blocks shows the cost that does not depend on new activity
+            _, content_idle_seconds = timed(index_content.main)
+            _, contracts_idle_seconds = timed(contracts.main)
+
+        results = {
+            "blocks": synced,
+            "transactions": num_transactions,
+            "generate_seconds": round(generate_seconds, 3),
+            "extract_seconds": round(extract_seconds, 3),
+            "blocks_per_sec": round(synced / extract_seconds, 2),
+            "block_file_import_seconds": round(import_seconds, 3),
+            "content_pass_seconds": round(content_seconds, 3),
+            "contracts_pass_seconds": round(contracts_seconds, 3),
+            "content_idle_pass_seconds": round(content_idle_seconds, 3),
+            "contracts_idle_pass_seconds": round(contracts_idle_seconds, 3),
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+            **extract.prevout_cache.report(),
+            "content_rows": count_rows("content.db", "content"),
+            "inscriptions": count_rows("content.db", "inscriptions"),
+            "token_interactions": count_rows("contracts.db", "token_interactions"),
+        }
+        for path in DATABASE_FILES:
+            results[f"{path.split('.')[0]}_db_bytes"] = database_size(path)
+        # Transactions are stored in the partition files next to novo_blocks.db
+        results["novo_blocks_db_bytes"] += sum(database_size(path) for path in partition_files("."))
+    finally:
+        os.chdir(cwd)
+        node.terminate()
+        if args.keep:
+            print(f"Databases kept in {workdir}")
+        else:
+            shutil.rmtree(workdir)
+
+    return {
+        "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "config": {
+            "blocks": args.blocks,
+            "txs_per_block": args.txs_per_block,
+            "addresses": args.addresses,
+            "seed": args.seed,
+            "block_files": args.block_files,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+
+
+def compare(previous, current):
+    if previous["config"] != current["config"]:
+        print(f"Warning: comparing runs with different configs: {previous['config']} vs {current['config']}")
+
+    print(f"{'metric':32} {'previous':>14} {'current':>14} {'change':>9}")
+    for key, value in current["results"].items():
+        old = previous["results"].get(key)
+        if not isinstance(value, (int, float)) or not old:
+            continue
+        change = (value - old) / old * 100
+        worse = change < 0 if key in HIGHER_IS_BETTER else change > 0
+        marker = " !" if worse and abs(change) >= 10 else ""
+        print(f"{key:32} {old:>14} {value:>14} {change:>8.1f}%{marker}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end indexing benchmark against a synthetic chain")
+    parser.add_argument("--blocks", type=int, default=500)
+    parser.add_argument("--txs-per-block", type=int, default=20)
+    parser.add_argument("--addresses", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="where to save the results (default benchmarks/benchmark-<timestamp>.json)")
+    parser.add_argument("--compare", help="previous results file to compare against")
+    parser.add_argument("--keep", action="store_true", help="keep the generated databases")
+    parser.add_argument("--block-files", action="store_true", help="do the initial sync from generated blk*.dat files")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    print(json.dumps(report["results"], indent=2))
+
+    output = args.output or os.path.join("benchmarks", f"benchmark-{report['timestamp'].replace(':', '')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,469 @@
+import argparse
+import glob
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import time
+from collections import deque
+
+import extract
+
+COIN = 100000000
+
+# Base58 version bytes for pay-to-pubkey-hash and pay-to-script-hash addresses
+ADDRESS_VERSION = 0x00
+SCRIPT_ADDRESS_VERSION = 0x05
+
+# Blocks closer than this to the tip of the block files are left for RPC sync, so a stale
+# tip the node has not reorganized away on disk is never imported
+HANDOFF_DEPTH = 6
+COMMIT_INTERVAL = 500
+
+HEADER_SIZE = 80
+NULL_HASH = b"\x00" * 32
+
+OP_0 = 0x00
+OP_PUSHDATA1 = 0x4c
+OP_PUSHDATA2 = 0x4d
+OP_PUSHDATA4 = 0x4e
+OP_1NEGATE = 0x4f
+OP_1 = 0x51
+OP_16 = 0x60
+OP_RETURN = 0x6a
+OP_DROP = 0x75
+OP_DUP = 0x76
+OP_EQUAL = 0x87
+OP_EQUALVERIFY = 0x88
+OP_HASH160 = 0xa9
+OP_CHECKSIG = 0xac
+
+OPCODE_NAMES = {
+    0x61: "OP_NOP", 0x62: "OP_VER", 0x63: "OP_IF", 0x64: "OP_NOTIF", 0x65: "OP_VERIF", 0x66: "OP_VERNOTIF",
+    0x67: "OP_ELSE", 0x68: "OP_ENDIF", 0x69: "OP_VERIFY", 0x6a: "OP_RETURN", 0x6b: "OP_TOALTSTACK",
+    0x6c: "OP_FROMALTSTACK", 0x6d: "OP_2DROP", 0x6e: "OP_2DUP", 0x6f: "OP_3DUP", 0x70: "OP_2OVER",
+    0x71: "OP_2ROT", 0x72: "OP_2SWAP", 0x73: "OP_IFDUP", 0x74: "OP_DEPTH", 0x75: "OP_DROP", 0x76: "OP_DUP",
+    0x77: "OP_NIP", 0x78: "OP_OVER", 0x79: "OP_PICK", 0x7a: "OP_ROLL", 0x7b: "OP_ROT", 0x7c: "OP_SWAP",
+    0x7d: "OP_TUCK", 0x7e: "OP_CAT", 0x7f: "OP_SPLIT", 0x80: "OP_NUM2BIN", 0x81: "OP_BIN2NUM",
+    0x82: "OP_SIZE", 0x83: "OP_INVERT", 0x84: "OP_AND", 0x85: "OP_OR", 0x86: "OP_XOR", 0x87: "OP_EQUAL",
+    0x88: "OP_EQUALVERIFY", 0x89: "OP_RESERVED1", 0x8a: "OP_RESERVED2", 0x8b: "OP_1ADD", 0x8c: "OP_1SUB",
+    0x8d: "OP_2MUL", 0x8e: "OP_2DIV", 0x8f: "OP_NEGATE", 0x90: "OP_ABS", 0x91: "OP_NOT",
+    0x92: "OP_0NOTEQUAL", 0x93: "OP_ADD", 0x94: "OP_SUB", 0x95: "OP_MUL", 0x96: "OP_DIV", 0x97: "OP_MOD",
+    0x98: "OP_LSHIFT", 0x99: "OP_RSHIFT", 0x9a: "OP_BOOLAND", 0x9b: "OP_BOOLOR", 0x9c: "OP_NUMEQUAL",
+    0x9d: "OP_NUMEQUALVERIFY", 0x9e: "OP_NUMNOTEQUAL", 0x9f: "OP_LESSTHAN", 0xa0: "OP_GREATERTHAN",
+    0xa1: "OP_LESSTHANOREQUAL", 0xa2: "OP_GREATERTHANOREQUAL", 0xa3: "OP_MIN", 0xa4: "OP_MAX",
+    0xa5: "OP_WITHIN", 0xa6: "OP_RIPEMD160", 0xa7: "OP_SHA1", 0xa8: "OP_SHA256", 0xa9: "OP_HASH160",
+    0xaa: "OP_HASH256", 0xab: "OP_CODESEPARATOR", 0xac: "OP_CHECKSIG", 0xad: "OP_CHECKSIGVERIFY",
+    0xae: "OP_CHECKMULTISIG", 0xaf: "OP_CHECKMULTISIGVERIFY", 0xb0: "OP_NOP1", 0xb1: "OP_CHECKLOCKTIMEVERIFY",
+    0xb2: "OP_CHECKSEQUENCEVERIFY", 0xb3: "OP_NOP4", 0xb4: "OP_NOP5", 0xb5: "OP_NOP6", 0xb6: "OP_NOP7",
+    0xb7: "OP_NOP8", 0xb8: "OP_NOP9", 0xb9: "OP_NOP10",
+}
+
+BASE58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+
+def dsha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def hash160(data):
+    return hashlib.new("ripemd160", hashlib.sha256(data).digest()).digest()
+
+
+def base58check(payload):
+    data = payload + dsha256(payload)[:4]
+    number = int.from_bytes(data, "big")
+    encoded = ""
+    while number:
+        number, remainder = divmod(number, 58)
+        encoded = BASE58_ALPHABET[remainder] + encoded
+    leading_zeros = len(data) - len(data.lstrip(b"\x00"))
+    return "1" * leading_zeros + encoded
+
+
+def read_varint(data, offset):
+    first = data[offset]
+    if first < 0xfd:
+        return first, offset + 1
+    if first == 0xfd:
+        return struct.unpack_from("<H", data, offset + 1)[0], offset + 3
+    if first == 0xfe:
+        return struct.unpack_from("<I", data, offset + 1)[0], offset + 5
+    return struct.unpack_from("<Q", data, offset + 1)[0], offset + 9
+
+
+# Split a script into (opcode, pushed data, end offset) triples, data is None for non-push
+# opcodes. A push running past the end of the script ends parsing with its data set to False
+def script_ops(script):
+    ops = []
+    offset = 0
+    while offset < len(script):
+        opcode = script[offset]
+        offset += 1
+        if opcode > OP_PUSHDATA4:
+            ops.append((opcode, None, offset))
+            continue
+        size = opcode
+        length_size = {OP_PUSHDATA1: 1, OP_PUSHDATA2: 2, OP_PUSHDATA4: 4}.get(opcode, 0)
+        if length_size:
+            if offset + length_size > len(script):
+                ops.append((opcode, False, len(script)))
+                break
+            size = int.from_bytes(script[offset:offset + length_size], "little")
+            offset += length_size
+        if offset + size > len(script):
+            ops.append((opcode, False, len(script)))
+            break
+        ops.append((opcode, bytes(script[offset:offset + size]), offset + size))
+        offset += size
+    return ops
+
+
+def script_num(data):
+    if not data:
+        return 0
+    value = int.from_bytes(data, "little")
+    if data[-1] & 0x80:
+        return -(value & ~(0x80 << (8 * (len(data) - 1))))
+    return value
+
+
+# The same rendering as the node's asm: small pushes as numbers, larger ones as hex
+def script_to_asm(script):
+    parts = []
+    for opcode, data, _ in script_ops(script):
+        if data is False:
+            parts.append("[error]")
+        elif data is not None:
+            parts.append(str(script_num(data)) if len(data) <= 4 else data.hex())
+        elif opcode == OP_1NEGATE:
+            parts.append("-1")
+        elif OP_1 <= opcode <= OP_16:
+            parts.append(str(opcode - OP_1 + 1))
+        else:
+            parts.append(OPCODE_NAMES.get(opcode, "OP_UNKNOWN"))
+    return " ".join(parts)
+
+
+# Contract outputs carry their fields as a pushed JSON document dropped in front of a
+# standard script. Return the fields and the script they lock, or (None, script)
+def decode_contract_fields(script):
+    ops = script_ops(script)
+    if len(ops) < 2 or not ops[0][1] or ops[1][:2] != (OP_DROP, None):
+        return None, script
+    try:
+        fields = json.loads(ops[0][1])
+    except ValueError:
+        return None, script
+    if not isinstance(fields, dict) or "contractID" not in fields:
+        return None, script
+    # The locking script follows the OP_DROP
+    return fields, script[ops[1][2]:]
+
+
+def classify_script(script):
+    if len(script) == 25 and script[0] == OP_DUP and script[1] == OP_HASH160 and script[2] == 20 and script[23] == OP_EQUALVERIFY and script[24] == OP_CHECKSIG:
+        return "pubkeyhash", [base58check(bytes([ADDRESS_VERSION]) + bytes(script[3:23]))]
+    if len(script) == 23 and script[0] == OP_HASH160 and script[1] == 20 and script[22] == OP_EQUAL:
+        return "scripthash", [base58check(bytes([SCRIPT_ADDRESS_VERSION]) + bytes(script[2:22]))]
+    if len(script) in (35, 67) and script[0] == len(script) - 2 and script[-1] == OP_CHECKSIG:
+        try:
+            return "pubkey", [base58check(bytes([ADDRESS_VERSION]) + hash160(bytes(script[1:-1])))]
+        except ValueError:
+            # OpenSSL builds without ripemd160
+            return "pubkey", None
+    if len(script) > 0 and script[0] == OP_RETURN:
+        return "nulldata", None
+    return "nonstandard", None
+
+
+def decode_output(n, value, script):
+    script_pubkey = {"asm": script_to_asm(script), "hex": script.hex()}
+    fields, locking_script = decode_contract_fields(script)
+    script_type, addresses = classify_script(locking_script)
+    if addresses:
+        script_pubkey["reqSigs"] = 1
+    script_pubkey["type"] = script_type
+    if addresses:
+        script_pubkey["addresses"] = addresses
+
+    entry = {"value": value / COIN, "n": n, "scriptPubKey": script_pubkey}
+    if fields:
+        entry.update(fields)
+    return entry
+
+
+# Decode one transaction into the same shape as getrawtransaction's verbose result
+def parse_transaction(data, offset):
+    start = offset
+    version = struct.unpack_from("<i", data, offset)[0]
+    offset += 4
+
+    segwit = data[offset] == 0 and data[offset + 1] == 1
+    if segwit:
+        offset += 2
+
+    vin = []
+    count, offset = read_varint(data, offset)
+    for _ in range(count):
+        prev_hash = bytes(data[offset:offset + 32])
+        prev_n = struct.unpack_from("<I", data, offset + 32)[0]
+        size, offset = read_varint(data, offset + 36)
+        script_sig = bytes(data[offset:offset + size])
+        sequence = struct.unpack_from("<I", data, offset + size)[0]
+        offset += size + 4
+        if prev_hash == NULL_HASH and prev_n == 0xffffffff:
+            vin.append({"coinbase": script_sig.hex(), "sequence": sequence})
+        else:
+            vin.append({"txid": prev_hash[::-1].hex(), "vout": prev_n, "scriptSig": {"asm": script_to_asm(script_sig), "hex": script_sig.hex()}, "sequence": sequence})
+
+    vout = []
+    count, offset = read_varint(data, offset)
+    for n in range(count):
+        value = struct.unpack_from("<q", data, offset)[0]
+        size, offset = read_varint(data, offset + 8)
+        vout.append(decode_output(n, value, bytes(data[offset:offset + size])))
+        offset += size
+
+    witness_start = offset
+    if segwit:
+        for entry in vin:
+            items, offset = read_varint(data, offset)
+            witness = []
+            for _ in range(items):
+                size, offset = read_varint(data, offset)
+                witness.append(bytes(data[offset:offset + size]).hex())
+                offset += size
+            entry["txinwitness"] = witness
+
+    locktime = struct.unpack_from("<I", data, offset)[0]
+    offset += 4
+
+    raw = bytes(data[start:offset])
+    tx_hash = dsha256(raw)[::-1].hex()
+    if segwit:
+        stripped = raw[:4] + raw[6:witness_start - start] + raw[-4:]
+        txid = dsha256(stripped)[::-1].hex()
+    else:
+        txid = tx_hash
+
+    tx = {
+        "hex": raw.hex(),
+        "txid": txid,
+        "hash": tx_hash,
+        "size": len(raw),
+        "version": version,
+        "locktime": locktime,
+        "vin": vin,
+        "vout": vout,
+    }
+    return tx, offset
+
+
+def parse_header(data, offset):
+    version, prev_hash, merkle_root, block_time, bits, nonce = struct.unpack_from("<i32s32sIII", data, offset)
+    return {
+        "hash": dsha256(data[offset:offset + HEADER_SIZE])[::-1].hex(),
+        "version": version,
+        "previousblockhash": prev_hash[::-1].hex(),
+        "merkleroot": merkle_root[::-1].hex(),
+        "time": block_time,
+        "bits": bits,
+        "nonce": nonce,
+    }
+
+
+def bits_to_target(bits):
+    exponent = bits >> 24
+    mantissa = bits & 0x007fffff
+    if exponent <= 3:
+        return mantissa >> (8 * (3 - exponent))
+    return mantissa << (8 * (exponent - 3))
+
+
+def block_work(bits):
+    return (1 << 256) // (bits_to_target(bits) + 1)
+
+
+def bits_to_difficulty(bits):
+    shift = (bits >> 24) & 0xff
+    difficulty = 0x0000ffff / (bits & 0x00ffffff)
+    while shift < 29:
+        difficulty *= 256
+        shift += 1
+    while shift > 29:
+        difficulty /= 256
+        shift -= 1
+    # The node writes doubles to JSON with 16 significant digits
+    return float(f"{difficulty:.16g}")
+
+
+def block_files(blocks_dir):
+    paths = glob.glob(os.path.join(blocks_dir, "blk*.dat"))
+    return sorted(paths, key=lambda path: int(re.sub(r"\D", "", os.path.basename(path)) or 0))
+
+
+# Walk every record in a block file, yielding (offset, size) of each serialized block. The
+# node preallocates files with zeros, so a zero magic ends the file. magic is taken from the
+# first record when not given
+def scan_block_file(data, magic=None):
+    offset = 0
+    while offset + 8 <= len(data):
+        record_magic = bytes(data[offset:offset + 4])
+        if record_magic == b"\x00\x00\x00\x00":
+            break
+        if magic is None:
+            magic = record_magic
+        if record_magic != magic:
+            raise ValueError(f"Bad magic {record_magic.hex()} at offset {offset}")
+        size = struct.unpack_from("<I", data, offset + 4)[0]
+        if offset + 8 + size > len(data):
+            break
+        yield offset + 8, size
+        offset += 8 + size
+
+
+class BlockFiles:
+    # Memory-maps every blk*.dat file in blocks_dir and indexes the block headers in them
+    def __init__(self, blocks_dir, magic=None):
+        self.maps = []
+        self.headers = {}
+        self.children = {}
+        for path in block_files(blocks_dir):
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    continue
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            file_index = len(self.maps)
+            self.maps.append(data)
+            for offset, size in scan_block_file(data, magic):
+                header = parse_header(data, offset)
+                header["location"] = (file_index, offset, size)
+                self.headers[header["hash"]] = header
+                self.children.setdefault(header["previousblockhash"], []).append(header["hash"])
+
+    def close(self):
+        for data in self.maps:
+            data.close()
+
+    # Hashes of the chain with the most work, indexed by height. Files are written in the
+    # order blocks arrive, not by height, so the chain is rebuilt by linking headers from genesis
+    def best_chain(self):
+        genesis = self.children.get(NULL_HASH.hex(), [])
+        best = (0, None)
+        work = {}
+        parent = {}
+        stack = [(block_hash, None) for block_hash in genesis]
+        while stack:
+            block_hash, prev = stack.pop()
+            work[block_hash] = work.get(prev, 0) + block_work(self.headers[block_hash]["bits"])
+            parent[block_hash] = prev
+            if work[block_hash] > best[0]:
+                best = (work[block_hash], block_hash)
+            stack.extend((child, block_hash) for child in self.children.get(block_hash, []))
+
+        chain = []
+        block_hash = best[1]
+        while block_hash is not None:
+            chain.append(block_hash)
+            block_hash = parent[block_hash]
+        chain.reverse()
+        return chain, work
+
+    def read_block(self, block_hash):
+        file_index, offset, size = self.headers[block_hash]["location"]
+        data = self.maps[file_index]
+        count, position = read_varint(data, offset + HEADER_SIZE)
+        transactions = []
+        for _ in range(count):
+            tx, position = parse_transaction(data, position)
+            transactions.append(tx)
+        return size, transactions
+
+
+# Import blocks straight from the node's block files into novo_blocks.db, stopping
+# handoff_depth blocks before the tip so extract.py takes over from there over RPC
+def import_block_files(conn, blocks_dir, magic=None, handoff_depth=HANDOFF_DEPTH):
+    files = BlockFiles(blocks_dir, magic)
+    try:
+        chain, work = files.best_chain()
+        tip_height = len(chain) - 1
+        stop_height = tip_height - handoff_depth
+
+        start_height = extract.get_last_synced_height(conn) + 1
+        if start_height > 1:
+            cursor = conn.cursor()
+            cursor.execute("SELECT hash FROM blocks WHERE height = ?", (start_height - 1,))
+            result = cursor.fetchone()
+            if start_height - 1 > tip_height or not result or result[0] != chain[start_height - 1]:
+                print(f"Block {start_height - 1} in the database is not on the block files' best chain, leaving sync to RPC")
+                return 0
+        if start_height > stop_height:
+            return 0
+
+        print(f"Importing blocks {start_height} to {stop_height} from {len(files.maps)} block files...")
+        started = time.perf_counter()
+        prevout_seconds = extract.prevout_cache.seconds
+
+        # mediantime is the median time of the previous 11 blocks, including this one
+        recent_times = deque((files.headers[block_hash]["time"] for block_hash in chain[max(start_height - 10, 0):start_height]), maxlen=11)
+        cursor = conn.cursor()
+        for height in range(start_height, stop_height + 1):
+            block_hash = chain[height]
+            header = files.headers[block_hash]
+            size, transactions = files.read_block(block_hash)
+            recent_times.append(header["time"])
+
+            block_data = {
+                "hash": block_hash,
+                "size": size,
+                "height": height,
+                "version": header["version"],
+                "versionHex": f"{header['version'] & 0xffffffff:08x}",
+                "merkleroot": header["merkleroot"],
+                "tx": [tx["txid"] for tx in transactions],
+                "time": header["time"],
+                "mediantime": sorted(recent_times)[len(recent_times) // 2],
+                "nonce": header["nonce"],
+                "bits": f"{header['bits']:08x}",
+                "difficulty": bits_to_difficulty(header["bits"]),
+                "chainwork": f"{work[block_hash]:064x}",
+                "previousblockhash": header["previousblockhash"],
+                "nextblockhash": chain[height + 1] if height < tip_height else "",
+            }
+            for tx in transactions:
+                tx.update(blockhash=block_hash, time=header["time"], blocktime=header["time"])
+
+            extract.save_block(conn, block_data, transactions)
+            cursor.execute("UPDATE blocks SET last_synced_height = ? WHERE height = ?", (height, height))
+            if height % COMMIT_INTERVAL == 0:
+                conn.commit()
+                print(f"Imported block {height} of {stop_height}")
+        conn.commit()
+        conn.partitions.freeze(stop_height)
+
+        imported = stop_height - start_height + 1
+        elapsed = time.perf_counter() - started
+        print(f"Imported {imported} blocks in {elapsed:.1f}s ({imported / elapsed:.1f} blocks/s)")
+        extract.print_prevout_report(elapsed, extract.prevout_cache.seconds - prevout_seconds)
+        return imported
+    finally:
+        files.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import blocks into novo_blocks.db from the node's blk*.dat files")
+    parser.add_argument("blocks_dir", help="the node's blocks directory")
+    parser.add_argument("--magic", help="network magic as hex, taken from the first block file when omitted")
+    parser.add_argument("--handoff-depth", type=int, default=HANDOFF_DEPTH, help="blocks below the tip to leave for RPC sync")
+    args = parser.parse_args()
+
+    conn = extract.create_database()
+    import_block_files(conn, args.blocks_dir, bytes.fromhex(args.magic) if args.magic else None, args.handoff_depth)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
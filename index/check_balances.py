@@ -0,0 +1,151 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+
+import contracts
+import extract
+from synthetic_chain import SyntheticChain, StubNode
+
+
+# Run the ledger passes on a mint, a transfer, a hold, a transfer that spends a holding in full
+# and a rollback, then index a synthetic chain. Fails if the ledger differs from what each
+# address holds unspent, if a balance differs from the ledger, or if a holder's rank or share
+# differs from a full re-rank of the contract
+def transaction(height, outputs):
+    metadata = json.dumps({"name": "Token", "symbol": "TKN", "decimal": 8})
+    txid = f"{height:064x}"
+    interactions = []
+    for n, (contract_type, address, value) in enumerate(outputs):
+        output = json.dumps({
+            "n": n,
+            "contractID": "cid:0",
+            "contractType": contract_type,
+            "contractValue": value,
+            "contractMaxSupply": 1000,
+            "contractMetadata": metadata,
+            "scriptPubKey": {"addresses": [address]},
+        })
+        interactions.extend(contracts.parse_contract_output(txid, output, 1690000000 + height, height))
+    return interactions
+
+
+def spend(height, spent_height, n):
+    return [(f"{spent_height:064x}", n, height)]
+
+
+def ledger_mismatches(conn, expected):
+    ledger = dict(conn.execute("SELECT address, balance FROM token_ledger").fetchall())
+    balances = dict(conn.execute("SELECT address, balance FROM token_balances").fetchall())
+    mismatches = [
+        (address, balance, ledger.get(address, 0))
+        for address, balance in expected.items()
+        if ledger.get(address, 0) != balance
+    ]
+    mismatches += [
+        (address, ledger.get(address, 0), balance)
+        for address, balance in balances.items()
+        if ledger.get(address, 0) != balance
+    ]
+    return mismatches
+
+
+def rank_mismatches(conn):
+    supplies = dict(conn.execute("""
+        SELECT contract_id, MAX(max_supply) FROM token_interactions GROUP BY contract_id
+    """).fetchall())
+    holders = {}
+    for contract_id, address, balance, rank, percent in conn.execute("""
+        SELECT contract_id, address, balance, rank, percent_of_supply FROM token_holders
+    """):
+        holders.setdefault(contract_id, []).append((address, balance, rank, percent))
+    mismatches = []
+    for contract_id, rows in holders.items():
+        rows.sort(key=lambda row: (-row[1], row[0]))
+        for expected_rank, (address, balance, rank, percent) in enumerate(rows, 1):
+            expected_percent = balance / supplies[contract_id] * 100 if supplies.get(contract_id) else None
+            if rank != expected_rank or percent != expected_percent:
+                mismatches.append((contract_id, address, (expected_rank, expected_percent), (rank, percent)))
+    return mismatches
+
+
+def check_fixture():
+    conn = contracts.create_contracts_database()
+    passes = [
+        # minter mints 1000 to alice, who sends 300 to bob and keeps 700 as change
+        ("mint and transfer",
+         transaction(1, [("FT_MINT", "minter", 1000), ("FT", "alice", 1000)])
+         + transaction(2, [("FT", "alice", 700), ("FT", "bob", 300)]),
+         spend(2, 1, 1),
+         {"minter": 0, "alice": 700, "bob": 300}),
+        # nothing moves
+        ("hold", [], [], {"minter": 0, "alice": 700, "bob": 300}),
+        # bob sends everything to carol
+        ("spend in full",
+         transaction(3, [("FT", "bob", 0), ("FT", "carol", 300)]),
+         spend(3, 2, 1),
+         {"alice": 700, "bob": 0, "carol": 300}),
+    ]
+
+    failures = 0
+    for name, interactions, spends, expected in passes:
+        contracts.index_contract_interactions(conn, interactions, spends)
+        failures += report(name, ledger_mismatches(conn, expected) + rank_mismatches(conn))
+
+    contracts.rollback_token_interactions(conn, 3)
+    failures += report("rollback", ledger_mismatches(conn, {"alice": 700, "bob": 300, "carol": 0}) + rank_mismatches(conn))
+    conn.close()
+    return failures
+
+
+# Index a synthetic chain from a stub node and compare the ledger with the node's unspent set
+def check_chain(num_blocks):
+    os.environ["PATH"] = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_bin") + os.pathsep + os.environ["PATH"]
+    node = StubNode(SyntheticChain(num_blocks))
+    extract.NODE_URL = node.start()
+    os.environ["NOVO_STUB_URL"] = extract.NODE_URL
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            conn = extract.create_database()
+            extract.sync_blocks(conn)
+            conn.close()
+            contracts.main()
+        unspent = {}
+        for entry in contracts.list_all_contract_unspent():
+            key = (entry["address"], entry["contractID"])
+            unspent[key] = unspent.get(key, 0) + int(entry["contractValue"])
+    finally:
+        node.stop()
+
+    conn = contracts.create_contracts_database()
+    ledger = {(address, contract_id): balance for address, contract_id, balance in conn.execute("SELECT address, contract_id, balance FROM token_ledger")}
+    balances = {(address, contract_id): balance for address, contract_id, balance in conn.execute("SELECT address, token_contract_id, balance FROM token_balances")}
+    ranks = rank_mismatches(conn)
+    conn.close()
+    mismatches = [
+        (key, unspent.get(key, 0), ledger.get(key, 0), balances.get(key, 0))
+        for key in set(unspent) | set(ledger) | set(balances)
+        if not unspent.get(key, 0) == ledger.get(key, 0) == balances.get(key, 0)
+    ]
+    return report(f"synthetic chain of {num_blocks} blocks, {len(unspent)} holdings", mismatches + ranks)
+
+
+def report(name, mismatches):
+    print(f"{'FAIL' if mismatches else 'ok'}: {name}")
+    for mismatch in mismatches[:10]:
+        print("   ", mismatch)
+    return 1 if mismatches else 0
+
+
+def main():
+    os.chdir(tempfile.mkdtemp(prefix="check_balances_"))
+    failures = check_fixture()
+    os.chdir(tempfile.mkdtemp(prefix="check_balances_"))
+    failures += check_chain(60)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+import json
+import os
+import sys
+import tempfile
+
+import contracts
+
+
+# Run the contracts passes on a small fixture, capture every statement they execute and
+# fail if EXPLAIN QUERY PLAN shows any of them scanning a whole table or index
+def build_fixture(conn):
+    metadata = json.dumps({"name": "Token", "symbol": "TKN", "decimal": 8})
+    interactions = []
+    for height in range(1, 4):
+        txid = f"{height:064x}"
+        for n, contract_type in enumerate(["FT_MINT", "FT", "FT"]):
+            output = json.dumps({
+                "n": n,
+                "contractID": "cid:0",
+                "contractType": contract_type,
+                "contractValue": 100,
+                "contractMaxSupply": 1000,
+                "contractMetadata": metadata,
+                "scriptPubKey": {"addresses": [f"address{n}"]},
+            })
+            interactions.extend(contracts.parse_contract_output(txid, output, 1690000000 + height, height))
+    contracts.process_transactions(conn, interactions)
+
+
+def capture_statements(conn):
+    statements = []
+    conn.set_trace_callback(statements.append)
+
+    contracts.populate_direction_column(conn)
+    contracts.apply_ledger_deltas(conn)
+    contracts.apply_spends(conn, [(f"{1:064x}", 1, 2)])
+    contracts.update_balances_from_ledger(conn, [("address1", "cid:0")])
+    contracts.update_token_balances(conn, "address1", "cid:0", "FT", 50, None)
+    contracts.refresh_holder_ranks(conn)
+    contracts.populate_defi_table(conn)
+    contracts.get_ledger_balance(conn, "address1", "cid:0")
+    contracts.get_top_holders(conn, "cid:0", 10)
+    contracts.get_top_holders(conn, "cid:0", 10, after=(100, "address1"))
+    contracts.rollback_token_interactions(conn, 3)
+
+    conn.set_trace_callback(None)
+
+    unique = []
+    for statement in statements:
+        statement = statement.strip()
+        if statement.split(None, 1)[0].upper() in ("SELECT", "UPDATE", "DELETE", "INSERT") and statement not in unique:
+            unique.append(statement)
+    return unique
+
+
+def find_full_scans(conn, statements):
+    failures = []
+    for statement in statements:
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {statement}").fetchall()
+        scans = [row[3] for row in plan if row[3].startswith("SCAN")]
+        if scans:
+            failures.append((statement, scans))
+    return failures
+
+
+def main():
+    os.chdir(tempfile.mkdtemp(prefix="check_query_plans_"))
+    conn = contracts.create_contracts_database()
+    build_fixture(conn)
+
+    statements = capture_statements(conn)
+    failures = find_full_scans(conn, statements)
+
+    for statement, scans in failures:
+        print("FULL SCAN:", " ".join(statement.split()))
+        for scan in scans:
+            print("   ", scan)
+    print(f"{len(statements)} statements checked, {len(failures)} with full scans")
+    conn.close()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,55 @@
+import os
 import sqlite3
 import json
 import subprocess
 import time
-import datetime
 import math
 import logging
+from collections import namedtuple
+
+import profiling
+from db_utils import SECONDS_PER_DAY, add_column_if_missing, add_daily_stats, change_column_types, create_stream_events_table, create_sync_state_table, enable_wal, epoch_sql, get_block_tip, get_column_types, get_sync_state, get_table_sql, get_watermark, publish_events, rebuild_table, save_watermark, set_sync_state, utc_day
+from partitions import connect_blocks
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Rows per executemany batch when writing interactions
+INSERT_CHUNK_SIZE = 5000
+
+# Totals per UTC day in daily_token_stats, counted as interactions are applied to the ledger
+DAILY_TOKEN_STATS = ["interactions", "transfers", "mints"]
+
+# Version of the rules in interaction_delta and apply_spends. A ledger built under other rules
+# is rebuilt
+LEDGER_RULES = 2
+
+CONTRACT_TYPES = {
+    'FT_MINT': 'token mint',
+    'FT': 'token transfer',
+    'NFT': 'NFT transfer',
+    'NFT_MINT': 'NFT mint',
+}
+
+# Interaction types whose outputs hold tokens, and the contract_type their balances are kept
+# under. A mint output only marks the creation of a contract, the minted supply is held by the
+# transfer output next to it
+HOLDING_TYPES = {
+    'token transfer': 'FT',
+    'NFT transfer': 'NFT',
+}
+
+# One row of token_interactions, built from a contract output parsed exactly once
+ContractInteraction = namedtuple('ContractInteraction', [
+    'transaction_id', 'address', 'contract_id', 'transaction_data', 'max_supply', 'token_name',
+    'token_symbol', 'interaction_time', 'n', 'type', 'value', 'token_decimals', 'token_icon',
+    'genesis_price', 'limit_mint', 'limit_wallet', 'blockheight',
+])
+
 
 def create_contracts_database():
-    conn = sqlite3.connect('contracts.db')
+    conn = profiling.register(sqlite3.connect('contracts.db'))
+    enable_wal(conn)
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -48,9 +86,82 @@ def create_contracts_database():
             type TEXT,
             value REAL,
             direction TEXT,
-            UNIQUE(transaction_id, address, contract_id)
+            blockheight INTEGER,
+            ledger_delta REAL,
+            spent_height INTEGER,
+            UNIQUE(transaction_id, n, address, contract_id)
+        )
+    """)
+
+    # Columns added after the first release of the table
+    add_column_if_missing(cursor, "token_interactions", "blockheight", "INTEGER")
+    add_column_if_missing(cursor, "token_interactions", "ledger_delta", "REAL")
+    add_column_if_missing(cursor, "token_interactions", "spent_height", "INTEGER")
+
+    # Interactions used to be unique per (transaction, address, contract), so of a transaction
+    # paying one address twice, such as change to the sender next to a transfer to itself, only
+    # the first output was kept. rescan_contract_outputs reads the dropped ones back
+    sql = get_table_sql(cursor, "token_interactions")
+    if "UNIQUE(transaction_id, address, contract_id)" in sql:
+        logger.info("Keying token interactions by output")
+        rebuild_table(cursor, "token_interactions", sql.replace("UNIQUE(transaction_id, address, contract_id)", "UNIQUE(transaction_id, n, address, contract_id)"), {})
+        conn.commit()
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_token_interactions_height ON token_interactions (blockheight, address, contract_id, ledger_delta)")
+
+    # Rows indexed before blockheight existed, or left NULL by the first version of this migration
+    if cursor.execute("SELECT 1 FROM token_interactions WHERE blockheight IS NULL LIMIT 1").fetchone():
+        backfill_interaction_heights(conn)
+
+    # Covering indexes for the per-contract lookups in populate_defi_table
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_token_interactions_contract_type ON token_interactions (contract_id, type, interaction_time, value, address)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_token_interactions_contract_direction ON token_interactions (contract_id, direction, interaction_time, value, address)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_token_interactions_symbol ON token_interactions (token_symbol, contract_id)")
+
+    # Sibling outputs of a transaction, used by populate_direction_column
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_token_interactions_transaction ON token_interactions (transaction_id, n, type)")
+
+    # Seek keys for paging through a contract's or an address's interactions
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_token_interactions_contract_height ON token_interactions (contract_id, blockheight, transaction_id, address)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_token_interactions_address_height ON token_interactions (address, blockheight, transaction_id, contract_id)")
+
+    # Token metadata lookup in update_token_balances
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_token_interactions_address ON token_interactions (address, contract_id)")
+
+    # Interactions still waiting for a direction
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_token_interactions_unclassified
+        ON token_interactions (type, transaction_id, n)
+        WHERE direction IS NULL
+    """)
+
+    # Interactions that have a direction but have not been applied to the ledger yet
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_token_interactions_unapplied
+        ON token_interactions (direction)
+        WHERE ledger_delta IS NULL
+    """)
+
+    # Outputs spent at or above a rollback height
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_token_interactions_spent
+        ON token_interactions (spent_height)
+        WHERE spent_height IS NOT NULL
+    """)
+
+    # Running balance per (address, contract): the value of the outputs it received that are not
+    # spent yet, credited as interactions are applied and debited as their outputs are spent
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS token_ledger (
+            address TEXT,
+            contract_id TEXT,
+            balance REAL,
+            last_height INTEGER,
+            contract_type TEXT,
+            PRIMARY KEY (address, contract_id)
         )
     """)
+    add_column_if_missing(cursor, "token_ledger", "contract_type", "TEXT")
     
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS defi (
@@ -67,8 +178,8 @@ def create_contracts_database():
             tx_volume_all_time REAL,
             tx_volume_evolution_24h REAL,
             tx_volume_evolution_7d REAL,
-            last_updated TEXT,
-            genesis_date TEXT,
+            last_updated INTEGER,
+            genesis_date INTEGER,
             token_icon TEXT,
             genesis_price INTEGER,
             limit_mint INTEGER,
@@ -86,32 +197,282 @@ def create_contracts_database():
         )
     """)
 
+    # Ranked holder list per contract, kept up to date as token_balances rows change.
+    # percent_of_supply is the holder's share of the contract's max supply
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS token_holders (
+            contract_id TEXT,
+            address TEXT,
+            balance REAL,
+            rank INTEGER,
+            percent_of_supply REAL,
+            PRIMARY KEY (contract_id, address)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_token_holders_balance ON token_holders (contract_id, balance DESC, address)")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS token_holder_counts (
+            contract_id TEXT PRIMARY KEY,
+            num_holders INTEGER,
+            total_balance REAL,
+            dirty INTEGER,
+            dirty_low REAL,
+            dirty_high REAL,
+            max_supply INTEGER
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_token_holder_counts_dirty ON token_holder_counts (dirty)")
+    add_column_if_missing(cursor, "token_holder_counts", "dirty_low", "REAL")
+    add_column_if_missing(cursor, "token_holder_counts", "dirty_high", "REAL")
+    # Percentages used to be of the total held, re-rank every contract once against its supply
+    if add_column_if_missing(cursor, "token_holder_counts", "max_supply", "INTEGER"):
+        cursor.execute("UPDATE token_holder_counts SET dirty = 1, dirty_low = 0, dirty_high = NULL")
+
+    # Times used to be saved as local-time strings, they are now integer UTC epoch seconds
+    if get_column_types(cursor, "defi").get("last_updated") == "TEXT":
+        migrate_times(conn)
+
+    # Token activity per UTC day, for charts
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_token_stats (
+            day INTEGER PRIMARY KEY,
+            interactions INTEGER,
+            transfers INTEGER,
+            mints INTEGER
+        )
+    """)
+
+    create_sync_state_table(cursor)
+    create_stream_events_table(cursor)
+
+    if get_sync_state(conn, "token_holders") is None:
+        backfill_token_holders(conn)
+
+    if get_sync_state(conn, "daily_token_stats") is None:
+        rebuild_daily_token_stats(conn)
+
+    if get_sync_state(conn, "interaction_outputs") is None:
+        rescan_contract_outputs(conn)
+
+    ledger_state = get_sync_state(conn, "token_ledger")
+    if ledger_state is None or ledger_state[0] != LEDGER_RULES:
+        rebuild_token_ledger(conn)
+
     return conn
 
 
-def get_transactions_with_any_contract_id():
-    conn_novo_blocks = sqlite3.connect("novo_blocks.db")
+# novo_blocks.db once extract.py has moved its transactions to partitions, or None
+def open_partitioned_blocks(blocks_path):
+    if not os.path.exists(blocks_path):
+        logger.warning("%s not found", blocks_path)
+        return None
+    conn = sqlite3.connect(f"file:{blocks_path}?mode=ro", uri=True)
+    partitioned = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'partitions'").fetchone()
+    conn.close()
+    if not partitioned:
+        logger.warning("%s has not been migrated to partitions yet", blocks_path)
+        return None
+    return connect_blocks(blocks_path, readonly=True)
+
+
+# Read the contract outputs of every block the stage has indexed back from novo_blocks.db, for
+# the outputs dropped while interactions were unique per address. Outputs already indexed are
+# ignored, the rest are classified and applied, and the ledger is rebuilt to replay their spends.
+# Retried on the next start while novo_blocks.db is not ready
+def rescan_contract_outputs(conn, blocks_path="novo_blocks.db"):
+    watermark = get_sync_state(conn, "contracts")
+    if watermark is not None:
+        novo_blocks_conn = open_partitioned_blocks(blocks_path)
+        if novo_blocks_conn is None:
+            return
+        logger.info("Reading contract outputs up to height %d back from %s", watermark[0], blocks_path)
+        transactions, _, _ = get_transactions_with_any_contract_id(novo_blocks_conn, 0, watermark[0])
+        novo_blocks_conn.close()
+        process_transactions(conn, transactions)
+        populate_direction_column(conn)
+        apply_ledger_deltas(conn)
+        conn.execute("DELETE FROM sync_state WHERE name = 'token_ledger'")
+
+    set_sync_state(conn, "interaction_outputs", 0, None)
+    conn.commit()
+
+
+# Give interactions indexed before the blockheight column existed the height of their transaction,
+# so reorg rollbacks and height-keyed paging see them. Heights come from novo_blocks.db: the
+# contract_outputs index, the tx_index router, or the transactions table of a database that
+# extract.py has not migrated yet
+def backfill_interaction_heights(conn, blocks_path="novo_blocks.db"):
+    if not os.path.exists(blocks_path):
+        logger.warning("%s not found, token interactions without a block height are left as they are", blocks_path)
+        return
+
+    logger.info("Filling in block heights of token interactions from %s", blocks_path)
+    cursor = conn.cursor()
+    conn.commit()
+    cursor.execute("ATTACH DATABASE ? AS novo_blocks", (blocks_path,))
+    try:
+        tables = {row[0] for row in cursor.execute("SELECT name FROM novo_blocks.sqlite_master WHERE type = 'table'")}
+        for table in ("contract_outputs", "tx_index", "transactions"):
+            if table in tables:
+                cursor.execute(f"""
+                    UPDATE token_interactions
+                    SET blockheight = (SELECT blockheight FROM novo_blocks.{table} WHERE txid = token_interactions.transaction_id LIMIT 1)
+                    WHERE blockheight IS NULL
+                """)
+        conn.commit()
+    finally:
+        conn.rollback()
+        cursor.execute("DETACH DATABASE novo_blocks")
+
+    missing = cursor.execute("SELECT COUNT(*) FROM token_interactions WHERE blockheight IS NULL").fetchone()[0]
+    if missing:
+        logger.warning("%d token interactions have no block height, their transactions are not in %s", missing, blocks_path)
+
+
+def migrate_times(conn):
+    logger.info("Converting interaction and defi times to epoch seconds")
+    cursor = conn.cursor()
+    cursor.execute(f"UPDATE token_interactions SET interaction_time = {epoch_sql('interaction_time')} WHERE typeof(interaction_time) = 'text'")
+    change_column_types(cursor, "defi", {"last_updated": "INTEGER", "genesis_date": "INTEGER"}, {
+        "last_updated": epoch_sql("last_updated"),
+        "genesis_date": epoch_sql("genesis_date"),
+    })
+    conn.commit()
+
+
+# Build the holders view from balances written before it existed
+def backfill_token_holders(conn):
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT address, token_contract_id, SUM(balance)
+        FROM token_balances
+        GROUP BY address, token_contract_id
+    """)
+    for address, contract_id, balance in cursor.fetchall():
+        update_token_holder(conn, contract_id, address, balance)
+
+    set_sync_state(conn, "token_holders", 0, None)
+    conn.commit()
+    refresh_holder_ranks(conn)
+
+
+# Aggregate daily_token_stats from scratch, for interactions applied before the table existed
+def rebuild_daily_token_stats(conn):
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM daily_token_stats")
+    cursor.execute("""
+        INSERT INTO daily_token_stats (day, interactions, transfers, mints)
+        SELECT interaction_time / ? * ? AS day, COUNT(*), SUM(direction = 'sent'), SUM(direction = 'mint')
+        FROM token_interactions
+        WHERE ledger_delta IS NOT NULL AND interaction_time IS NOT NULL
+        GROUP BY day
+    """, (SECONDS_PER_DAY, SECONDS_PER_DAY))
+    set_sync_state(conn, "daily_token_stats", 0, None)
+    conn.commit()
+
+
+# Count interactions per UTC day: every interaction, transfers (the sending side of each
+# transfer) and mints. sign is -1 when interactions are rolled back
+def daily_token_totals(rows, sign=1):
+    totals = {}
+    for interaction_time, direction in rows:
+        if interaction_time is None:
+            continue
+        day = utc_day(interaction_time)
+        interactions, transfers, mints = totals.get(day, (0, 0, 0))
+        totals[day] = (interactions + sign, transfers + sign * (direction == 'sent'), mints + sign * (direction == 'mint'))
+    return totals
+
+
+def get_contracts_watermark(conn, conn_novo_blocks):
+    return get_watermark(conn, conn_novo_blocks, "contracts", rollback_token_interactions)
+
+
+def parse_contract_output(txid, transaction_data, interaction_time, blockheight):
+    return contract_interactions(txid, json.loads(transaction_data), transaction_data, interaction_time, blockheight)
+
+
+# Build the interactions of an already decoded contract output, one per receiving address
+def contract_interactions(txid, entry, transaction_data, interaction_time, blockheight):
+    token_name = None
+    token_symbol = None
+    token_decimals = None
+    token_icon = None
+    genesis_price = None
+    limit_mint = None
+    limit_wallet = None
+
+    try:
+        metadata = json.loads(entry.get('contractMetadata', ''))
+        if isinstance(metadata, dict):
+            token_name = metadata.get('name', None)
+            token_symbol = metadata.get('symbol', None)
+            token_decimals = metadata.get('decimal', None)
+            token_icon = metadata.get('icon', None)
+            genesis_price = metadata.get('genesis_price', None)
+            limit_mint = metadata.get('limit_mint', None)
+            limit_wallet = metadata.get('limit_wallet', None)
+    except (json.JSONDecodeError, TypeError):
+        # Handle case where metadata is not valid JSON or is not a dictionary
+        pass
+
+    address_list = entry.get('scriptPubKey', {}).get('addresses', [])
+    return [
+        ContractInteraction(
+            txid, address, entry.get('contractID', None), transaction_data, entry.get('contractMaxSupply', None),
+            token_name, token_symbol, interaction_time, entry.get('n', None),
+            CONTRACT_TYPES.get(entry.get('contractType', None)), entry.get('contractValue', None),
+            token_decimals, token_icon, genesis_price, limit_mint, limit_wallet, blockheight,
+        )
+        for address in address_list
+    ]
+
+
+def get_transactions_with_any_contract_id(conn_novo_blocks, from_height, to_height):
     cursor_novo_blocks = conn_novo_blocks.cursor()
 
-    query = "SELECT txid, vout, time FROM transactions WHERE vout LIKE '%\"contractID\":%'"
-    cursor_novo_blocks.execute(query)
-    results = cursor_novo_blocks.fetchall()
+    # contract_outputs is filled by extract.py as blocks are saved
+    query = """
+        SELECT c.txid, c.output, b.time, c.blockheight
+        FROM contract_outputs c
+        JOIN blocks b ON b.height = c.blockheight
+        WHERE c.blockheight > ? AND c.blockheight <= ?
+        ORDER BY c.blockheight, c.txid, c.n
+    """
+    cursor_novo_blocks.execute(query, (from_height, to_height))
 
     transactions = []
     addresses = set()
-    for tx in results:
-        txid = tx[0]
-        vout = json.loads(tx[1])
-        for entry in vout:
-            if 'contractID' in entry:
-                address_list = entry.get('scriptPubKey', {}).get('addresses', [])
-                transaction_data = json.dumps(entry)
-                transactions.extend([(txid, address, transaction_data, tx[2]) for address in address_list])
-                addresses.update(address_list)
+    for txid, transaction_data, interaction_time, blockheight in cursor_novo_blocks:
+        interactions = parse_contract_output(txid, transaction_data, interaction_time, blockheight)
+        transactions.extend(interactions)
+        addresses.update(interaction.address for interaction in interactions)
+
+    return transactions, get_contract_spends(conn_novo_blocks, from_height, to_height), addresses
 
-    conn_novo_blocks.close()
 
-    return transactions, addresses
+# Outputs spent by the transactions with contract outputs in blocks above from_height, up to
+# to_height, as (txid, n, height of the spending block). A token output spent by a transaction
+# without contract outputs is not seen, and stays on the ledger
+def get_contract_spends(conn_novo_blocks, from_height, to_height):
+    cursor = conn_novo_blocks.cursor()
+    cursor.execute("""
+        SELECT DISTINCT txid, blockheight
+        FROM contract_outputs
+        WHERE blockheight > ? AND blockheight <= ?
+    """, (from_height, to_height))
+
+    spends = []
+    for txid, blockheight in cursor.fetchall():
+        result = conn_novo_blocks.partitions.get_transaction(txid, "vin")
+        if result is not None:
+            spends.extend(transaction_spends(json.loads(result[0]), blockheight))
+    return spends
+
+
+def transaction_spends(vin, blockheight):
+    return [(entry["txid"], entry["vout"], blockheight) for entry in vin if "txid" in entry]
 
 
 def import_address(address):
@@ -180,33 +541,352 @@ def list_all_contract_unspent():
 #    logger.info("listcontractunspent output: %s", output)
     return json.loads(output)
 
-def update_token_balances(conn, address, contract_id, contract_type, balance, metadata):
+def get_ledger_balance(conn, address, contract_id):
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT balance FROM token_ledger WHERE address = ? AND contract_id = ?
+    """, (address, contract_id))
+    result = cursor.fetchone()
+    return result[0] if result and result[0] is not None else 0
+
+
+# An output credits its address with its value. apply_spends takes it off again once the output
+# is spent
+def interaction_delta(interaction_type, value):
+    if interaction_type not in HOLDING_TYPES:
+        return 0
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def apply_ledger_deltas(conn):
     cursor = conn.cursor()
 
-    # Compute the token balance
+    # Only interactions classified since the last pass are picked up here
     cursor.execute("""
-        SELECT SUM(CASE WHEN direction = 'received' THEN value ELSE 0 END) - SUM(CASE WHEN direction = 'sent' THEN value ELSE 0 END) AS balance
+        SELECT rowid, address, contract_id, type, direction, value, blockheight, interaction_time
         FROM token_interactions
-        WHERE address = ? AND contract_id = ?
-    """, (address, contract_id))
+        WHERE ledger_delta IS NULL AND direction IS NOT NULL
+    """)
+    rows = cursor.fetchall()
+
+    deltas = {}
+    applied = []
+    for rowid, address, contract_id, interaction_type, direction, value, blockheight, interaction_time in rows:
+        delta = interaction_delta(interaction_type, value)
+        applied.append((delta, rowid))
+        if interaction_type not in HOLDING_TYPES:
+            continue
+        balance, last_height, _ = deltas.get((address, contract_id), (0, None, None))
+        if blockheight is not None and (last_height is None or blockheight > last_height):
+            last_height = blockheight
+        deltas[(address, contract_id)] = (balance + delta, last_height, HOLDING_TYPES[interaction_type])
+
+    cursor.executemany("""
+        INSERT INTO token_ledger (address, contract_id, balance, last_height, contract_type)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (address, contract_id) DO UPDATE SET
+            balance = balance + excluded.balance,
+            last_height = MAX(COALESCE(last_height, 0), COALESCE(excluded.last_height, 0)),
+            contract_type = excluded.contract_type
+    """, [(address, contract_id, balance, last_height, contract_type) for (address, contract_id), (balance, last_height, contract_type) in deltas.items()])
+
+    cursor.executemany("UPDATE token_interactions SET ledger_delta = ? WHERE rowid = ?", applied)
+
+    add_daily_stats(cursor, "daily_token_stats", DAILY_TOKEN_STATS, daily_token_totals(
+        (interaction_time, direction) for _, _, _, _, direction, _, _, interaction_time in rows
+    ))
+
+    conn.commit()
+    return set(deltas)
+
+
+# Mark the token outputs spent by this pass's transactions as spent at the spending block's
+# height and take their value off the ledger. Most inputs spend plain NOVO outputs and match
+# nothing. Returns the (address, contract) pairs whose balance moved
+def apply_spends(conn, spends):
+    cursor = conn.cursor()
+    debits = {}
+    for txid, n, blockheight in spends:
+        cursor.execute("""
+            SELECT rowid, address, contract_id, ledger_delta
+            FROM token_interactions
+            WHERE transaction_id = ? AND n = ? AND spent_height IS NULL AND ledger_delta IS NOT NULL
+        """, (txid, n))
+        for rowid, address, contract_id, delta in cursor.fetchall():
+            cursor.execute("UPDATE token_interactions SET spent_height = ? WHERE rowid = ?", (blockheight, rowid))
+            if delta:
+                debits[(address, contract_id)] = debits.get((address, contract_id), 0) + delta
+
+    cursor.executemany("""
+        UPDATE token_ledger SET balance = balance - ? WHERE address = ? AND contract_id = ?
+    """, [(delta, address, contract_id) for (address, contract_id), delta in debits.items()])
+
+    conn.commit()
+    return set(debits)
+
+
+# Recompute the delta of every applied interaction under the current rules, replay the spends of
+# every block the stage has indexed from novo_blocks.db, and rebuild the ledger and the balances
+# from them. Retried on the next start while novo_blocks.db is not ready
+def rebuild_token_ledger(conn, blocks_path="novo_blocks.db"):
+    watermark = get_sync_state(conn, "contracts")
+    novo_blocks_conn = None
+    if watermark is not None:
+        novo_blocks_conn = open_partitioned_blocks(blocks_path)
+        if novo_blocks_conn is None:
+            return
+
+    logger.info("Rebuilding the token ledger")
+    cursor = conn.cursor()
+    cursor.execute("SELECT rowid, type, value FROM token_interactions WHERE ledger_delta IS NOT NULL")
+    cursor.executemany("UPDATE token_interactions SET ledger_delta = ? WHERE rowid = ?", [
+        (interaction_delta(interaction_type, value), rowid) for rowid, interaction_type, value in cursor.fetchall()
+    ])
+    cursor.execute("UPDATE token_interactions SET spent_height = NULL WHERE spent_height IS NOT NULL")
+    if novo_blocks_conn is not None:
+        apply_spends(conn, get_contract_spends(novo_blocks_conn, 0, watermark[0]))
+        novo_blocks_conn.close()
+
+    cursor.execute("DELETE FROM token_ledger")
+    cursor.execute("""
+        SELECT address, contract_id, type, SUM(ledger_delta), MAX(blockheight)
+        FROM token_interactions
+        WHERE ledger_delta IS NOT NULL AND spent_height IS NULL
+        GROUP BY address, contract_id, type
+    """)
+    cursor.executemany("""
+        INSERT INTO token_ledger (address, contract_id, balance, last_height, contract_type)
+        VALUES (?, ?, ?, ?, ?)
+    """, [
+        (address, contract_id, balance, last_height, HOLDING_TYPES[interaction_type])
+        for address, contract_id, interaction_type, balance, last_height in cursor.fetchall()
+        if interaction_type in HOLDING_TYPES
+    ])
+
+    # Balances the ledger no longer has drop to 0
+    cursor.execute("SELECT address, contract_id, contract_type, balance FROM token_ledger")
+    balances = {(address, contract_id, contract_type): balance for address, contract_id, contract_type, balance in cursor.fetchall()}
+    cursor.execute("SELECT address, token_contract_id, contract_type FROM token_balances")
+    for key in cursor.fetchall():
+        balances.setdefault(key, 0)
+    for (address, contract_id, contract_type), balance in balances.items():
+        update_token_balances(conn, address, contract_id, contract_type, balance, None)
+    refresh_holder_ranks(conn)
+
+    set_sync_state(conn, "token_ledger", LEDGER_RULES, None)
+    conn.commit()
+
+
+# Copy the ledger balance of each (address, contract) pair into token_balances
+def update_balances_from_ledger(conn, keys):
+    cursor = conn.cursor()
+    for address, contract_id in keys:
+        cursor.execute("""
+            SELECT balance, contract_type FROM token_ledger WHERE address = ? AND contract_id = ?
+        """, (address, contract_id))
+        result = cursor.fetchone()
+        if result and result[1] is not None:
+            update_token_balances(conn, address, contract_id, result[1], result[0], None)
+
+
+def rollback_token_interactions(conn, height):
+    cursor = conn.cursor()
+
+    # Outputs spent at or above the fork height are unspent again
+    cursor.execute("""
+        SELECT address, contract_id, ledger_delta
+        FROM token_interactions
+        WHERE spent_height >= ?
+    """, (height,))
+    credits = {}
+    for address, contract_id, delta in cursor.fetchall():
+        credits[(address, contract_id)] = credits.get((address, contract_id), 0) + delta
+    cursor.executemany("""
+        UPDATE token_ledger SET balance = balance + ? WHERE address = ? AND contract_id = ?
+    """, [(delta, address, contract_id) for (address, contract_id), delta in credits.items()])
+    cursor.execute("UPDATE token_interactions SET spent_height = NULL WHERE spent_height >= ?", (height,))
+
+    # Reverse the ledger deltas of every interaction at or above the fork height
+    cursor.execute("""
+        SELECT address, contract_id, ledger_delta, interaction_time, direction
+        FROM token_interactions
+        WHERE blockheight >= ? AND ledger_delta IS NOT NULL
+    """, (height,))
+    rows = cursor.fetchall()
+    reversals = {}
+    for address, contract_id, delta, _, _ in rows:
+        reversals[(address, contract_id)] = reversals.get((address, contract_id), 0) + delta
+
+    cursor.executemany("""
+        UPDATE token_ledger SET balance = balance - ? WHERE address = ? AND contract_id = ?
+    """, [(delta, address, contract_id) for (address, contract_id), delta in reversals.items()])
+
+    add_daily_stats(cursor, "daily_token_stats", DAILY_TOKEN_STATS, daily_token_totals(
+        ((interaction_time, direction) for _, _, _, interaction_time, direction in rows), -1
+    ))
+
+    cursor.execute("DELETE FROM token_interactions WHERE blockheight >= ?", (height,))
+
+    conn.commit()
+
+    touched = set(credits) | set(reversals)
+    update_balances_from_ledger(conn, touched)
+    refresh_holder_ranks(conn)
+    logger.info("Rolled back token interactions from height %d (%d balances adjusted)", height, len(touched))
+
+
+def update_token_holder(conn, contract_id, address, balance):
+    cursor = conn.cursor()
+    cursor.execute("SELECT balance FROM token_holders WHERE contract_id = ? AND address = ?", (contract_id, address))
+    result = cursor.fetchone()
+    old_balance = result[0] if result else 0
+    balance = balance if balance and balance > 0 else 0
+
+    # Holder counts and the held total are counters adjusted by the change, never recounted
+    if balance > 0:
+        cursor.execute("""
+            INSERT INTO token_holders (contract_id, address, balance)
+            VALUES (?, ?, ?)
+            ON CONFLICT (contract_id, address) DO UPDATE SET balance = excluded.balance
+        """, (contract_id, address, balance))
+    elif result:
+        cursor.execute("DELETE FROM token_holders WHERE contract_id = ? AND address = ?", (contract_id, address))
+
+    # Moving a holder from old_balance to balance only shifts the ranks of holders between the
+    # two, so widen the contract's dirty range to cover both; a NULL dirty_high means no bound
+    holder_delta = (1 if balance > 0 else 0) - (1 if result else 0)
+    cursor.execute("""
+        INSERT INTO token_holder_counts (contract_id, num_holders, total_balance, dirty, dirty_low, dirty_high)
+        VALUES (?, ?, ?, 1, ?, ?)
+        ON CONFLICT (contract_id) DO UPDATE SET
+            num_holders = num_holders + excluded.num_holders,
+            total_balance = total_balance + excluded.total_balance,
+            dirty_low = CASE WHEN dirty = 1 THEN MIN(dirty_low, excluded.dirty_low) ELSE excluded.dirty_low END,
+            dirty_high = CASE
+                WHEN dirty = 1 AND dirty_high IS NULL THEN NULL
+                WHEN dirty = 1 THEN MAX(dirty_high, excluded.dirty_high)
+                ELSE excluded.dirty_high
+            END,
+            dirty = 1
+    """, (contract_id, holder_delta, balance - old_balance, min(balance, old_balance), max(balance, old_balance)))
+
+
+# Re-rank the holders whose balance lies in each dirty contract's range. Holders above the
+# range keep their rank and holders below it only shift if the range covers them, so a pass
+# costs the number of holders between the lowest and highest balance that moved
+def refresh_holder_ranks(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT contract_id, max_supply, dirty_low, dirty_high FROM token_holder_counts WHERE dirty = 1")
+    dirty_contracts = cursor.fetchall()
+
+    for contract_id, max_supply, low, high in dirty_contracts:
+        # The supply is fixed by the contract; once it is known every percentage needs computing
+        if not max_supply:
+            cursor.execute("""
+                SELECT max_supply FROM token_interactions
+                WHERE contract_id = ? AND max_supply IS NOT NULL
+                LIMIT 1
+            """, (contract_id,))
+            result = cursor.fetchone()
+            if result and result[0]:
+                max_supply, low, high = result[0], 0, None
+                cursor.execute("UPDATE token_holder_counts SET max_supply = ? WHERE contract_id = ?", (max_supply, contract_id))
+
+        offset = 0
+        if high is not None:
+            # The lowest holder above the range was not touched, so its rank still holds
+            cursor.execute("""
+                SELECT rank FROM token_holders
+                WHERE contract_id = ? AND balance > ?
+                ORDER BY balance, address DESC
+                LIMIT 1
+            """, (contract_id, high))
+            result = cursor.fetchone()
+            if result and result[0] is not None:
+                offset = result[0]
+            elif result:
+                low, high = 0, None
+
+        if high is None:
+            cursor.execute("""
+                SELECT address, balance, rank, percent_of_supply
+                FROM token_holders
+                WHERE contract_id = ? AND balance >= ?
+                ORDER BY balance DESC, address
+            """, (contract_id, low or 0))
+        else:
+            cursor.execute("""
+                SELECT address, balance, rank, percent_of_supply
+                FROM token_holders
+                WHERE contract_id = ? AND balance >= ? AND balance <= ?
+                ORDER BY balance DESC, address
+            """, (contract_id, low or 0, high))
+
+        updates = []
+        for rank, (address, balance, old_rank, old_percent) in enumerate(cursor.fetchall(), offset + 1):
+            percent_of_supply = (balance / max_supply) * 100 if max_supply else None
+            if rank != old_rank or percent_of_supply != old_percent:
+                updates.append((rank, percent_of_supply, contract_id, address))
+
+        cursor.executemany("""
+            UPDATE token_holders SET rank = ?, percent_of_supply = ?
+            WHERE contract_id = ? AND address = ?
+        """, updates)
+        cursor.execute("""
+            UPDATE token_holder_counts SET dirty = 0, dirty_low = NULL, dirty_high = NULL
+            WHERE contract_id = ?
+        """, (contract_id,))
+
+    conn.commit()
+    return len(dirty_contracts)
+
+
+def get_num_holders(conn, contract_id):
+    cursor = conn.cursor()
+    cursor.execute("SELECT num_holders FROM token_holder_counts WHERE contract_id = ?", (contract_id,))
+    result = cursor.fetchone()
+    return result[0] if result else 0
+
+
+# Keyset page of holders ordered by balance; pass the last (balance, address) seen to continue
+def get_top_holders(conn, contract_id, limit=100, after=None):
+    cursor = conn.cursor()
+    if after is None:
+        cursor.execute("""
+            SELECT address, balance, rank, percent_of_supply
+            FROM token_holders
+            WHERE contract_id = ?
+            ORDER BY balance DESC, address
+            LIMIT ?
+        """, (contract_id, limit))
+    else:
+        last_balance, last_address = after
+        cursor.execute("""
+            SELECT address, balance, rank, percent_of_supply
+            FROM token_holders
+            WHERE contract_id = ? AND (balance < ? OR (balance = ? AND address > ?))
+            ORDER BY balance DESC, address
+            LIMIT ?
+        """, (contract_id, last_balance, last_balance, last_address, limit))
+    return cursor.fetchall()
+
+
+def update_token_balances(conn, address, contract_id, contract_type, balance, metadata):
+    cursor = conn.cursor()
+
+    new_balance = balance
+
+    # Nothing to rewrite when the ledger balance did not move
+    cursor.execute("""
+        SELECT balance FROM token_balances
+        WHERE address = ? AND token_contract_id = ? AND contract_type = ?
+    """, (address, contract_id, contract_type))
     result = cursor.fetchone()
-    existing_balance = result[0] if result[0] is not None else 0
-
-    # Fetch contract unspent for the given address and contract_id
-    contract_unspent_list = list_all_contract_unspent()
-    new_balance = existing_balance + balance
-
-    for contract_unspent in contract_unspent_list:
-        unspent_address = contract_unspent.get('address')
-        unspent_contract_id = contract_unspent.get('contractID')
-        unspent_balance = contract_unspent.get('contractValue')
-        
-        if unspent_address == address and unspent_contract_id == contract_id:
-            # Update the balance with the unspent balance
-            try:
-                new_balance += int(unspent_balance)
-            except ValueError:
-                logger.error(f"Invalid contractValue: {unspent_balance}")
+    if result and result[0] == new_balance:
+        return
 
     # Retrieve token symbol, name, and decimals from token_interactions table
     cursor.execute("""
@@ -228,6 +908,11 @@ def update_token_balances(conn, address, contract_id, contract_type, balance, me
         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
     """, (address, contract_id, contract_type, new_balance, int(time.time()), token_name, token_symbol, token_decimals))
 
+    cursor.execute("""
+        SELECT SUM(balance) FROM token_balances WHERE address = ? AND token_contract_id = ?
+    """, (address, contract_id))
+    update_token_holder(conn, contract_id, address, cursor.fetchone()[0])
+
     conn.commit()
 
 
@@ -235,68 +920,49 @@ def update_token_balances(conn, address, contract_id, contract_type, balance, me
 
 def process_transactions(conn, transactions):
     cursor = conn.cursor()
-    for tx in transactions:
-        txid, address, transaction_data, interaction_time = tx
-        contract_id = json.loads(transaction_data).get('contractID', None)
-        max_supply = json.loads(transaction_data).get('contractMaxSupply', None)
-        token_name = None
-        token_symbol = None
-        n = json.loads(transaction_data).get('n', None)
-        contract_type = json.loads(transaction_data).get('contractType', None)
-        value = json.loads(transaction_data).get('contractValue', None)
-        token_decimals = None
-        token_icon = None
-        genesis_price = None
-        limit_mint = None
-        limit_wallet = None
-
-        try:
-            metadata = json.loads(json.loads(transaction_data).get('contractMetadata', ''))
-            if isinstance(metadata, dict):
-                token_name = metadata.get('name', None)
-                token_symbol = metadata.get('symbol', None)
-                token_decimals = metadata.get('decimal', None)
-                token_icon = metadata.get('icon', None)
-                genesis_price = metadata.get('genesis_price', None)
-                limit_mint = metadata.get('limit_mint', None)
-                limit_wallet = metadata.get('limit_wallet', None)
-        except (json.JSONDecodeError, TypeError):
-            # Handle case where metadata is not valid JSON or is not a dictionary
-            pass
-
-        type_value = None
-        if contract_type == 'FT_MINT':
-            type_value = 'token mint'
-        elif contract_type == 'FT':
-            type_value = 'token transfer'
-        elif contract_type == 'NFT':
-            type_value = 'NFT transfer'
-        elif contract_type == 'NFT_MINT':
-            type_value = 'NFT mint'
-
-        cursor.execute("""
-            INSERT OR IGNORE INTO token_interactions (transaction_id, address, contract_id, transaction_data, max_supply, token_name, token_symbol, interaction_time, n, type, value, token_decimals,  token_icon, genesis_price, limit_mint, limit_wallet, direction)
+    last_rowid = cursor.execute("SELECT COALESCE(MAX(rowid), 0) FROM token_interactions").fetchone()[0]
+    for start in range(0, len(transactions), INSERT_CHUNK_SIZE):
+        cursor.executemany("""
+            INSERT OR IGNORE INTO token_interactions (transaction_id, address, contract_id, transaction_data, max_supply, token_name, token_symbol, interaction_time, n, type, value, token_decimals,  token_icon, genesis_price, limit_mint, limit_wallet, blockheight)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (txid, address, contract_id, transaction_data, max_supply, token_name, token_symbol, interaction_time, n, type_value, value, token_decimals, token_icon, genesis_price, limit_mint, limit_wallet, None))
+        """, transactions[start:start + INSERT_CHUNK_SIZE])
 
+    # Announce the rows that were inserted, not the ones ignored as duplicates
+    cursor.execute("""
+        SELECT transaction_id, n, address, contract_id, type, value, token_symbol, blockheight, interaction_time
+        FROM token_interactions WHERE rowid > ? ORDER BY rowid
+    """, (last_rowid,))
+    publish_events(cursor, [("token", address, contract_id, {
+        "transaction_id": transaction_id,
+        "n": n,
+        "address": address,
+        "contract_id": contract_id,
+        "type": interaction_type,
+        "value": value,
+        "token_symbol": token_symbol,
+        "blockheight": blockheight,
+        "interaction_time": interaction_time
+    }) for transaction_id, n, address, contract_id, interaction_type, value, token_symbol, blockheight, interaction_time in cursor.fetchall()])
     conn.commit()
 
 
 def populate_direction_column(conn):
     cursor = conn.cursor()
 
+    # Directions never change once set, so only unclassified interactions are looked at
+
     # Set 'mint' in 'direction' column for mint transactions
     cursor.execute("""
         UPDATE token_interactions
         SET direction = 'mint'
-        WHERE type LIKE '%mint%'
+        WHERE type IN ('token mint', 'NFT mint') AND direction IS NULL
     """)
 
     # Get transfers with 'transfer' in 'type' column
     cursor.execute("""
         SELECT transaction_id, n
         FROM token_interactions
-        WHERE type LIKE '%transfer%'
+        WHERE type IN ('token transfer', 'NFT transfer') AND direction IS NULL
     """)
     transfers = cursor.fetchall()
 
@@ -321,7 +987,7 @@ def populate_direction_column(conn):
             cursor.execute("""
                 SELECT COUNT(*)
                 FROM token_interactions
-                WHERE transaction_id = ? AND n = ? AND type LIKE '%mint%'
+                WHERE transaction_id = ? AND n = ? AND type IN ('token mint', 'NFT mint')
             """, (txid, n - 1))
             mint_count = cursor.fetchone()[0]
 
@@ -351,12 +1017,12 @@ def populate_defi_table(conn):
     # Retrieve distinct contract IDs associated with tokens that have a non-null token_symbol
     cursor.execute("""
         SELECT DISTINCT contract_id
-        FROM token_interactions
+        FROM token_interactions INDEXED BY idx_token_interactions_symbol
         WHERE token_symbol IS NOT NULL
     """)
     contract_ids = cursor.fetchall()
 
-    current_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    current_time = int(time.time())
 
     for contract_id in contract_ids:
         contract_id = contract_id[0]  # Extract the contract_id value from the tuple
@@ -437,26 +1103,17 @@ def populate_defi_table(conn):
         else:
             minter = None
 
-        # Count the number of addresses with a non-null balance for the contract_id
-        cursor.execute("""
-            SELECT COUNT(DISTINCT address)
-            FROM token_balances
-            WHERE token_contract_id = ?
-        """, (contract_id,))
-        result = cursor.fetchone()
-        if result:
-            num_holders = result[0]
-        else:
-            continue
+        # Holder count is a stored counter maintained by update_token_holder
+        num_holders = get_num_holders(conn, contract_id)
 
         # Calculate tx_volume_24h
-        interaction_time_24h_start = (datetime.datetime.now() - datetime.timedelta(hours=24)).strftime('%Y-%m-%d %H:%M:%S')
-        interaction_time_24h_end = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        interaction_time_24h_start = current_time - SECONDS_PER_DAY
+        interaction_time_24h_end = current_time
 
         cursor.execute("""
             SELECT COALESCE(SUM(value), 0) AS tx_volume_24h
             FROM token_interactions
-            WHERE contract_id = ? AND direction LIKE '%received%' AND interaction_time > ? AND interaction_time <= ?
+            WHERE contract_id = ? AND direction IN ('received from mint', 'received from wallet') AND interaction_time > ? AND interaction_time <= ?
         """, (contract_id, interaction_time_24h_start, interaction_time_24h_end))
 
         result = cursor.fetchone()
@@ -466,13 +1123,13 @@ def populate_defi_table(conn):
             continue
 
         # Calculate tx_volume for the previous 24h period
-        interaction_time_48h_start = (datetime.datetime.now() - datetime.timedelta(hours=48)).strftime('%Y-%m-%d %H:%M:%S')
+        interaction_time_48h_start = current_time - 2 * SECONDS_PER_DAY
         interaction_time_48h_end = interaction_time_24h_start
 
         cursor.execute("""
             SELECT COALESCE(SUM(value), 0) AS tx_volume_48h
             FROM token_interactions
-            WHERE contract_id = ? AND direction LIKE '%received%' AND interaction_time > ? AND interaction_time <= ?
+            WHERE contract_id = ? AND direction IN ('received from mint', 'received from wallet') AND interaction_time > ? AND interaction_time <= ?
         """, (contract_id, interaction_time_48h_start, interaction_time_48h_end))
 
         result = cursor.fetchone()
@@ -482,13 +1139,13 @@ def populate_defi_table(conn):
             continue
 
         # Calculate the tx_volume_7d
-        interaction_time_7d_start = (datetime.datetime.now() - datetime.timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
-        interaction_time_7d_end = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        interaction_time_7d_start = current_time - 7 * SECONDS_PER_DAY
+        interaction_time_7d_end = current_time
 
         cursor.execute("""
             SELECT COALESCE(SUM(value), 0) AS tx_volume_7d
             FROM token_interactions
-            WHERE contract_id = ? AND direction LIKE '%received%' AND interaction_time > ? AND interaction_time <= ?
+            WHERE contract_id = ? AND direction IN ('received from mint', 'received from wallet') AND interaction_time > ? AND interaction_time <= ?
         """, (contract_id, interaction_time_7d_start, interaction_time_7d_end))
 
         result = cursor.fetchone()
@@ -498,13 +1155,13 @@ def populate_defi_table(conn):
             continue
 
         # Calculate tx_volume for the previous 7d period
-        interaction_time_14d_start = (datetime.datetime.now() - datetime.timedelta(days=14)).strftime('%Y-%m-%d %H:%M:%S')
+        interaction_time_14d_start = current_time - 14 * SECONDS_PER_DAY
         interaction_time_14d_end = interaction_time_7d_start
 
         cursor.execute("""
             SELECT COALESCE(SUM(value), 0) AS tx_volume_14d
             FROM token_interactions
-            WHERE contract_id = ? AND direction LIKE '%received%' AND interaction_time > ? AND interaction_time <= ?
+            WHERE contract_id = ? AND direction IN ('received from mint', 'received from wallet') AND interaction_time > ? AND interaction_time <= ?
         """, (contract_id, interaction_time_14d_start, interaction_time_14d_end))
 
         result = cursor.fetchone()
@@ -517,7 +1174,7 @@ def populate_defi_table(conn):
         cursor.execute("""
             SELECT COALESCE(SUM(value), 0) AS tx_volume_all_time
             FROM token_interactions
-            WHERE contract_id = ? AND direction LIKE '%received%'
+            WHERE contract_id = ? AND direction IN ('received from mint', 'received from wallet')
         """, (contract_id,))
 
         result = cursor.fetchone()
@@ -638,60 +1295,78 @@ def populate_defi_table(conn):
 
 
 
-def main():
-    contracts_conn = create_contracts_database()
-    transactions, addresses = get_transactions_with_any_contract_id()
-    process_transactions(contracts_conn, transactions)
-    populate_direction_column(contracts_conn)
-    populate_defi_table(contracts_conn)
+# Insert new interactions, classify them, apply them and the outputs they spend to the ledger,
+# and bring the balances they moved up to date
+def index_contract_interactions(conn, transactions, spends):
+    process_transactions(conn, transactions)
+    populate_direction_column(conn)
+    touched = apply_ledger_deltas(conn) | apply_spends(conn, spends)
+    update_balances_from_ledger(conn, touched)
+    refresh_holder_ranks(conn)
+
+
+# Work that depends on the node's wallet rather than on new blocks: defi stats, address
+# imports and NOVO balances
+def refresh_balances(conn, addresses):
+    populate_defi_table(conn)
+
+    # Until every address seen so far has been imported into the node's wallet, for instance after
+    # a snapshot import onto a node with a new wallet, they are all imported rather than only the
+    # ones of this pass
+    all_imported = get_sync_state(conn, "imported_addresses") is not None
+    if not all_imported:
+        addresses = set(addresses) | {row[0] for row in conn.execute("SELECT DISTINCT address FROM token_interactions")}
 
     print('Addresses:')
 
     for address in addresses:
         logger.info("Importing address: %s", address)
-        if not is_address_imported(contracts_conn, address):
+        if not is_address_imported(conn, address):
             import_address(address)
             # Add a default NOVO balance of 0 when adding a new imported address
-            add_imported_address(contracts_conn, address, 0)
-
-    contract_unspent_list = list_all_contract_unspent()
-    for contract_unspent in contract_unspent_list:
-        print(f"contract_unspent: {contract_unspent}")
-        address = contract_unspent.get('address')
-        contract_id = contract_unspent.get('contractID')
-        contract_type = contract_unspent.get('contractType')
-        try:
-            balance = int(contract_unspent.get('contractValue'))
-        except ValueError:
-            logger.error(f"Invalid contractValue: {contract_unspent.get('contractValue')}")
-            continue
-        metadata = contract_unspent.get('contractMetadata')
-
-        # Import address only if it hasn't been imported before
-        if not is_address_imported(contracts_conn, address):
-            import_address(address)
-            add_imported_address(contracts_conn, address, 0)
+            add_imported_address(conn, address, 0)
 
-        update_token_balances(contracts_conn, address, contract_id, contract_type, balance, metadata)
+    if not all_imported:
+        set_sync_state(conn, "imported_addresses", 0, None)
+        conn.commit()
 
     # Update NOVO balances
     address_groupings = list_address_groupings()
     for group in address_groupings:
         for entry in group:
             address, novo_balance = entry[:2]
-            if is_address_imported(contracts_conn, address):
-                update_novo_balances(contracts_conn, address, novo_balance)
- 
+            if is_address_imported(conn, address):
+                update_novo_balances(conn, address, novo_balance)
+
+
+def main():
+    contracts_conn = create_contracts_database()
+    novo_blocks_conn = connect_blocks("novo_blocks.db", readonly=True)
+
+    # Only blocks above the watermark are read from novo_blocks.db
+    watermark = get_contracts_watermark(contracts_conn, novo_blocks_conn)
+    tip_height, tip_hash = get_block_tip(novo_blocks_conn)
+    transactions, spends, addresses = get_transactions_with_any_contract_id(novo_blocks_conn, watermark, tip_height)
+    novo_blocks_conn.close()
+    logger.info("Processing %d contract interactions from heights %d to %d", len(transactions), watermark + 1, tip_height)
+
+    index_contract_interactions(contracts_conn, transactions, spends)
+    if tip_height > watermark:
+        save_watermark(contracts_conn, "contracts", tip_height, tip_hash)
+        contracts_conn.commit()
 
+    refresh_balances(contracts_conn, addresses)
 
     contracts_conn.close()
 
 
 if __name__ == '__main__':
     update_interval = 60  # Update every minute
+    profiling.install()
     while True:
         try:
-            main()
+            with profiling.profile_pass("contracts"):
+                main()
             logger.info("Sleeping for %d seconds", update_interval)
             time.sleep(update_interval)
         except Exception as e:
@@ -0,0 +1,186 @@
+import json
+import logging
+import queue
+import threading
+import time
+
+import contracts
+import extract
+import index_content
+from db_utils import get_block_tip, get_sync_state, get_watermark, save_watermark
+from events import CONNECTED, BlockBus
+from partitions import connect_blocks
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# How often the extractor asks the node for new blocks
+POLL_INTERVAL = 5
+# How long a consumer waits after an error before catching up from novo_blocks.db again
+RETRY_INTERVAL = 10
+# How often the contracts consumer refreshes balances from the node's wallet
+BALANCE_REFRESH_INTERVAL = 60
+
+
+# A stage that follows the block bus. It first catches up from novo_blocks.db to its own
+# checkpoint, then indexes blocks straight from the decoded events. Events at or below the
+# checkpoint were already covered by the catch up and are skipped
+class StageConsumer(threading.Thread):
+    stage = None
+
+    def __init__(self, bus, stop):
+        super().__init__(name=self.stage, daemon=True)
+        self.bus = bus
+        self.stop = stop
+        # Subscribe before the extractor starts so no event falls between catch up and the bus
+        self.events = bus.subscribe()
+        self.checkpoint = (0, None)
+
+    def run(self):
+        self.conn = self.open_database()
+        self.novo_blocks_conn = connect_blocks("novo_blocks.db", readonly=True)
+        while not self.stop.is_set():
+            try:
+                self.catch_up()
+                self.consume()
+            except Exception as e:
+                logger.exception("%s consumer failed: %s", self.stage, e)
+                self.conn.rollback()
+                time.sleep(RETRY_INTERVAL)
+        self.conn.close()
+        self.novo_blocks_conn.close()
+
+    def catch_up(self):
+        watermark = get_watermark(self.conn, self.novo_blocks_conn, self.stage, self.rollback)
+        tip_height, tip_hash = get_block_tip(self.novo_blocks_conn)
+        if tip_height > watermark:
+            logger.info("%s catching up from height %d to %d", self.stage, watermark + 1, tip_height)
+            self.index_range(watermark, tip_height)
+            self.save_checkpoint(tip_height, tip_hash)
+        else:
+            self.checkpoint = get_sync_state(self.conn, self.stage) or (0, None)
+
+    def consume(self):
+        while not self.stop.is_set():
+            try:
+                event = self.events.get(timeout=1)
+            except queue.Empty:
+                self.idle()
+                continue
+
+            height, block_hash = self.checkpoint
+            if event.kind == CONNECTED:
+                if event.height <= height:
+                    continue
+                if event.height > height + 1 or event.block.get("previousblockhash") != block_hash:
+                    # Missed events, read what is missing from novo_blocks.db instead
+                    self.catch_up()
+                    continue
+                self.index_block(event)
+                self.save_checkpoint(event.height, event.hash)
+            elif event.height <= height:
+                self.rollback(self.conn, event.height)
+                cursor = self.novo_blocks_conn.cursor()
+                cursor.execute("SELECT hash FROM blocks WHERE height = ?", (event.height - 1,))
+                result = cursor.fetchone()
+                self.save_checkpoint(event.height - 1, result[0] if result else None)
+                logger.info("%s disconnected block %d", self.stage, event.height)
+
+    def save_checkpoint(self, height, block_hash):
+        save_watermark(self.conn, self.stage, height, block_hash)
+        self.conn.commit()
+        self.checkpoint = (height, block_hash)
+
+    def idle(self):
+        pass
+
+
+class ContentConsumer(StageConsumer):
+    stage = "content"
+
+    def open_database(self):
+        return index_content.create_content_database()
+
+    def rollback(self, conn, height):
+        index_content.rollback_content(conn, height)
+
+    def index_range(self, from_height, to_height):
+        transactions = index_content.get_transactions_with_any_content(self.novo_blocks_conn, from_height, to_height)
+        index_content.index_content(self.conn, transactions, from_height)
+
+    def index_block(self, event):
+        transactions = []
+        for tx_data in event.transactions:
+            tx = index_content.classify_transaction(tx_data["txid"], json.dumps(tx_data["vout"]), tx_data["time"], event.height, tx_data.get("fee"))
+            if tx:
+                transactions.append(tx)
+        index_content.index_content(self.conn, transactions, event.height - 1)
+
+
+class ContractsConsumer(StageConsumer):
+    stage = "contracts"
+
+    def __init__(self, bus, stop):
+        super().__init__(bus, stop)
+        self.pending_addresses = set()
+        self.last_refresh = 0
+
+    def open_database(self):
+        return contracts.create_contracts_database()
+
+    def rollback(self, conn, height):
+        contracts.rollback_token_interactions(conn, height)
+
+    def index_range(self, from_height, to_height):
+        transactions, spends, addresses = contracts.get_transactions_with_any_contract_id(self.novo_blocks_conn, from_height, to_height)
+        contracts.index_contract_interactions(self.conn, transactions, spends)
+        self.pending_addresses.update(addresses)
+
+    def index_block(self, event):
+        transactions = []
+        spends = []
+        for tx_data in sorted(event.transactions, key=lambda tx: tx["txid"]):
+            outputs = [entry for entry in sorted(tx_data["vout"], key=lambda entry: entry.get("n")) if "contractID" in entry]
+            for entry in outputs:
+                transactions.extend(contracts.contract_interactions(tx_data["txid"], entry, json.dumps(entry), tx_data["time"], event.height))
+            if outputs:
+                spends.extend(contracts.transaction_spends(tx_data["vin"], event.height))
+        contracts.index_contract_interactions(self.conn, transactions, spends)
+        self.pending_addresses.update(interaction.address for interaction in transactions)
+
+    # NOVO balances and defi stats come from the node's wallet rather than from blocks, so they
+    # are refreshed on a timer while the bus is quiet instead of after every block
+    def idle(self):
+        if time.monotonic() - self.last_refresh < BALANCE_REFRESH_INTERVAL:
+            return
+        addresses, self.pending_addresses = self.pending_addresses, set()
+        contracts.refresh_balances(self.conn, addresses)
+        self.last_refresh = time.monotonic()
+
+
+def main():
+    bus = BlockBus()
+    stop = threading.Event()
+
+    conn = extract.create_database()
+    consumers = [ContentConsumer(bus, stop), ContractsConsumer(bus, stop)]
+    for consumer in consumers:
+        consumer.start()
+
+    try:
+        while True:
+            try:
+                if not extract.sync_blocks(conn, bus):
+                    time.sleep(POLL_INTERVAL)
+            except Exception as e:
+                logger.error("Error syncing blocks: %s", e)
+                time.sleep(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        stop.set()
+        for consumer in consumers:
+            consumer.join()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import json
+import re
+import sqlite3
+
+
+def get_columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return [row[1] for row in cursor.fetchall()]
+
+
+# SQLite has no ADD COLUMN IF NOT EXISTS, so check the table first
+def add_column_if_missing(cursor, table, column, definition):
+    if column not in get_columns(cursor, table):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        return True
+    return False
+
+
+def get_column_types(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {row[1]: row[2].upper() for row in cursor.fetchall()}
+
+
+# SQLite cannot change a column's type in place, so rebuild the table from its own CREATE
+# statement with the new types and copy every row across through the given SQL conversions.
+# Indexes are dropped with the old table, so call this before creating them
+def change_column_types(cursor, table, types, conversions):
+    sql = get_table_sql(cursor, table)
+    for column, column_type in types.items():
+        sql = re.sub(rf"\b{column}\s+\w+", f"{column} {column_type}", sql, count=1)
+    rebuild_table(cursor, table, sql, conversions)
+
+
+def get_table_sql(cursor, table):
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return cursor.fetchone()[0]
+
+
+# Rebuild a table from a changed CREATE statement, the same way change_column_types does
+def rebuild_table(cursor, table, sql, conversions):
+    sql = re.sub(rf"^CREATE TABLE\s+\"?{table}\"?", f"CREATE TABLE {table}_rebuild", sql)
+
+    columns = get_columns(cursor, table)
+    cursor.execute(f"DROP TABLE IF EXISTS {table}_rebuild")
+    cursor.execute(sql)
+    cursor.execute(f"""
+        INSERT INTO {table}_rebuild ({', '.join(columns)})
+        SELECT {', '.join(conversions.get(column, column) for column in columns)} FROM {table}
+    """)
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_rebuild RENAME TO {table}")
+
+
+# SQL converting a '%Y-%m-%d %H:%M:%S' string back to integer epoch seconds. Strings written
+# with datetime.fromtimestamp are in the indexer's local time, utcfromtimestamp ones are UTC
+def epoch_sql(column, local_time=True):
+    modifier = ", 'utc'" if local_time else ""
+    return f"CASE WHEN typeof({column}) = 'text' THEN CAST(strftime('%s', {column}{modifier}) AS INTEGER) ELSE {column} END"
+
+
+SECONDS_PER_DAY = 86400
+
+
+# Epoch seconds of the UTC midnight a timestamp falls on, the key of the daily stats tables
+def utc_day(timestamp):
+    return timestamp // SECONDS_PER_DAY * SECONDS_PER_DAY
+
+
+# Add per-day totals, {day: values in the order of columns}, into a daily stats table.
+# Negative totals undo earlier ones, and days whose first column drops to zero are removed
+def add_daily_stats(cursor, table, columns, totals):
+    if not totals:
+        return
+    cursor.executemany(f"""
+        INSERT INTO {table} (day, {', '.join(columns)})
+        VALUES (?, {', '.join('?' * len(columns))})
+        ON CONFLICT (day) DO UPDATE SET {', '.join(f'{column} = {column} + excluded.{column}' for column in columns)}
+    """, [(day, *values) for day, values in totals.items()])
+    cursor.executemany(f"DELETE FROM {table} WHERE day = ? AND {columns[0]} <= 0", [(day,) for day in totals])
+
+
+# Rows kept in each database's stream_events table. The API reads new events twice a second,
+# so only the last few commits need to stay
+STREAM_EVENTS_KEPT = 10000
+
+
+# Events for the API's live stream, one table per database. They are written in the same
+# transaction as the rows they announce, so the API never sees an event before its data.
+# AUTOINCREMENT keeps ids increasing after old rows are pruned
+def create_stream_events_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stream_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT,
+            address TEXT,
+            contract_id TEXT,
+            data TEXT
+        )
+    """)
+
+
+# Add events, (topic, address, contract_id, data), and prune the oldest
+def publish_events(cursor, events):
+    if not events:
+        return
+    cursor.executemany("""
+        INSERT INTO stream_events (topic, address, contract_id, data)
+        VALUES (?, ?, ?, ?)
+    """, [(topic, address, contract_id, json.dumps(data, separators=(",", ":"))) for topic, address, contract_id, data in events])
+    cursor.execute("DELETE FROM stream_events WHERE id <= (SELECT MAX(id) FROM stream_events) - ?", (STREAM_EVENTS_KEPT,))
+
+
+# How far below a stage's watermark its checkpoints are kept, as deep as the partitions'
+# FREEZE_DEPTH
+CHECKPOINT_DEPTH = 1000
+
+
+# Each stage records how far it has processed the chain as a (height, hash) watermark. Every
+# watermark it moves to is also kept in sync_checkpoints, so a reorg can be traced back to the
+# last block the stage processed that is still on the chain
+def create_sync_state_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name TEXT PRIMARY KEY,
+            height INTEGER,
+            hash TEXT
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sync_checkpoints (
+            name TEXT,
+            height INTEGER,
+            hash TEXT,
+            PRIMARY KEY (name, height)
+        )
+    """)
+
+    # Watermarks saved before sync_checkpoints existed are its first checkpoints
+    cursor.execute("""
+        INSERT OR IGNORE INTO sync_checkpoints (name, height, hash)
+        SELECT name, height, hash FROM sync_state WHERE hash IS NOT NULL
+    """)
+
+
+def get_sync_state(conn, name):
+    cursor = conn.cursor()
+    cursor.execute("SELECT height, hash FROM sync_state WHERE name = ?", (name,))
+    return cursor.fetchone()
+
+
+def set_sync_state(conn, name, height, block_hash):
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT OR REPLACE INTO sync_state (name, height, hash)
+        VALUES (?, ?, ?)
+    """, (name, height, block_hash))
+
+
+# Move a stage's watermark and keep it as a checkpoint. Checkpoints above it belong to blocks
+# that were rolled back. Checkpoints more than CHECKPOINT_DEPTH blocks below it are pruned,
+# except the newest of them, where a walk back in get_watermark ends
+def save_watermark(conn, name, height, block_hash):
+    set_sync_state(conn, name, height, block_hash)
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM sync_checkpoints WHERE name = ? AND height > ?", (name, height))
+    if block_hash is not None:
+        cursor.execute("INSERT OR REPLACE INTO sync_checkpoints (name, height, hash) VALUES (?, ?, ?)", (name, height, block_hash))
+    cursor.execute("""
+        DELETE FROM sync_checkpoints
+        WHERE name = ? AND height < (
+            SELECT MAX(height) FROM sync_checkpoints WHERE name = ? AND height <= ?
+        )
+    """, (name, name, height - CHECKPOINT_DEPTH))
+
+
+# WAL keeps readers (the API) and the indexer writing the same file from blocking each other
+def enable_wal(conn):
+    conn.execute("PRAGMA journal_mode=WAL")
+
+
+def connect_readonly(path):
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only = 1")
+    return conn
+
+
+def get_block_tip(conn_novo_blocks):
+    cursor = conn_novo_blocks.cursor()
+    cursor.execute("SELECT height, hash FROM blocks ORDER BY height DESC LIMIT 1")
+    return cursor.fetchone() or (0, None)
+
+
+# Return the height a stage has fully processed. If the block its watermark points at is no
+# longer indexed the chain was reorganized: step back through the stage's checkpoints to the
+# last one still on the chain, however deep the reorg, and let rollback undo everything above it.
+# With no checkpoint left on the chain the stage starts over from the genesis block
+def get_watermark(conn, conn_novo_blocks, name, rollback):
+    state = get_sync_state(conn, name)
+    if state is None:
+        return 0
+
+    height, block_hash = state
+    cursor = conn_novo_blocks.cursor()
+    cursor.execute("SELECT 1 FROM blocks WHERE height = ? AND hash = ?", (height, block_hash))
+    if cursor.fetchone():
+        return height
+
+    fork_height, fork_hash = 0, None
+    checkpoints = conn.cursor()
+    checkpoints.execute("SELECT height, hash FROM sync_checkpoints WHERE name = ? AND height < ? ORDER BY height DESC", (name, height))
+    for checkpoint_height, checkpoint_hash in checkpoints:
+        cursor.execute("SELECT 1 FROM blocks WHERE height = ? AND hash = ?", (checkpoint_height, checkpoint_hash))
+        if cursor.fetchone():
+            fork_height, fork_hash = checkpoint_height, checkpoint_hash
+            break
+    checkpoints.close()
+
+    rollback(conn, fork_height + 1)
+    save_watermark(conn, name, fork_height, fork_hash)
+    conn.commit()
+    return fork_height
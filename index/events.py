@@ -0,0 +1,38 @@
+import queue
+import threading
+from collections import namedtuple
+
+CONNECTED = "connected"
+DISCONNECTED = "disconnected"
+
+# transactions are the decoded getrawtransaction results of the block, empty on disconnect
+BlockEvent = namedtuple("BlockEvent", ["kind", "height", "hash", "block", "transactions"])
+
+# Events a consumer may fall behind by before the producer waits for it
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+# In-process fan-out of block events from the extractor to the indexing stages. Each
+# subscriber gets its own bounded queue, so a slow stage holds the extractor back instead of
+# letting decoded blocks pile up in memory
+class BlockBus:
+    def __init__(self, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        subscriber = queue.Queue(self.queue_size)
+        with self.lock:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.remove(subscriber)
+
+    def publish(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(event)
@@ -0,0 +1,823 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from contracts import get_top_holders
+from db_utils import SECONDS_PER_DAY, connect_readonly
+from partitions import connect_blocks
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+HOST = "0.0.0.0"
+PORT = 5000
+WORKER_THREADS = 8
+
+# Rendered responses kept in memory until the indexed data changes
+CACHE_MAX_ENTRIES = 5000
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# How often the databases are checked for commits by the indexers
+CHANGE_POLL_INTERVAL = 0.5
+
+DATABASES = {
+    "blocks": "novo_blocks.db",
+    "content": "content.db",
+    "contracts": "contracts.db",
+    "mempool": "mempool.db",
+}
+
+# The mempool changes every few seconds, so mempool.db is not watched for commits and
+# responses under /mempool are never cached
+UNCACHED_DATABASES = {"mempool"}
+UNCACHED_PREFIX = "/mempool"
+
+DEFAULT_LIMIT = 25
+MAX_LIMIT = 100
+
+# Live event stream at /stream. A subscriber that falls STREAM_CLIENT_BUFFER events behind is
+# disconnected, so one slow client never holds up the others or the indexers. Queued frames
+# are shared between subscribers, so a full buffer costs little more than its pointers
+STREAM_TOPICS = ("block", "inscription", "token")
+MAX_STREAM_SUBSCRIBERS = 10000
+STREAM_CLIENT_BUFFER = 10000
+STREAM_KEEPALIVE_INTERVAL = 15
+# Events queued before subscribers get a chance to write them out
+STREAM_PUBLISH_CHUNK = 100
+# stream_events rows read from each database per poll
+STREAM_READ_BATCH = 5000
+
+DEFAULT_DAYS = 30
+MAX_DAYS = 365
+
+STATUS_TEXT = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class APIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ReadPool:
+    # Each worker thread lazily opens its own read-only connection to every database
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sqlite-reader")
+        self.local = threading.local()
+
+    def connection(self, name):
+        connections = getattr(self.local, "connections", None)
+        if connections is None:
+            connections = self.local.connections = {}
+
+        conn = connections.get(name)
+        if conn is None:
+            try:
+                # novo_blocks.db routes transaction lookups to its partition files
+                conn = connect_blocks(DATABASES[name], readonly=True) if name == "blocks" else connect_readonly(DATABASES[name])
+            except sqlite3.OperationalError as e:
+                raise APIError(503, f"{DATABASES[name]} is not available: {e}")
+            conn.row_factory = sqlite3.Row
+            connections[name] = conn
+        return conn
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, self, *args)
+
+
+class ResponseCache:
+    # LRU of rendered response bodies, bounded by entry count and total size
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, etag, payload):
+        if len(payload) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old[1])
+        self.entries[key] = (etag, payload)
+        self.size += len(payload)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+        self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class StreamSubscriber:
+    def __init__(self, topics, address, contract_id, writer):
+        self.topics = topics
+        self.address = address
+        self.contract_id = contract_id
+        self.writer = writer
+        self.queue = asyncio.Queue(STREAM_CLIENT_BUFFER)
+        self.dropped = False
+
+    def matches(self, topic, address, contract_id):
+        return (topic in self.topics
+                and (self.address is None or self.address == address)
+                and (self.contract_id is None or self.contract_id == contract_id))
+
+
+class EventStream:
+    # Subscribers are indexed by their address or contract filter, so an event is only matched
+    # against the subscribers that can want it. Block events carry no address and go to every
+    # subscriber of the block topic
+    def __init__(self, max_subscribers=MAX_STREAM_SUBSCRIBERS):
+        self.max_subscribers = max_subscribers
+        self.subscribers = set()
+        self.block_subscribers = set()
+        self.unfiltered = set()
+        self.by_address = defaultdict(set)
+        self.by_contract = defaultdict(set)
+        self.events = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    # The index a subscriber is kept in, and the key it is kept under
+    def filter_index(self, subscriber):
+        if subscriber.address is not None:
+            return self.by_address, subscriber.address
+        if subscriber.contract_id is not None:
+            return self.by_contract, subscriber.contract_id
+        return None, None
+
+    def subscribe(self, topics, address, contract_id, writer):
+        if len(self.subscribers) >= self.max_subscribers:
+            raise APIError(503, "too many stream subscribers")
+        subscriber = StreamSubscriber(topics, address, contract_id, writer)
+        self.subscribers.add(subscriber)
+        if "block" in topics:
+            self.block_subscribers.add(subscriber)
+        index, key = self.filter_index(subscriber)
+        if index is None:
+            self.unfiltered.add(subscriber)
+        else:
+            index[key].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        if subscriber not in self.subscribers:
+            return
+        self.subscribers.discard(subscriber)
+        self.block_subscribers.discard(subscriber)
+        index, key = self.filter_index(subscriber)
+        if index is None:
+            self.unfiltered.discard(subscriber)
+        else:
+            index[key].discard(subscriber)
+            if not index[key]:
+                del index[key]
+
+    # Queue a frame without waiting. A subscriber whose buffer is full is cut off: the
+    # connection is aborted and the client can reconnect and catch up through the list endpoints
+    def deliver(self, subscriber, frame):
+        try:
+            subscriber.queue.put_nowait(frame)
+            self.delivered += 1
+        except asyncio.QueueFull:
+            subscriber.dropped = True
+            self.dropped += 1
+            self.unsubscribe(subscriber)
+            subscriber.writer.transport.abort()
+
+    # events are (topic, address, contract_id, data) with data already JSON-encoded. Each frame
+    # is encoded once for all subscribers. A catch-up
+    # pass commits thousands of events at once, so subscribers write out every chunk before the
+    # next one is queued
+    async def publish(self, events):
+        for i, (topic, address, contract_id, data) in enumerate(events):
+            if i and i % STREAM_PUBLISH_CHUNK == 0:
+                await asyncio.sleep(0)
+            self.events += 1
+            frame = f"event: {topic}\ndata: {data}\n\n".encode()
+            if topic == "block":
+                candidates = list(self.block_subscribers)
+            else:
+                candidates = list(self.unfiltered)
+                candidates.extend(self.by_address.get(address, ()))
+                candidates.extend(self.by_contract.get(contract_id, ()))
+            for subscriber in candidates:
+                if not subscriber.dropped and (topic == "block" or subscriber.matches(topic, address, contract_id)):
+                    self.deliver(subscriber, frame)
+
+    # Comment frames keep idle connections open through proxies and detect clients that left
+    async def run(self):
+        while True:
+            await asyncio.sleep(STREAM_KEEPALIVE_INTERVAL)
+            for subscriber in list(self.subscribers):
+                self.deliver(subscriber, b": keepalive\n\n")
+
+    def stats(self):
+        return {
+            "subscribers": len(self.subscribers),
+            "events": self.events,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+        }
+
+
+class ChangeWatcher:
+    # PRAGMA data_version changes whenever another connection commits, so polling it
+    # tells us about new blocks (and content/contract passes) without reading any table.
+    # The indexers add stream_events rows in the same commits, which are read from the
+    # databases that changed and handed to the event stream
+    def __init__(self, cache, stream):
+        self.cache = cache
+        self.stream = stream
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="change-watcher")
+        self.connections = {}
+        self.versions = {}
+        self.event_ids = {}
+        self.backlogged = set()
+        self.tip_hash = None
+
+    # Events added since the last read. The first read only notes where the table ends, so
+    # events from before the API started are not sent
+    def read_events(self, name, conn):
+        try:
+            if name not in self.event_ids:
+                self.event_ids[name] = conn.execute("SELECT COALESCE(MAX(id), 0) FROM stream_events").fetchone()[0]
+                return []
+            rows = conn.execute("""
+                SELECT id, topic, address, contract_id, data FROM stream_events WHERE id > ? ORDER BY id LIMIT ?
+            """, (self.event_ids[name], STREAM_READ_BATCH)).fetchall()
+        except sqlite3.OperationalError:
+            # Written by an indexer from before the stream existed
+            return []
+        if rows:
+            self.event_ids[name] = rows[-1][0]
+        return [row[1:] for row in rows]
+
+    def poll(self):
+        changed = False
+        events = []
+        for name, path in DATABASES.items():
+            if name in UNCACHED_DATABASES:
+                continue
+            conn = self.connections.get(name)
+            if conn is None:
+                try:
+                    conn = self.connections[name] = connect_readonly(path)
+                except sqlite3.OperationalError:
+                    continue
+            try:
+                version = conn.execute("PRAGMA data_version").fetchone()[0]
+            except sqlite3.OperationalError:
+                continue
+            if self.versions.get(name) != version:
+                self.versions[name] = version
+                changed = True
+                new_events = self.read_events(name, conn)
+            elif name in self.backlogged:
+                new_events = self.read_events(name, conn)
+            else:
+                continue
+            # A database with more than STREAM_READ_BATCH new events is read again on the next poll
+            if len(new_events) == STREAM_READ_BATCH:
+                self.backlogged.add(name)
+            else:
+                self.backlogged.discard(name)
+            events.extend(new_events)
+
+        if changed:
+            try:
+                row = self.connections["blocks"].execute("SELECT hash FROM blocks ORDER BY height DESC LIMIT 1").fetchone()
+                self.tip_hash = row[0] if row else None
+            except (KeyError, sqlite3.OperationalError):
+                self.tip_hash = None
+        return changed, events
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            changed, events = await loop.run_in_executor(self.executor, self.poll)
+            if changed:
+                self.cache.clear()
+                logger.info("Indexed data changed (tip %s), response cache cleared", self.tip_hash)
+            if events:
+                await self.stream.publish(events)
+            await asyncio.sleep(CHANGE_POLL_INTERVAL)
+
+
+def get_limit(params):
+    try:
+        limit = int(params.get("limit", DEFAULT_LIMIT))
+    except ValueError:
+        raise APIError(400, "limit must be an integer")
+    return max(1, min(limit, MAX_LIMIT))
+
+
+# Cursors are the seek key of the last row of a page, JSON-encoded and base64url'd
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, size):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise APIError(400, "invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise APIError(400, "invalid cursor")
+    return values
+
+
+# Keyset page ordered by key_columns, descending. The cursor resumes with a row-value
+# comparison on the same columns, which an index on them turns into a seek, so the cost
+# of a page does not depend on how deep it is
+def keyset_page(conn, table, columns, key_columns, params, where=None, args=()):
+    limit = get_limit(params)
+    query, args = keyset_query(table, columns, key_columns, params, where, args)
+    rows = conn.execute(query, args + [limit + 1]).fetchall()
+
+    return page(rows, limit, lambda row: [row[column] for column in key_columns])
+
+
+# The query for keyset_page, taking the row limit as its last parameter
+def keyset_query(table, columns, key_columns, params, where=None, args=()):
+    clauses = [where] if where else []
+    args = list(args)
+
+    cursor = params.get("cursor")
+    if cursor:
+        clauses.append(f"({', '.join(key_columns)}) < ({', '.join('?' * len(key_columns))})")
+        args.extend(decode_cursor(cursor, len(key_columns)))
+
+    query = f"SELECT {columns} FROM {table}"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY " + ", ".join(f"{column} DESC" for column in key_columns) + " LIMIT ?"
+    return query, args
+
+
+def page(rows, limit, cursor_key):
+    next_cursor = encode_cursor(cursor_key(rows[limit - 1])) if len(rows) > limit else None
+    return {"items": [dict(row) for row in rows[:limit]], "next_cursor": next_cursor}
+
+
+def fetch_one(conn, query, args, not_found):
+    row = conn.execute(query, args).fetchone()
+    if row is None:
+        raise APIError(404, not_found)
+    return dict(row)
+
+
+def transaction_to_dict(row):
+    tx = dict(row)
+    tx["vin"] = json.loads(tx["vin"]) if tx["vin"] else []
+    tx["vout"] = json.loads(tx["vout"]) if tx["vout"] else []
+    return tx
+
+
+def get_tip_height(conn):
+    return conn.execute("SELECT MAX(height) FROM blocks").fetchone()[0] or 0
+
+
+def get_status(pool, match, params):
+    conn = pool.connection("blocks")
+    row = conn.execute("SELECT height, hash FROM blocks ORDER BY height DESC LIMIT 1").fetchone()
+    return {"height": row["height"] if row else 0, "hash": row["hash"] if row else None}
+
+
+def list_blocks(pool, match, params):
+    conn = pool.connection("blocks")
+    return keyset_page(conn, "blocks_view", "*", ["height"], params)
+
+
+def get_block(pool, match, params):
+    conn = pool.connection("blocks")
+    block_id = match.group(1)
+    if block_id.isdigit():
+        block = fetch_one(conn, "SELECT * FROM blocks_view WHERE height = ? LIMIT 1", (int(block_id),), "block not found")
+    else:
+        block = fetch_one(conn, "SELECT * FROM blocks_view WHERE hash = ?", (block_id,), "block not found")
+
+    partition = conn.partitions.connection(block["height"])
+    rows = partition.execute("SELECT txid FROM transactions WHERE blockheight = ? ORDER BY txid", (block["height"],)).fetchall() if partition else []
+    block["tx"] = [row["txid"] for row in rows]
+    return block
+
+
+def get_days(params):
+    try:
+        return max(1, min(int(params.get("days", DEFAULT_DAYS)), MAX_DAYS))
+    except ValueError:
+        raise APIError(400, "days must be an integer")
+
+
+# The last ?days= days of a daily stats table, counted back from its latest day. The indexers
+# keep these tables up to date, so a chart reads one pre-aggregated row per day by primary key
+def daily_stats(conn, table, columns, params):
+    days = get_days(params)
+    row = conn.execute(f"SELECT MAX(day) AS last_day FROM {table}").fetchone()
+    if row["last_day"] is None:
+        return []
+    since = row["last_day"] - (days - 1) * SECONDS_PER_DAY
+    rows = conn.execute(f"SELECT day, {columns} FROM {table} WHERE day >= ? ORDER BY day", (since,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_blocks_per_day(pool, match, params):
+    return daily_stats(pool.connection("blocks"), "daily_block_stats", "blocks", params)
+
+
+def get_block_stats(pool, match, params):
+    return daily_stats(pool.connection("blocks"), "daily_block_stats",
+                       "blocks, transactions, size / blocks AS average_size, difficulty / blocks AS average_difficulty, fees", params)
+
+
+def get_inscription_stats(pool, match, params):
+    return daily_stats(pool.connection("content"), "daily_inscription_stats", "inscriptions", params)
+
+
+def get_token_stats(pool, match, params):
+    return daily_stats(pool.connection("contracts"), "daily_token_stats", "interactions, transfers, mints", params)
+
+
+# Transactions are spread over partition files by height, so a page is filled from the newest
+# partition down until it has enough rows. Each partition seeks to the cursor on its own index
+def list_transactions(pool, match, params):
+    conn = pool.connection("blocks")
+    limit = get_limit(params)
+    tip_height = get_tip_height(conn)
+    query, args = keyset_query("transactions", "txid, blockhash, blockheight, size, time", ["blockheight", "txid"], params, "blockheight <= ?", (tip_height,))
+
+    rows = []
+    for partition in conn.partitions.descending(tip_height):
+        rows.extend(partition.execute(query, args + [limit + 1 - len(rows)]).fetchall())
+        if len(rows) > limit:
+            break
+
+    result = page(rows, limit, lambda row: [row["blockheight"], row["txid"]])
+    for tx in result["items"]:
+        tx["confirmations"] = tip_height - tx["blockheight"] + 1
+    return result
+
+
+def get_transaction(pool, match, params):
+    conn = pool.connection("blocks")
+    row = conn.partitions.get_transaction(match.group(1))
+    if row is None:
+        raise APIError(404, "transaction not found")
+    tx = transaction_to_dict(row)
+    tx["confirmations"] = get_tip_height(conn) - tx["blockheight"] + 1
+    return tx
+
+
+def list_inscriptions(pool, match, params):
+    conn = pool.connection("content")
+    return keyset_page(conn, "inscriptions", "*", ["number"], params)
+
+
+def get_inscription(pool, match, params):
+    conn = pool.connection("content")
+    return fetch_one(conn, "SELECT * FROM inscriptions WHERE id = ?", (match.group(1),), "inscription not found")
+
+
+def get_address_balances(pool, match, params):
+    conn = pool.connection("contracts")
+    rows = conn.execute("SELECT * FROM token_balances WHERE address = ?", (match.group(1),)).fetchall()
+    return [dict(row) for row in rows]
+
+
+INTERACTION_COLUMNS = "transaction_id, address, contract_id, n, type, direction, value, interaction_time, blockheight"
+
+
+def list_address_interactions(pool, match, params):
+    conn = pool.connection("contracts")
+    return keyset_page(conn, "token_interactions", INTERACTION_COLUMNS, ["blockheight", "transaction_id", "contract_id"], params,
+                       "address = ?", (match.group(1),))
+
+
+def list_defi(pool, match, params):
+    conn = pool.connection("contracts")
+    rows = conn.execute("SELECT * FROM defi ORDER BY num_holders DESC, contract_id").fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_defi(pool, match, params):
+    conn = pool.connection("contracts")
+    return fetch_one(conn, "SELECT * FROM defi WHERE contract_id = ?", (match.group(1),), "token not found")
+
+
+def list_contract_interactions(pool, match, params):
+    conn = pool.connection("contracts")
+    return keyset_page(conn, "token_interactions", INTERACTION_COLUMNS, ["blockheight", "transaction_id", "address"], params,
+                       "contract_id = ?", (match.group(1),))
+
+
+def list_holders(pool, match, params):
+    conn = pool.connection("contracts")
+    limit = get_limit(params)
+    after = decode_cursor(params["cursor"], 2) if params.get("cursor") else None
+    rows = get_top_holders(conn, match.group(1), limit + 1, after)
+    return page(rows, limit, lambda row: [row["balance"], row["address"]])
+
+
+MEMPOOL_COLUMNS = "txid, size, fee, fee_rate, first_seen"
+
+
+def list_mempool(pool, match, params):
+    conn = pool.connection("mempool")
+    return keyset_page(conn, "mempool_transactions", MEMPOOL_COLUMNS, ["first_seen", "txid"], params)
+
+
+def get_mempool_transaction(pool, match, params):
+    conn = pool.connection("mempool")
+    txid = match.group(1)
+    row = conn.execute("SELECT * FROM mempool_transactions WHERE txid = ?", (txid,)).fetchone()
+    if row is None:
+        raise APIError(404, "transaction not in mempool")
+    tx = transaction_to_dict(row)
+
+    content = conn.execute("SELECT op_return, text, json, standard FROM mempool_content WHERE txid = ?", (txid,)).fetchone()
+    tx["content"] = dict(content) if content else None
+    rows = conn.execute("SELECT n, address, contract_id, type, value FROM mempool_interactions WHERE txid = ? ORDER BY n, address", (txid,)).fetchall()
+    tx["interactions"] = [dict(row) for row in rows]
+    return tx
+
+
+# Standard inscription payloads waiting to be mined
+def list_mempool_inscriptions(pool, match, params):
+    conn = pool.connection("mempool")
+    return keyset_page(conn, "mempool_transactions JOIN mempool_content USING (txid)", MEMPOOL_COLUMNS + ", text", ["first_seen", "txid"], params,
+                       "standard = 'Yes'")
+
+
+def list_mempool_address_interactions(pool, match, params):
+    conn = pool.connection("mempool")
+    return keyset_page(conn, "mempool_interactions", "txid, n, address, contract_id, type, value", ["txid", "n"], params,
+                       "address = ?", (match.group(1),))
+
+
+ROUTES = [
+    (re.compile(r"^/status$"), get_status),
+    (re.compile(r"^/blocks$"), list_blocks),
+    (re.compile(r"^/blocks/([0-9a-fA-F]+)$"), get_block),
+    (re.compile(r"^/stats/blocks-per-day$"), get_blocks_per_day),
+    (re.compile(r"^/stats/blocks$"), get_block_stats),
+    (re.compile(r"^/stats/inscriptions$"), get_inscription_stats),
+    (re.compile(r"^/stats/tokens$"), get_token_stats),
+    (re.compile(r"^/transactions$"), list_transactions),
+    (re.compile(r"^/tx/([0-9a-fA-F]{64})$"), get_transaction),
+    (re.compile(r"^/inscriptions$"), list_inscriptions),
+    (re.compile(r"^/inscriptions/([^/]+)$"), get_inscription),
+    (re.compile(r"^/address/([^/]+)/balances$"), get_address_balances),
+    (re.compile(r"^/address/([^/]+)/interactions$"), list_address_interactions),
+    (re.compile(r"^/defi$"), list_defi),
+    (re.compile(r"^/defi/([^/]+)$"), get_defi),
+    (re.compile(r"^/defi/([^/]+)/holders$"), list_holders),
+    (re.compile(r"^/defi/([^/]+)/interactions$"), list_contract_interactions),
+    (re.compile(r"^/mempool$"), list_mempool),
+    (re.compile(r"^/mempool/inscriptions$"), list_mempool_inscriptions),
+    (re.compile(r"^/mempool/tx/([0-9a-fA-F]{64})$"), get_mempool_transaction),
+    (re.compile(r"^/mempool/address/([^/]+)$"), list_mempool_address_interactions),
+]
+
+
+async def dispatch(pool, method, target):
+    if method != "GET":
+        raise APIError(405, "only GET is supported")
+
+    url = urlsplit(target)
+    path = unquote(url.path.rstrip("/")) or "/"
+    params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+    for pattern, handler in ROUTES:
+        match = pattern.match(path)
+        if match:
+            try:
+                return await pool.run(handler, match, params)
+            except sqlite3.OperationalError as e:
+                raise APIError(503, f"database error: {e}")
+    raise APIError(404, "no such endpoint")
+
+
+def encode_body(body):
+    return json.dumps(body, separators=(",", ":")).encode()
+
+
+async def respond(pool, cache, watcher, method, target, headers):
+    if method == "GET" and target == "/metrics":
+        return 200, encode_body({"cache": cache.stats(), "stream": watcher.stream.stats(), "tip_hash": watcher.tip_hash}), None
+
+    # Cached responses are only valid for the tip they were rendered at
+    key = (target, watcher.tip_hash)
+    cacheable = method == "GET" and not target.startswith(UNCACHED_PREFIX)
+    entry = cache.get(key) if cacheable else None
+    if entry is None:
+        generation = cache.invalidations
+        try:
+            payload = encode_body(await dispatch(pool, method, target))
+        except APIError as e:
+            return e.status, encode_body({"error": str(e)}), None
+        etag = f'"{hashlib.blake2b(payload, digest_size=12).hexdigest()}"'
+        # Drop results rendered from data that changed while the query was running
+        if cacheable and generation == cache.invalidations:
+            cache.put(key, etag, payload)
+    else:
+        etag, payload = entry
+
+    if headers.get("if-none-match") == etag:
+        return 304, b"", etag
+    return 200, payload, etag
+
+
+def render_response(status, payload, etag, keep_alive):
+    head = (
+        f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(payload)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+    )
+    if etag:
+        head += f"ETag: {etag}\r\nCache-Control: no-cache\r\n"
+    return (head + "\r\n").encode("latin-1") + payload
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+
+    parts = request_line.decode("latin-1").split()
+    if len(parts) != 3:
+        raise APIError(400, "malformed request line")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    # GET requests carry no body, but drain one if a client sends it anyway
+    try:
+        content_length = int(headers.get("content-length", 0) or 0)
+    except ValueError:
+        raise APIError(400, "malformed content-length")
+    if content_length < 0:
+        raise APIError(400, "malformed content-length")
+    if content_length:
+        await reader.readexactly(content_length)
+
+    return parts[0], parts[1], parts[2], headers
+
+
+def get_stream_filter(params):
+    topics = set(filter(None, params.get("topics", ",".join(STREAM_TOPICS)).split(",")))
+    unknown = topics - set(STREAM_TOPICS)
+    if unknown or not topics:
+        raise APIError(400, f"topics must be a comma-separated list of {', '.join(STREAM_TOPICS)}")
+    return topics, params.get("address"), params.get("contract_id")
+
+
+# Server-sent events until the client disconnects or falls too far behind. The response has no
+# length, so the connection is closed when the stream ends
+async def serve_stream(stream, target, writer):
+    params = {key: values[0] for key, values in parse_qs(urlsplit(target).query).items()}
+    try:
+        subscriber = stream.subscribe(*get_stream_filter(params), writer)
+    except APIError as e:
+        writer.write(render_response(e.status, encode_body({"error": str(e)}), None, False))
+        await writer.drain()
+        return
+
+    try:
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Connection: close\r\n"
+            b"\r\n"
+            b": connected\n\n"
+        )
+        await writer.drain()
+        while not subscriber.dropped:
+            writer.write(await subscriber.queue.get())
+            await writer.drain()
+    finally:
+        stream.unsubscribe(subscriber)
+
+
+async def handle_connection(pool, cache, watcher, reader, writer):
+    try:
+        while True:
+            try:
+                request = await read_request(reader)
+            except APIError as e:
+                writer.write(render_response(e.status, encode_body({"error": str(e)}), None, False))
+                break
+            if request is None:
+                break
+
+            method, target, version, headers = request
+            connection = headers.get("connection", "").lower()
+            keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+
+            if method == "GET" and urlsplit(target).path.rstrip("/") == "/stream":
+                await serve_stream(watcher.stream, target, writer)
+                break
+
+            try:
+                status, payload, etag = await respond(pool, cache, watcher, method, target, headers)
+            except Exception:
+                logger.exception("Error handling %s %s", method, target)
+                status, payload, etag = 500, encode_body({"error": "internal error"}), None
+
+            writer.write(render_response(status, payload, etag, keep_alive))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port, workers, cache_entries=CACHE_MAX_ENTRIES, cache_bytes=CACHE_MAX_BYTES):
+    pool = ReadPool(workers)
+    cache = ResponseCache(cache_entries, cache_bytes)
+    stream = EventStream()
+    watcher = ChangeWatcher(cache, stream)
+    watcher.poll()
+    watch_task = asyncio.create_task(watcher.run())
+    stream_task = asyncio.create_task(stream.run())
+
+    server = await asyncio.start_server(lambda reader, writer: handle_connection(pool, cache, watcher, reader, writer), host, port)
+    logger.info("Explorer API listening on http://%s:%d/", host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        watch_task.cancel()
+        stream_task.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read-only HTTP API over the explorer databases")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKER_THREADS)
+    parser.add_argument("--cache-entries", type=int, default=CACHE_MAX_ENTRIES)
+    parser.add_argument("--cache-bytes", type=int, default=CACHE_MAX_BYTES)
+    args = parser.parse_args()
+
+    asyncio.run(serve(args.host, args.port, args.workers, args.cache_entries, args.cache_bytes))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,24 @@
 import json
-import sqlite3
 import requests
 import time
-from datetime import datetime
+
+import profiling
+from db_utils import SECONDS_PER_DAY, add_column_if_missing, add_daily_stats, change_column_types, get_columns, create_stream_events_table, create_sync_state_table, epoch_sql, get_column_types, get_sync_state, publish_events, set_sync_state, utc_day
+from events import CONNECTED, DISCONNECTED, BlockEvent
+from partitions import PARTITION_BLOCKS, connect_blocks
+from prevouts import PrevoutCache
 
 # Replace the following values with your Novo node's RPC settings
 NODE_URL = "http://127.0.0.1:8332"
 RPC_USER = "NovoDockerUser"
 RPC_PASSWORD = "NovoDockerPassword"
 
+# Values of recently created outputs, used to work out fees as blocks are saved
+prevout_cache = PrevoutCache()
+
+# Totals per UTC day in daily_block_stats, kept up to date as blocks are saved and disconnected
+DAILY_BLOCK_STATS = ["blocks", "transactions", "size", "difficulty", "fees"]
+
 def rpc_request(method, params):
     headers = {"content-type": "text/plain"}
     rpc_data = {
@@ -22,19 +32,18 @@ def rpc_request(method, params):
     return response.json()["result"]
 
 def create_database():
-    conn = sqlite3.connect("novo_blocks.db")
+    conn = connect_blocks("novo_blocks.db")
     cursor = conn.cursor()
 
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS blocks (
             hash TEXT PRIMARY KEY,
-            confirmations INTEGER,
             size INTEGER,
             height INTEGER,
             version INTEGER,
             versionHex TEXT,
             merkleroot TEXT,
-            time TEXT,
+            time INTEGER,
             mediantime INTEGER,
             nonce INTEGER,
             bits TEXT,
@@ -46,27 +55,152 @@ def create_database():
         )
     """)
 
+    # Transactions used to be stored in novo_blocks.db itself. They now live in partition files
+    # (see partitions.py), and older databases have theirs moved across below
+    legacy_transactions = bool(get_columns(cursor, "transactions"))
+
+    # Times used to be saved as local-time strings, they are now integer UTC epoch seconds
+    if get_column_types(cursor, "blocks")["time"] == "TEXT":
+        migrate_times(conn, legacy_transactions)
+
+    # Confirmations are derived from the tip instead of being stored, where they went stale
+    # with every new block
+    for table in ("blocks", "transactions"):
+        if "confirmations" in get_columns(cursor, table):
+            cursor.execute(f"ALTER TABLE {table} DROP COLUMN confirmations")
+
+    # Fees in satoshis and fee rates in satoshis per byte, NULL where an input could not be resolved
+    if legacy_transactions:
+        add_column_if_missing(cursor, "transactions", "fee", "INTEGER")
+        add_column_if_missing(cursor, "transactions", "input_total", "INTEGER")
+        add_column_if_missing(cursor, "transactions", "fee_rate", "REAL")
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_blocks_height ON blocks (height)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_blocks_time ON blocks (time)")
+
+    # Outputs carrying a contractID, flagged at ingest so the contracts job never scans vout text
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS transactions (
-            hex TEXT,
-            txid TEXT PRIMARY KEY,
-            hash TEXT,
-            size INTEGER,
-            version INTEGER,
-            locktime INTEGER,
-            vin TEXT,
-            vout TEXT,
-            blockhash TEXT,
+        CREATE TABLE IF NOT EXISTS contract_outputs (
+            txid TEXT,
+            n INTEGER,
             blockheight INTEGER,
-            confirmations INTEGER,
-            time TEXT,
-            blocktime TEXT,
-            FOREIGN KEY(blockhash) REFERENCES blocks(hash)
+            output TEXT,
+            PRIMARY KEY (txid, n)
         )
     """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_contract_outputs_blockheight ON contract_outputs (blockheight)")
+
+    cursor.execute("""
+        CREATE VIEW IF NOT EXISTS blocks_view AS
+        SELECT blocks.*, (SELECT MAX(height) FROM blocks) - height + 1 AS confirmations
+        FROM blocks
+    """)
+
+    # Chart data, read by the API instead of aggregating blocks and transactions
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_block_stats (
+            day INTEGER PRIMARY KEY,
+            blocks INTEGER,
+            transactions INTEGER,
+            size INTEGER,
+            difficulty REAL,
+            fees INTEGER
+        )
+    """)
+
+    create_sync_state_table(cursor)
+    create_stream_events_table(cursor)
+    conn.commit()
+
+    if legacy_transactions:
+        partition_transactions(conn)
+
+    if get_sync_state(conn, "contract_outputs") is None:
+        backfill_contract_outputs(conn)
+
+    if get_sync_state(conn, "daily_block_stats") is None:
+        rebuild_daily_block_stats(conn)
 
     return conn
 
+
+def migrate_times(conn, transactions=True):
+    print("Converting block and transaction times to epoch seconds...")
+    cursor = conn.cursor()
+    change_column_types(cursor, "blocks", {"time": "INTEGER"}, {"time": epoch_sql("time")})
+    if transactions:
+        change_column_types(cursor, "transactions", {"time": "INTEGER", "blocktime": "INTEGER"}, {"time": epoch_sql("time"), "blocktime": epoch_sql("blocktime")})
+    conn.commit()
+
+
+# One-off move of the transactions table into partition files, one partition per commit so an
+# interrupted move picks up where it stopped
+def partition_transactions(conn):
+    print("Moving transactions into partition files...")
+    cursor = conn.cursor()
+    cursor.execute("SELECT MIN(blockheight), MAX(blockheight) FROM transactions")
+    low, high = cursor.fetchone()
+    if low is not None:
+        for start in range(low - low % PARTITION_BLOCKS, high + 1, PARTITION_BLOCKS):
+            partition = conn.partitions.connection(start, write=True)
+            columns = get_columns(partition.cursor(), "transactions")
+            rows = conn.execute(f"SELECT {', '.join(columns)} FROM transactions WHERE blockheight >= ? AND blockheight < ?", (start, start + PARTITION_BLOCKS))
+            partition.executemany(f"INSERT OR IGNORE INTO transactions ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", rows)
+            cursor.execute("""
+                INSERT OR IGNORE INTO tx_index (txid, blockheight)
+                SELECT txid, blockheight FROM transactions WHERE blockheight >= ? AND blockheight < ?
+            """, (start, start + PARTITION_BLOCKS))
+            conn.commit()
+            print(f"Moved transactions of blocks {start} to {min(start + PARTITION_BLOCKS - 1, high)}")
+    cursor.execute("DROP TABLE transactions")
+    conn.commit()
+    if high is not None:
+        conn.partitions.freeze(high)
+
+
+# One-off pass over blocks synced before contract_outputs existed
+def backfill_contract_outputs(conn):
+    cursor = conn.cursor()
+    for txid, vout, blockheight in conn.partitions.select_range("txid, vout, blockheight", 0):
+        if '"contractID":' in vout:
+            save_contract_outputs(cursor, txid, json.loads(vout), blockheight)
+
+    cursor.execute("SELECT height, hash FROM blocks ORDER BY height DESC LIMIT 1")
+    tip = cursor.fetchone() or (0, None)
+    set_sync_state(conn, "contract_outputs", tip[0], tip[1])
+    conn.commit()
+
+
+# Aggregate daily_block_stats from scratch, for blocks synced before the table existed
+def rebuild_daily_block_stats(conn):
+    cursor = conn.cursor()
+    # Transactions are counted per block in each partition, then joined to the blocks here
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS block_transactions (blockheight INTEGER PRIMARY KEY, transactions INTEGER, fees INTEGER)")
+    cursor.execute("DELETE FROM block_transactions")
+    for partition in conn.partitions.overlapping(-1):
+        cursor.executemany("INSERT INTO block_transactions VALUES (?, ?, ?)", partition.execute("""
+            SELECT blockheight, COUNT(*), SUM(fee) FROM transactions GROUP BY blockheight
+        """).fetchall())
+
+    cursor.execute("DELETE FROM daily_block_stats")
+    cursor.execute("""
+        INSERT INTO daily_block_stats (day, blocks, transactions, size, difficulty, fees)
+        SELECT b.time / ? * ? AS day, COUNT(*), COALESCE(SUM(t.transactions), 0), SUM(b.size), SUM(b.difficulty), COALESCE(SUM(t.fees), 0)
+        FROM blocks b
+        LEFT JOIN block_transactions t ON t.blockheight = b.height
+        GROUP BY day
+    """, (SECONDS_PER_DAY, SECONDS_PER_DAY))
+    cursor.execute("DROP TABLE block_transactions")
+    set_sync_state(conn, "daily_block_stats", 0, None)
+    conn.commit()
+
+
+def save_contract_outputs(cursor, txid, vout, blockheight):
+    cursor.executemany("""
+        INSERT OR IGNORE INTO contract_outputs (txid, n, blockheight, output)
+        VALUES (?, ?, ?, ?)
+    """, [(txid, entry.get("n"), blockheight, json.dumps(entry)) for entry in vout if "contractID" in entry])
+
 import json
 import sqlite3
 import requests
@@ -89,29 +223,42 @@ def rpc_request(method, params):
     print(response.json())
     return response.json()["result"]
 
-    # Convert the UNIX timestamps to datetime strings before saving them to the database
 def save_block_data(conn, block_data):
-    cursor = conn.cursor()
+    transactions = [rpc_request("getrawtransaction", [txid, True]) for txid in block_data["tx"]]
+    save_block(conn, block_data, transactions)
+    publish_events(conn.cursor(), [("block", None, None, {
+        "height": block_data["height"],
+        "hash": block_data["hash"],
+        "connected": True,
+        "time": block_data["time"],
+        "size": block_data["size"],
+        "transactions": len(transactions),
+        "previousblockhash": block_data.get("previousblockhash", "")
+    })])
+    conn.commit()
+    return transactions
 
-    # Convert UNIX timestamps to datetime strings
-    block_time = datetime.fromtimestamp(block_data["time"]).strftime('%Y-%m-%d %H:%M:%S')
 
-    # Save block data into the 'blocks' table
+# Write a block and its decoded transactions without committing, so bulk imports can batch commits
+def save_block(conn, block_data, transactions):
+    cursor = conn.cursor()
+
+    # Save block data into the 'blocks' table. Rows never change once written, so a block
+    # that is already saved is left alone rather than deleted and rewritten
     cursor.execute("""
-        INSERT OR REPLACE INTO blocks (
-            hash, confirmations, size, height, version, versionHex,
+        INSERT OR IGNORE INTO blocks (
+            hash, size, height, version, versionHex,
             merkleroot, time, mediantime, nonce, bits, difficulty,
             chainwork, previousblockhash, nextblockhash
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     """, (
         block_data["hash"],
-        block_data["confirmations"],
         block_data["size"],
         block_data["height"],
         block_data["version"],
         block_data["versionHex"],
         block_data["merkleroot"],
-        block_time,
+        block_data["time"],
         block_data["mediantime"],
         block_data["nonce"],
         block_data["bits"],
@@ -120,19 +267,22 @@ def save_block_data(conn, block_data):
         block_data.get("previousblockhash", ""),
         block_data.get("nextblockhash", "")
     ))
+    # Only blocks written for the first time count towards the daily stats
+    new_block = cursor.rowcount == 1
+    new_transactions = 0
+    fees = 0
 
-    # Save transaction data into the 'transactions' table
-    for txid in block_data["tx"]:
-        tx_data = rpc_request("getrawtransaction", [txid, True])
+    # Save transaction data into the 'transactions' table of the block's partition, and route
+    # its txid there through tx_index
+    partition = conn.partitions.connection(block_data["height"], write=True)
+    for tx_data in transactions:
+        tx_data["fee"], tx_data["input_total"], tx_data["fee_rate"] = prevout_cache.resolve(conn.partitions, tx_data)
 
-        # Convert UNIX timestamps to datetime strings
-        tx_time = datetime.fromtimestamp(tx_data["time"]).strftime('%Y-%m-%d %H:%M:%S')
-
-        cursor.execute("""
-            INSERT OR REPLACE INTO transactions (
+        partition.execute("""
+            INSERT OR IGNORE INTO transactions (
                 hex, txid, hash, size, version, locktime, vin, vout,
-                blockhash, blockheight,confirmations, time, blocktime
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                blockhash, blockheight, time, blocktime, fee, input_total, fee_rate
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """, (
             tx_data["hex"],
             tx_data["txid"],
@@ -144,13 +294,23 @@ def save_block_data(conn, block_data):
             json.dumps(tx_data["vout"]),
             block_data["hash"],
             block_data["height"],
-            tx_data["confirmations"],
-            tx_time,
-            block_time
+            tx_data["time"],
+            block_data["time"],
+            tx_data["fee"],
+            tx_data["input_total"],
+            tx_data["fee_rate"]
         ))
+        cursor.execute("INSERT OR IGNORE INTO tx_index (txid, blockheight) VALUES (?, ?)", (tx_data["txid"], block_data["height"]))
+        if cursor.rowcount == 1:
+            new_transactions += 1
+            fees += tx_data["fee"] or 0
 
-    conn.commit()
+        save_contract_outputs(cursor, tx_data["txid"], tx_data["vout"], block_data["height"])
 
+    if new_block:
+        add_daily_stats(cursor, "daily_block_stats", DAILY_BLOCK_STATS, {
+            utc_day(block_data["time"]): (1, new_transactions, block_data["size"], block_data["difficulty"], fees)
+        })
    
     # Get the last synced block height
 def get_last_synced_height(conn):
@@ -166,29 +326,107 @@ def update_last_synced_height(conn, block_data):
     conn.commit()
 
 
+# Remove a block that is no longer on the node's best chain
+def disconnect_block(conn, height):
+    cursor = conn.cursor()
+    cursor.execute("SELECT hash, time, size, difficulty FROM blocks WHERE height = ?", (height,))
+    result = cursor.fetchone()
+    # Only open the partition for writing when there is something to delete, so an empty range
+    # is not created and a frozen partition is not thawed for nothing
+    cursor.execute("SELECT 1 FROM tx_index WHERE blockheight = ? LIMIT 1", (height,))
+    partition = conn.partitions.connection(height, write=True) if cursor.fetchone() else None
+    if result:
+        transactions, fees = 0, 0
+        if partition is not None:
+            transactions, fees = partition.execute("SELECT COUNT(*), COALESCE(SUM(fee), 0) FROM transactions WHERE blockheight = ?", (height,)).fetchone()
+        add_daily_stats(cursor, "daily_block_stats", DAILY_BLOCK_STATS, {
+            utc_day(result[1]): (-1, -transactions, -result[2], -result[3], -fees)
+        })
+    cursor.execute("DELETE FROM contract_outputs WHERE blockheight = ?", (height,))
+    if partition is not None:
+        for txid, vout in partition.execute("SELECT txid, vout FROM transactions WHERE blockheight = ?", (height,)).fetchall():
+            prevout_cache.remove_outputs(txid, json.loads(vout))
+        partition.execute("DELETE FROM transactions WHERE blockheight = ?", (height,))
+    cursor.execute("DELETE FROM tx_index WHERE blockheight = ?", (height,))
+    cursor.execute("DELETE FROM blocks WHERE height = ?", (height,))
+    if result:
+        publish_events(cursor, [("block", None, None, {"height": height, "hash": result[0], "connected": False})])
+    conn.commit()
+    return result[0] if result else None
+
+
+# Walk back from our tip until our block hash matches the node's again
+def disconnect_stale_blocks(conn, block_count, bus=None):
+    height = get_last_synced_height(conn)
+    while height > 0:
+        cursor = conn.cursor()
+        cursor.execute("SELECT hash FROM blocks WHERE height = ?", (height,))
+        result = cursor.fetchone()
+        if result and height <= block_count and rpc_request("getblockhash", [height]) == result[0]:
+            break
+        block_hash = disconnect_block(conn, height)
+        print(f"Disconnected block {height} ({block_hash})")
+        if bus is not None:
+            bus.publish(BlockEvent(DISCONNECTED, height, block_hash, None, []))
+        height -= 1
+
+
+# Sync every block the node has that we don't, returning how many heights were processed.
+# When a bus is given every connected and disconnected block is published on it
+def sync_blocks(conn, bus=None):
+    block_count = rpc_request("getblockcount", [])
+    disconnect_stale_blocks(conn, block_count, bus)
+    last_synced_height = get_last_synced_height(conn)
+
+    if last_synced_height >= block_count:
+        return 0
+
+    print(f"Started syncing blocks from height {last_synced_height + 1} to {block_count}...")
+    started = time.perf_counter()
+    prevout_seconds = prevout_cache.seconds
+
+    # Blocks are saved in order and the next pass resumes above MAX(height), so a block that
+    # fails to save ends the pass and is retried on the next one rather than skipped
+    synced_height = last_synced_height
+    for block_height in range(last_synced_height + 1, block_count + 1):
+        block_hash = rpc_request("getblockhash", [block_height])
+        block_data = rpc_request("getblock", [block_hash])
+        try:
+            print(f"Saving block {block_height} of {block_count}")
+            transactions = save_block_data(conn, block_data)
+            update_last_synced_height(conn, block_data)
+        except KeyError as e:
+            print(f"Error saving block {block_height}: {e}. Block data: {block_data}")
+            conn.rollback()
+            break
+        except Exception as e:
+            print(f"Unknown error saving block {block_height}: {e}")
+            conn.rollback()
+            break
+        synced_height = block_height
+        if bus is not None:
+            bus.publish(BlockEvent(CONNECTED, block_height, block_hash, block_data, transactions))
+    conn.partitions.freeze(synced_height)
+    print("Sync completed." if synced_height == block_count else f"Sync stopped at height {synced_height}, retrying from there on the next pass.")
+    print_prevout_report(time.perf_counter() - started, prevout_cache.seconds - prevout_seconds)
+    return synced_height - last_synced_height
+
+
+def print_prevout_report(sync_seconds, prevout_seconds):
+    report = prevout_cache.report()
+    print(f"Prevouts: {report['prevout_hits']} cache hits, {report['prevout_misses']} database lookups "
+          f"({report['prevout_hit_ratio']:.1%} hit ratio), {report['prevout_unresolved']} unresolved, "
+          f"{prevout_seconds:.2f}s of {sync_seconds:.2f}s sync ({prevout_seconds / sync_seconds if sync_seconds else 0:.1%})")
+
+
 def main():
     conn = create_database()
+    profiling.install()
     
     while True:
-        block_count = rpc_request("getblockcount", [])
-        last_synced_height = get_last_synced_height(conn)
-
-        if last_synced_height < block_count:
-            print(f"Started syncing blocks from height {last_synced_height + 1} to {block_count}...")
-
-            for block_height in range(last_synced_height + 1, block_count + 1):
-                block_hash = rpc_request("getblockhash", [block_height])
-                block_data = rpc_request("getblock", [block_hash])
-                try:
-                    print(f"Saving block {block_height} of {block_count}")
-                    save_block_data(conn, block_data)
-                    update_last_synced_height(conn, block_data)
-                except KeyError as e:
-                    print(f"Error saving block {block_height}: {e}. Block data: {block_data}")
-                except Exception as e:
-                    print(f"Unknown error saving block {block_height}: {e}")
-            print("Sync completed.")
-        else:
+        with profiling.profile_pass("extract", conn, *conn.partitions.connections.values()):
+            synced = sync_blocks(conn)
+        if not synced:
             print("No new blocks found. Waiting for 60 seconds before checking again.")
             time.sleep(60)
 
@@ -1,10 +1,13 @@
 import sqlite3
 import json
 import binascii
-from datetime import datetime
 import time
 import logging
 
+import profiling
+from db_utils import SECONDS_PER_DAY, add_column_if_missing, add_daily_stats, change_column_types, create_stream_events_table, create_sync_state_table, enable_wal, epoch_sql, get_block_tip, get_column_types, get_sync_state, get_watermark, publish_events, save_watermark, set_sync_state, utc_day
+from partitions import connect_blocks
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -26,7 +29,8 @@ def rpc_request(method, params):
     return response.json()["result"]
 
 def create_content_database():
-    conn = sqlite3.connect("content.db")
+    conn = profiling.register(sqlite3.connect("content.db"))
+    enable_wal(conn)
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -38,10 +42,14 @@ def create_content_database():
             op_return TEXT,
             text TEXT,
             json TEXT,
-            standard TEXT
+            standard TEXT,
+            fee INTEGER
         )
     """)
 
+    # Fee of the transaction in satoshis, as resolved by extract.py
+    add_column_if_missing(cursor, "content", "fee", "INTEGER")
+
     # Add a unique constraint on the 'id' column
     cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_content_txid ON content (txid)")
     
@@ -55,7 +63,7 @@ def create_content_database():
             genesis_block_hash TEXT,
             genesis_tx_id TEXT,
             genesis_fee TEXT,
-            genesis_timestamp TEXT,
+            genesis_timestamp INTEGER,
             tx_id TEXT,
             chunk_txids TEXT,
             location TEXT,
@@ -74,8 +82,16 @@ def create_content_database():
         )
     """)
 
+    # Times used to be saved as formatted strings, they are now integer UTC epoch seconds
+    if get_column_types(cursor, "inscriptions")["genesis_timestamp"] == "TEXT":
+        migrate_times(conn)
+
     # Add a unique constraint on the 'id' column
     cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_inscriptions_id ON inscriptions (id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_inscriptions_number ON inscriptions (number)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_inscriptions_genesis_block_height ON inscriptions (genesis_block_height)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_inscriptions_timestamp ON inscriptions (timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_content_blockheight ON content (blockheight)")
     
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS transfers (
@@ -92,10 +108,45 @@ def create_content_database():
         )
     """)
 
+    # New inscriptions per UTC day, for charts
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_inscription_stats (
+            day INTEGER PRIMARY KEY,
+            inscriptions INTEGER
+        )
+    """)
+
+    create_sync_state_table(cursor)
+    create_stream_events_table(cursor)
+    conn.commit()
+
+    if get_sync_state(conn, "daily_inscription_stats") is None:
+        rebuild_daily_inscription_stats(conn)
+
     return conn
 
-def unix_to_datetime(unix_timestamp):
-    return datetime.utcfromtimestamp(int(unix_timestamp)).strftime('%Y-%m-%d %H:%M:%S')
+# Aggregate daily_inscription_stats from scratch, for inscriptions indexed before the table existed
+def rebuild_daily_inscription_stats(conn):
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM daily_inscription_stats")
+    cursor.execute("""
+        INSERT INTO daily_inscription_stats (day, inscriptions)
+        SELECT timestamp / ? * ? AS day, COUNT(*) FROM inscriptions WHERE timestamp IS NOT NULL GROUP BY day
+    """, (SECONDS_PER_DAY, SECONDS_PER_DAY))
+    set_sync_state(conn, "daily_inscription_stats", 0, None)
+    conn.commit()
+
+# content.time and inscriptions.timestamp held local-time strings copied from novo_blocks.db,
+# genesis_timestamp a UTC string
+def migrate_times(conn):
+    logger.info("Converting content and inscription times to epoch seconds")
+    cursor = conn.cursor()
+    cursor.execute(f"UPDATE content SET time = {epoch_sql('time')} WHERE typeof(time) = 'text'")
+    change_column_types(cursor, "inscriptions", {"genesis_timestamp": "INTEGER"}, {
+        "genesis_timestamp": epoch_sql("genesis_timestamp", local_time=False),
+        "timestamp": epoch_sql("timestamp"),
+    })
+    conn.commit()
 
 def extract_op_return_hex(vout):
     vout_json = json.loads(vout)
@@ -133,22 +184,24 @@ def is_standard_json(text):
     except json.JSONDecodeError:
         return "No"
         
-def get_transactions_with_any_content(conn):
-    cursor = conn.cursor()
-
-    query = "SELECT txid, vout, time, blockheight FROM transactions"
-    cursor.execute(query)
-    transactions = cursor.fetchall()
-
+# Return the content row for a transaction carrying an OP_RETURN, or None
+def classify_transaction(txid, vout, time, blockheight, fee):
+    op_return_hex = extract_op_return_hex(vout)
+    if not op_return_hex:
+        return None
+    text = hex_to_text(op_return_hex)
+    json_status = is_valid_json(text)
+    standard_status=is_standard_json(text)
+    return (txid, vout, time, blockheight, op_return_hex, text, json_status, standard_status, fee)
+
+
+# Only transactions in blocks above from_height are read, through the blockheight index
+def get_transactions_with_any_content(conn, from_height=0, to_height=None):
     filtered_transactions = []
-    for tx in transactions:
-        txid, vout, time, blockheight = tx
-        op_return_hex = extract_op_return_hex(vout)
-        if op_return_hex:
-            text = hex_to_text(op_return_hex)
-            json_status = is_valid_json(text)
-            standard_status=is_standard_json(text)
-            filtered_transactions.append((txid, vout, time, blockheight, op_return_hex, text, json_status, standard_status))
+    for txid, vout, time, blockheight, fee in conn.partitions.select_range("txid, vout, time, blockheight, fee", from_height, to_height):
+        tx = classify_transaction(txid, vout, time, blockheight, fee)
+        if tx:
+            filtered_transactions.append(tx)
 
     return filtered_transactions
 
@@ -157,12 +210,12 @@ def process_transactions(conn, transactions):
     cursor = conn.cursor()
 
     for tx in transactions:
-        txid, vout, time, blockheight, op_return_hex, text, json_status, standard_status = tx
+        txid, vout, time, blockheight, op_return_hex, text, json_status, standard_status, fee = tx
 
         cursor.execute("""
-            INSERT OR IGNORE INTO content (txid, vout, time, blockheight, op_return, text, json, standard)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (txid, vout, time, blockheight, op_return_hex, text, json_status, standard_status))
+            INSERT OR IGNORE INTO content (txid, vout, time, blockheight, op_return, text, json, standard, fee)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (txid, vout, time, blockheight, op_return_hex, text, json_status, standard_status, fee))
 
     conn.commit()
 
@@ -175,7 +228,7 @@ def extract_json_data(text):
         content_length = data.get("content_length", 0)
         content_type = data.get("content_type", "")
         genesis_address = data.get("genesis_address", "")
-        genesis_timestamp = unix_to_datetime(data.get("genesis_timestamp", ""))  # Conversion here
+        genesis_timestamp = int(data.get("genesis_timestamp", 0))
         genesis_fee=data.get("genesis_fee", 0)
         unique_identifier = data.get("unique_identifier", "")
         encrypted = data.get("encrypted", False)
@@ -184,21 +237,31 @@ def extract_json_data(text):
         whitelist = data.get("whitelist", [])
         return chunk_txids, mime_type, content_length, content_type, genesis_address, genesis_timestamp, genesis_fee, unique_identifier, encrypted, licence, max_claims, whitelist
     except json.JSONDecodeError:
-        return [], "", 0, "", "", "", 0, "", False, "", 0, []
+        return [], "", 0, "", "", 0, 0, "", False, "", 0, []
 
 
-def get_valid_json_entries(conn):
+# New inscriptions above from_height are numbered in chain order, on from the highest number
+# already assigned, so indexing block by block or a whole range gives the same numbers
+def get_valid_json_entries(conn, from_height=0):
     cursor = conn.cursor()
 
-    query = "SELECT txid, text, time, blockheight FROM content WHERE standard='Yes' ORDER BY time ASC"
-    cursor.execute(query)
+    cursor.execute("SELECT MAX(number) FROM inscriptions")
+    number = (cursor.fetchone()[0] or 0) + 1
+
+    query = "SELECT txid, text, time, blockheight, fee FROM content WHERE standard='Yes' AND blockheight > ? ORDER BY blockheight, time, txid"
+    cursor.execute(query, (from_height,))
     entries = cursor.fetchall()
 
     valid_entries = []
-    number = 1
     for entry in entries:
-        txid, text, time, blockheight = entry
+        txid, text, time, blockheight, fee = entry
+        cursor.execute("SELECT 1 FROM inscriptions WHERE id = ?", (txid,))
+        if cursor.fetchone():
+            continue
         chunk_txids, mime_type, content_length, content_type, genesis_address, genesis_timestamp, genesis_fee, unique_identifier, encrypted, licence, max_claims, whitelist = extract_json_data(text)
+        # The fee actually paid by the genesis transaction, the payload's own value when unknown
+        if fee is not None:
+            genesis_fee = fee
         if chunk_txids:
             valid_entries.append((number, txid, json.dumps(chunk_txids), mime_type, content_length, content_type, genesis_address, genesis_timestamp, genesis_fee, unique_identifier, encrypted, licence, max_claims, whitelist, blockheight, time))
             number += 1
@@ -207,6 +270,8 @@ def get_valid_json_entries(conn):
 
 def process_valid_json_entries(conn, valid_entries):
     cursor = conn.cursor()
+    daily_counts = {}
+    events = []
 
     for entry in valid_entries:
         number, txid, chunk_txids, mime_type, content_length, content_type, genesis_address, genesis_timestamp, genesis_fee, unique_identifier, encrypted, licence, max_claims, whitelist, blockheight, time = entry
@@ -215,28 +280,69 @@ def process_valid_json_entries(conn, valid_entries):
             INSERT OR IGNORE INTO inscriptions (number, id, address, genesis_tx_id, chunk_txids, mime_type, content_length, content_type, genesis_address, genesis_timestamp, genesis_fee, encrypted, licence, max_claims, whitelist, genesis_block_height, timestamp)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """, (number, txid , genesis_address, txid, chunk_txids, mime_type, content_length, content_type, genesis_address, genesis_timestamp, genesis_fee, encrypted, licence, max_claims, json.dumps(whitelist), blockheight, time))
-
+        if cursor.rowcount == 1:
+            day = utc_day(time)
+            daily_counts[day] = daily_counts.get(day, 0) + 1
+            events.append(("inscription", genesis_address, None, {
+                "number": number,
+                "id": txid,
+                "address": genesis_address,
+                "mime_type": mime_type,
+                "content_type": content_type,
+                "content_length": content_length,
+                "genesis_block_height": blockheight,
+                "timestamp": time
+            }))
+
+    add_daily_stats(cursor, "daily_inscription_stats", ["inscriptions"], {day: (count,) for day, count in daily_counts.items()})
+    publish_events(cursor, events)
     conn.commit()
 
 
-def main():
-    novo_blocks_conn = sqlite3.connect("novo_blocks.db")
-    conn = create_content_database()
+# Undo everything indexed from blocks at or above height
+def rollback_content(conn, height):
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT timestamp / ? * ? AS day, COUNT(*) FROM inscriptions WHERE genesis_block_height >= ? GROUP BY day
+    """, (SECONDS_PER_DAY, SECONDS_PER_DAY, height))
+    add_daily_stats(cursor, "daily_inscription_stats", ["inscriptions"], {day: (-count,) for day, count in cursor.fetchall()})
+    cursor.execute("DELETE FROM inscriptions WHERE genesis_block_height >= ?", (height,))
+    cursor.execute("DELETE FROM content WHERE blockheight >= ?", (height,))
+    logger.info("Rolled back content from height %d", height)
+
 
-    transactions = get_transactions_with_any_content(novo_blocks_conn)
+# Store the content of new transactions and number the inscriptions among them
+def index_content(conn, transactions, from_height):
     process_transactions(conn, transactions)
 
-    valid_entries = get_valid_json_entries(conn)
+    valid_entries = get_valid_json_entries(conn, from_height)
     process_valid_json_entries(conn, valid_entries)
 
+
+def main():
+    novo_blocks_conn = connect_blocks("novo_blocks.db", readonly=True)
+    conn = create_content_database()
+
+    # Only blocks above the watermark are read from novo_blocks.db
+    watermark = get_watermark(conn, novo_blocks_conn, "content", rollback_content)
+    tip_height, tip_hash = get_block_tip(novo_blocks_conn)
+    transactions = get_transactions_with_any_content(novo_blocks_conn, watermark, tip_height)
+    index_content(conn, transactions, watermark)
+
+    if tip_height > watermark:
+        save_watermark(conn, "content", tip_height, tip_hash)
+        conn.commit()
+
     conn.close()
     novo_blocks_conn.close()
 
 if __name__ == "__main__":
     update_interval = 60  # Update every minute
+    profiling.install()
     while True:
         try:
-            main()
+            with profiling.profile_pass("content"):
+                main()
             logger.info("Sleeping for %d seconds", update_interval)
             time.sleep(update_interval)
         except Exception as e:
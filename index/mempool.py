@@ -0,0 +1,207 @@
+import json
+import logging
+import sqlite3
+import time
+
+import requests
+
+import contracts
+import index_content
+from db_utils import enable_wal
+from partitions import connect_blocks
+from prevouts import PrevoutCache
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Replace the following values with your Novo node's RPC settings
+NODE_URL = "http://127.0.0.1:8332"
+RPC_USER = "NovoDockerUser"
+RPC_PASSWORD = "NovoDockerPassword"
+
+# How often the node's mempool is listed
+POLL_INTERVAL = 5
+# Transactions fetched per batched JSON-RPC request
+FETCH_BATCH_SIZE = 100
+# Unconfirmed transactions tracked at once. During a flood the rest wait until room frees up
+MAX_TRACKED_TRANSACTIONS = 50000
+# Outputs of tracked transactions kept for working out the fees of their children
+MEMPOOL_PREVOUT_CACHE_SIZE = 100000
+
+
+def rpc_request(method, params):
+    headers = {"content-type": "text/plain"}
+    rpc_data = {
+        "jsonrpc": "1.0",
+        "id": "curltest",
+        "method": method,
+        "params": params
+    }
+
+    response = requests.post(NODE_URL, headers=headers, data=json.dumps(rpc_data), auth=(RPC_USER, RPC_PASSWORD))
+    return response.json()["result"]
+
+
+# Send one call per params list in a single JSON-RPC batch. Calls that fail, such as a
+# transaction that left the mempool after it was listed, give None
+def rpc_batch(method, params_list):
+    headers = {"content-type": "text/plain"}
+    rpc_data = [
+        {"jsonrpc": "1.0", "id": i, "method": method, "params": params}
+        for i, params in enumerate(params_list)
+    ]
+
+    response = requests.post(NODE_URL, headers=headers, data=json.dumps(rpc_data), auth=(RPC_USER, RPC_PASSWORD))
+    results = [None] * len(params_list)
+    for reply in response.json():
+        if reply.get("error") is None:
+            results[reply["id"]] = reply["result"]
+    return results
+
+
+def create_mempool_database():
+    conn = sqlite3.connect("mempool.db")
+    enable_wal(conn)
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mempool_transactions (
+            txid TEXT PRIMARY KEY,
+            size INTEGER,
+            vin TEXT,
+            vout TEXT,
+            fee INTEGER,
+            fee_rate REAL,
+            first_seen INTEGER
+        )
+    """)
+
+    # OP_RETURN payloads, classified the same way as content.db
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mempool_content (
+            txid TEXT PRIMARY KEY,
+            op_return TEXT,
+            text TEXT,
+            json TEXT,
+            standard TEXT
+        )
+    """)
+
+    # Pending token transfers and mints, one row per contract output and address
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mempool_interactions (
+            txid TEXT,
+            n INTEGER,
+            address TEXT,
+            contract_id TEXT,
+            type TEXT,
+            value REAL,
+            PRIMARY KEY (txid, n, address)
+        )
+    """)
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_mempool_transactions_first_seen ON mempool_transactions (first_seen, txid)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_mempool_interactions_address ON mempool_interactions (address, txid, n)")
+    conn.commit()
+
+    return conn
+
+
+def save_mempool_transaction(cursor, tx_data, fee, fee_rate, first_seen):
+    vout = json.dumps(tx_data["vout"])
+    cursor.execute("""
+        INSERT OR IGNORE INTO mempool_transactions (txid, size, vin, vout, fee, fee_rate, first_seen)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (tx_data["txid"], tx_data["size"], json.dumps(tx_data["vin"]), vout, fee, fee_rate, first_seen))
+
+    content = index_content.classify_transaction(tx_data["txid"], vout, first_seen, None, fee)
+    if content:
+        txid, _, _, _, op_return_hex, text, json_status, standard_status, _ = content
+        cursor.execute("""
+            INSERT OR IGNORE INTO mempool_content (txid, op_return, text, json, standard)
+            VALUES (?, ?, ?, ?, ?)
+        """, (txid, op_return_hex, text, json_status, standard_status))
+
+    for entry in tx_data["vout"]:
+        if "contractID" in entry:
+            for interaction in contracts.contract_interactions(tx_data["txid"], entry, json.dumps(entry), first_seen, None):
+                cursor.execute("""
+                    INSERT OR IGNORE INTO mempool_interactions (txid, n, address, contract_id, type, value)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (interaction.transaction_id, interaction.n, interaction.address, interaction.contract_id, interaction.type, interaction.value))
+
+
+# Transactions leave the mempool when they are mined or evicted; either way they are dropped
+def expire_transactions(conn, txids):
+    cursor = conn.cursor()
+    rows = [(txid,) for txid in txids]
+    cursor.executemany("DELETE FROM mempool_interactions WHERE txid = ?", rows)
+    cursor.executemany("DELETE FROM mempool_content WHERE txid = ?", rows)
+    cursor.executemany("DELETE FROM mempool_transactions WHERE txid = ?", rows)
+    conn.commit()
+
+
+# Keeps mempool.db in step with the node's mempool. Each poll diffs the node's txids against
+# the ones already tracked, so only new transactions are fetched and classified
+class MempoolTracker:
+    def __init__(self, conn, novo_blocks_conn, max_tracked=MAX_TRACKED_TRANSACTIONS, batch_size=FETCH_BATCH_SIZE):
+        self.conn = conn
+        self.novo_blocks_conn = novo_blocks_conn
+        self.max_tracked = max_tracked
+        self.batch_size = batch_size
+        # Spent outputs are looked up here first, then in novo_blocks.db
+        self.prevouts = PrevoutCache(MEMPOOL_PREVOUT_CACHE_SIZE)
+        self.tracked = {row[0] for row in conn.execute("SELECT txid FROM mempool_transactions")}
+
+    def poll(self):
+        mempool = rpc_request("getrawmempool", [])
+        current = set(mempool)
+
+        gone = self.tracked - current
+        if gone:
+            expire_transactions(self.conn, gone)
+            self.tracked -= gone
+
+        new = [txid for txid in mempool if txid not in self.tracked]
+        room = self.max_tracked - len(self.tracked)
+        if len(new) > room:
+            logger.warning("Mempool holds %d untracked transactions, tracking %d of them", len(new), room)
+            new = new[:room]
+
+        for start in range(0, len(new), self.batch_size):
+            self.fetch(new[start:start + self.batch_size])
+
+        if gone or new:
+            logger.info("Mempool: %d transactions, %d new, %d left", len(self.tracked), len(new), len(gone))
+        return len(new), len(gone)
+
+    def fetch(self, txids):
+        cursor = self.conn.cursor()
+        first_seen = int(time.time())
+        saved = []
+        for tx_data in rpc_batch("getrawtransaction", [[txid, True] for txid in txids]):
+            if tx_data is None:
+                continue
+            fee, _, fee_rate = self.prevouts.resolve(self.novo_blocks_conn.partitions, tx_data)
+            save_mempool_transaction(cursor, tx_data, fee, fee_rate, first_seen)
+            saved.append(tx_data["txid"])
+        self.conn.commit()
+        self.tracked.update(saved)
+
+
+def main():
+    conn = create_mempool_database()
+    novo_blocks_conn = connect_blocks("novo_blocks.db", readonly=True)
+    tracker = MempoolTracker(conn, novo_blocks_conn)
+
+    while True:
+        try:
+            tracker.poll()
+        except Exception as e:
+            logger.error("Error polling the mempool: %s", e)
+            conn.rollback()
+        time.sleep(POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+import glob
+import os
+import sqlite3
+import stat
+
+import profiling
+from db_utils import enable_wal
+
+# Blocks per transactions partition file
+PARTITION_BLOCKS = 100000
+# A partition is frozen once the tip is this many blocks past its last height, far deeper than
+# any reorg the indexers roll back
+FREEZE_DEPTH = 1000
+
+TRANSACTIONS_TABLE = """
+    CREATE TABLE IF NOT EXISTS transactions (
+        hex TEXT,
+        txid TEXT PRIMARY KEY,
+        hash TEXT,
+        size INTEGER,
+        version INTEGER,
+        locktime INTEGER,
+        vin TEXT,
+        vout TEXT,
+        blockhash TEXT,
+        blockheight INTEGER,
+        time INTEGER,
+        blocktime INTEGER,
+        fee INTEGER,
+        input_total INTEGER,
+        fee_rate REAL
+    )
+"""
+
+
+def partition_path(directory, start_height):
+    return os.path.join(directory, f"novo_blocks_{start_height:08d}.db")
+
+
+def partition_files(directory):
+    return sorted(glob.glob(os.path.join(directory, "novo_blocks_" + "[0-9]" * 8 + ".db")))
+
+
+# The router tables in novo_blocks.db: the height range of every partition file, and which
+# partition (by height) holds each txid
+def create_router_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS partitions (
+            start_height INTEGER PRIMARY KEY,
+            end_height INTEGER,
+            frozen INTEGER DEFAULT 0
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tx_index (
+            txid TEXT PRIMARY KEY,
+            blockheight INTEGER
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tx_index_blockheight ON tx_index (blockheight)")
+
+
+# Transactions live in one SQLite file per PARTITION_BLOCKS heights next to novo_blocks.db.
+# Old partitions are frozen: optimized and vacuumed once, made read-only and opened as
+# immutable. Only the newest partitions take writes
+class PartitionStore:
+    def __init__(self, conn, directory, readonly):
+        self.conn = conn
+        self.directory = directory
+        self.readonly = readonly
+        self.ranges = []
+        self.data_version = None
+        self.connections = {}
+        self.immutable = {}
+        self.load()
+
+    def load(self):
+        self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        self.ranges = self.conn.execute("SELECT start_height, end_height, frozen FROM partitions ORDER BY start_height").fetchall()
+
+    def find(self, height):
+        # Another connection committed to novo_blocks.db, a partition may have been frozen or thawed
+        if self.conn.execute("PRAGMA data_version").fetchone()[0] != self.data_version:
+            self.load()
+        for _ in range(2):
+            for start, end, frozen in self.ranges:
+                if start <= height <= end:
+                    return start, end, frozen
+            # The writer may have added a partition since we last looked
+            self.load()
+        return None
+
+    # Frozen partitions are opened as immutable. The writer opens the others read-write, so
+    # it reads back rows it has not committed yet
+    def open(self, start, immutable):
+        path = partition_path(self.directory, start)
+        if immutable:
+            conn = sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+        elif self.readonly:
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute("PRAGMA query_only = 1")
+        else:
+            conn = sqlite3.connect(path)
+            enable_wal(conn)
+            conn.execute(TRANSACTIONS_TABLE)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_blockheight ON transactions (blockheight, txid)")
+        conn.row_factory = self.conn.row_factory
+        profiling.register(conn)
+        self.connections[start] = conn
+        self.immutable[start] = immutable
+        return conn
+
+    # The partition holding height, or None. With write=True the partition is created, or
+    # thawed if a reorg reaches back into a frozen one
+    def connection(self, height, write=False):
+        found = self.find(height)
+        if found is None:
+            if not write:
+                return None
+            start = height - height % PARTITION_BLOCKS
+            self.conn.execute("INSERT INTO partitions (start_height, end_height) VALUES (?, ?)", (start, start + PARTITION_BLOCKS - 1))
+            self.load()
+            return self.open(start, False)
+
+        start, end, frozen = found
+        if write and frozen:
+            self.thaw(start)
+            frozen = 0
+        conn = self.connections.get(start)
+        # thaw makes the file writable before the writer touches it, while the frozen flag only
+        # changes when the writer commits. Stop trusting an immutable handle as soon as it is
+        if conn is not None and self.immutable[start] and os.stat(partition_path(self.directory, start)).st_mode & stat.S_IWUSR:
+            frozen = 0
+        # Reopen a partition that was frozen or thawed since it was opened
+        if conn is not None and self.immutable[start] != bool(frozen):
+            conn.close()
+            conn = None
+        if conn is None:
+            conn = self.open(start, bool(frozen))
+        return conn
+
+    # Partitions overlapping heights from_height (exclusive) to to_height, oldest first
+    def overlapping(self, from_height, to_height=None):
+        self.load()
+        for start, end, frozen in self.ranges:
+            if end > from_height and (to_height is None or start <= to_height):
+                yield self.connection(start)
+
+    # Partitions at or below height, newest first
+    def descending(self, height):
+        self.load()
+        for start, end, frozen in reversed(self.ranges):
+            if start <= height:
+                yield self.connection(start)
+
+    def get_transaction(self, txid, columns="*"):
+        row = self.conn.execute("SELECT blockheight FROM tx_index WHERE txid = ?", (txid,)).fetchone()
+        if row is None:
+            return None
+        partition = self.connection(row[0])
+        if partition is None:
+            return None
+        return partition.execute(f"SELECT {columns} FROM transactions WHERE txid = ?", (txid,)).fetchone()
+
+    # Rows of transactions in blocks above from_height, up to to_height, in chain order
+    def select_range(self, columns, from_height, to_height=None):
+        for partition in self.overlapping(from_height, to_height):
+            if to_height is None:
+                yield from partition.execute(f"SELECT {columns} FROM transactions WHERE blockheight > ? ORDER BY blockheight, txid", (from_height,))
+            else:
+                yield from partition.execute(f"SELECT {columns} FROM transactions WHERE blockheight > ? AND blockheight <= ? ORDER BY blockheight, txid", (from_height, to_height))
+
+    # Optimize and vacuum every partition that is FREEZE_DEPTH blocks behind the tip, then stop
+    # writing to it. It stays in WAL mode, since readers holding it open would block a switch
+    # back, but after a full checkpoint the main file holds every page and readers can open it
+    # as immutable, skipping locks and change checks
+    def freeze(self, tip_height):
+        for start, end, frozen in list(self.ranges):
+            if frozen or end + FREEZE_DEPTH > tip_height:
+                continue
+            conn = self.connection(start, write=True)
+            conn.commit()
+            conn.execute("ANALYZE")
+            conn.execute("VACUUM")
+            busy, _, _ = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            if busy:
+                # A reader is still on an older snapshot, try again after the next sync
+                continue
+            conn.close()
+            del self.connections[start]
+            del self.immutable[start]
+
+            path = partition_path(self.directory, start)
+            os.chmod(path, os.stat(path).st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+            self.conn.execute("UPDATE partitions SET frozen = 1 WHERE start_height = ?", (start,))
+            self.conn.commit()
+            self.load()
+            print(f"Froze transactions partition {start}-{end}")
+
+    # A reorg deeper than FREEZE_DEPTH makes a frozen partition writable again
+    def thaw(self, start):
+        path = partition_path(self.directory, start)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IWUSR)
+        self.conn.execute("UPDATE partitions SET frozen = 0 WHERE start_height = ?", (start,))
+        self.load()
+
+    def commit(self):
+        if not self.readonly:
+            for conn in self.connections.values():
+                conn.commit()
+
+    def rollback(self):
+        if not self.readonly:
+            for conn in self.connections.values():
+                conn.rollback()
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections.clear()
+        self.immutable.clear()
+
+
+# A novo_blocks.db connection carrying its partition store. Partitions are committed before
+# novo_blocks.db, so a block and its tx_index rows are never visible before the rows they route to
+class BlocksConnection(sqlite3.Connection):
+    partitions = None
+
+    def commit(self):
+        if self.partitions is not None:
+            self.partitions.commit()
+        super().commit()
+
+    def rollback(self):
+        if self.partitions is not None:
+            self.partitions.rollback()
+        super().rollback()
+        # Forget partitions added in the rolled back transaction
+        if self.partitions is not None:
+            self.partitions.load()
+
+    def close(self):
+        if self.partitions is not None:
+            self.partitions.close()
+        super().close()
+
+
+def connect_blocks(path="novo_blocks.db", readonly=False):
+    if readonly:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False, factory=BlocksConnection)
+        profiling.register(conn)
+        conn.execute("PRAGMA query_only = 1")
+    else:
+        conn = sqlite3.connect(path, factory=BlocksConnection)
+        profiling.register(conn)
+        enable_wal(conn)
+        create_router_tables(conn.cursor())
+        conn.commit()
+    conn.partitions = PartitionStore(conn, os.path.dirname(os.path.abspath(path)), readonly)
+    return conn
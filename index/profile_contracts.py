@@ -0,0 +1,145 @@
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import random
+import tempfile
+import time
+
+import contracts
+from extract import create_database, save_contract_outputs
+
+
+# Profile the contracts extraction and insert pass on a synthetic corpus of contract outputs
+def build_corpus(conn, num_blocks, txs_per_block, num_contracts, num_addresses):
+    cursor = conn.cursor()
+    rng = random.Random(42)
+    contract_ids = [f"{rng.getrandbits(256):064x}:0" for _ in range(num_contracts)]
+    addresses = [f"N{rng.getrandbits(160):040x}" for _ in range(num_addresses)]
+
+    for height in range(1, num_blocks + 1):
+        block_hash = f"{height:064x}"
+        cursor.execute("INSERT INTO blocks (hash, height, time) VALUES (?, ?, ?)", (block_hash, height, 1690000000 + height * 60))
+        for i in range(txs_per_block):
+            txid = f"{height:032x}{i:032x}"
+            contract_id = rng.choice(contract_ids)
+            metadata = json.dumps({"name": contract_id[:8], "symbol": contract_id[:4], "decimal": 8, "icon": "", "genesis_price": 0, "limit_mint": 1000, "limit_wallet": 100000})
+            contract_type = rng.choice(["FT_MINT", "FT", "FT", "NFT"])
+            vout = []
+            for n in range(2):
+                vout.append({
+                    "value": 0.0,
+                    "n": n,
+                    "scriptPubKey": {"asm": "", "hex": "", "type": "pubkeyhash", "addresses": [rng.choice(addresses)]},
+                    "contractID": contract_id,
+                    "contractType": contract_type if n == 0 else "FT",
+                    "contractValue": rng.randint(1, 10000),
+                    "contractMaxSupply": 21000000,
+                    "contractMetadata": metadata,
+                })
+            save_contract_outputs(cursor, txid, vout, height)
+
+    conn.commit()
+    return num_blocks
+
+
+# The pass as it was before each contract output was parsed once, kept so --baseline can
+# profile it on the same corpus: the output is parsed to find its addresses, then six more
+# times and once for its metadata per interaction, and every row is inserted on its own
+def baseline_extract(conn_novo_blocks, from_height, to_height):
+    cursor_novo_blocks = conn_novo_blocks.cursor()
+    cursor_novo_blocks.execute("""
+        SELECT c.txid, c.output, b.time, c.blockheight
+        FROM contract_outputs c
+        JOIN blocks b ON b.height = c.blockheight
+        WHERE c.blockheight > ? AND c.blockheight <= ?
+        ORDER BY c.blockheight, c.txid, c.n
+    """, (from_height, to_height))
+
+    transactions = []
+    addresses = set()
+    for txid, transaction_data, interaction_time, blockheight in cursor_novo_blocks.fetchall():
+        entry = json.loads(transaction_data)
+        address_list = entry.get('scriptPubKey', {}).get('addresses', [])
+        transactions.extend([(txid, address, transaction_data, interaction_time, blockheight) for address in address_list])
+        addresses.update(address_list)
+
+    return transactions, addresses
+
+
+def baseline_process(conn, transactions):
+    cursor = conn.cursor()
+    for txid, address, transaction_data, interaction_time, blockheight in transactions:
+        contract_id = json.loads(transaction_data).get('contractID', None)
+        max_supply = json.loads(transaction_data).get('contractMaxSupply', None)
+        n = json.loads(transaction_data).get('n', None)
+        contract_type = json.loads(transaction_data).get('contractType', None)
+        value = json.loads(transaction_data).get('contractValue', None)
+        token_name = token_symbol = token_decimals = token_icon = genesis_price = limit_mint = limit_wallet = None
+
+        try:
+            metadata = json.loads(json.loads(transaction_data).get('contractMetadata', ''))
+            if isinstance(metadata, dict):
+                token_name = metadata.get('name', None)
+                token_symbol = metadata.get('symbol', None)
+                token_decimals = metadata.get('decimal', None)
+                token_icon = metadata.get('icon', None)
+                genesis_price = metadata.get('genesis_price', None)
+                limit_mint = metadata.get('limit_mint', None)
+                limit_wallet = metadata.get('limit_wallet', None)
+        except (json.JSONDecodeError, TypeError):
+            pass
+
+        cursor.execute("""
+            INSERT OR IGNORE INTO token_interactions (transaction_id, address, contract_id, transaction_data, max_supply, token_name, token_symbol, interaction_time, n, type, value, token_decimals,  token_icon, genesis_price, limit_mint, limit_wallet, direction, blockheight)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (txid, address, contract_id, transaction_data, max_supply, token_name, token_symbol, interaction_time, n, contracts.CONTRACT_TYPES.get(contract_type), value, token_decimals, token_icon, genesis_price, limit_mint, limit_wallet, None, blockheight))
+
+    conn.commit()
+
+
+def current_pass(novo_blocks_conn, contracts_conn, tip_height):
+    transactions, spends, addresses = contracts.get_transactions_with_any_contract_id(novo_blocks_conn, 0, tip_height)
+    contracts.process_transactions(contracts_conn, transactions)
+
+
+def baseline_pass(novo_blocks_conn, contracts_conn, tip_height):
+    transactions, addresses = baseline_extract(novo_blocks_conn, 0, tip_height)
+    baseline_process(contracts_conn, transactions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile the contracts extraction and insert pass on a synthetic corpus")
+    parser.add_argument("--blocks", type=int, default=2000)
+    parser.add_argument("--txs-per-block", type=int, default=25)
+    parser.add_argument("--contracts", type=int, default=50)
+    parser.add_argument("--addresses", type=int, default=5000)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--baseline", action="store_true", help="profile the pass as it was before each output was parsed once")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="profile_contracts_")
+    os.chdir(workdir)
+
+    novo_blocks_conn = create_database()
+    tip_height = build_corpus(novo_blocks_conn, args.blocks, args.txs_per_block, args.contracts, args.addresses)
+    contracts_conn = contracts.create_contracts_database()
+
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    (baseline_pass if args.baseline else current_pass)(novo_blocks_conn, contracts_conn, tip_height)
+    profiler.disable()
+    elapsed = time.perf_counter() - start
+
+    count = contracts_conn.execute("SELECT COUNT(*) FROM token_interactions").fetchone()[0]
+    print(f"{'baseline' if args.baseline else 'current'} pass: {count} interactions from {tip_height} blocks in {elapsed:.2f}s ({count / elapsed:.0f} interactions/s)")
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(args.top)
+
+    contracts_conn.close()
+    novo_blocks_conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import signal
+import sqlite3
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Send this signal to a running indexer, or create CONTROL_FILE in its working directory, to
+# profile its next pass. Reports are written to REPORT_DIR
+PROFILE_SIGNAL = getattr(signal, "SIGUSR1", None)
+CONTROL_FILE = "profile.request"
+REPORT_DIR = "profiles"
+
+# Rows in each section of a report
+TOP_FUNCTIONS = 40
+TOP_STATEMENTS = 40
+TOP_ALLOCATIONS = 25
+
+# SQLite calls the progress handler every this many virtual machine instructions
+PROGRESS_STEPS = 1000
+
+_requested = False
+_session = None
+
+
+def _request(signum, frame):
+    global _requested
+    _requested = True
+
+
+def install():
+    if PROFILE_SIGNAL is not None:
+        signal.signal(PROFILE_SIGNAL, _request)
+
+
+# A request is used up by the pass it profiles
+def take_request():
+    global _requested
+    requested, _requested = _requested, False
+    if os.path.exists(CONTROL_FILE):
+        os.remove(CONTROL_FILE)
+        requested = True
+    return requested
+
+
+# Connections opened while a pass is profiled call this to have their statements timed.
+# Outside a profiled pass it does nothing
+def register(conn):
+    if _session is not None:
+        _session.statements.attach(conn)
+    return conn
+
+
+# Statement text with literals replaced by ?, so executions with different values add up
+def normalize_sql(sql):
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b[xX]\?", "?", sql)
+    sql = re.sub(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b", "?", sql)
+    return " ".join(sql.split())
+
+
+# Times statements through the sqlite3 trace callback, which fires as each statement starts.
+# A statement is charged the time until the next traced statement starts, so the time spent
+# iterating its rows counts towards it. The progress handler counts the VM instructions
+# SQLite itself ran for it, which does not depend on what Python did in between
+class StatementTimer:
+    def __init__(self):
+        self.statements = {}
+        self.connections = []
+        self.current = None
+        self.started = None
+
+    def attach(self, conn):
+        current = [None]
+
+        def trace(sql):
+            current[0] = self.start(sql)
+
+        def progress():
+            if current[0] is not None:
+                current[0][2] += PROGRESS_STEPS
+            return 0
+
+        conn.set_trace_callback(trace)
+        conn.set_progress_handler(progress, PROGRESS_STEPS)
+        self.connections.append(conn)
+
+    def start(self, sql):
+        now = time.perf_counter()
+        self.finish(now)
+        entry = self.statements.setdefault(normalize_sql(sql), [0, 0.0, 0])
+        entry[0] += 1
+        self.current, self.started = entry, now
+        return entry
+
+    def finish(self, now):
+        if self.current is not None:
+            self.current[1] += now - self.started
+            self.current = None
+
+    def detach(self):
+        self.finish(time.perf_counter())
+        for conn in self.connections:
+            try:
+                conn.set_trace_callback(None)
+                conn.set_progress_handler(None, 0)
+            except sqlite3.ProgrammingError:
+                # Closed during the pass
+                pass
+        self.connections = []
+
+
+class PassProfile:
+    def __init__(self, name):
+        self.name = name
+        self.profiler = cProfile.Profile()
+        self.statements = StatementTimer()
+        self.started_tracemalloc = False
+
+    def start(self, connections):
+        for conn in connections:
+            self.statements.attach(conn)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        tracemalloc.reset_peak()
+        self.memory_before = tracemalloc.take_snapshot()
+        self.started = time.perf_counter()
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        self.seconds = time.perf_counter() - self.started
+        self.statements.detach()
+        self.memory_after = tracemalloc.take_snapshot()
+        self.memory_peak = tracemalloc.get_traced_memory()[1]
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+
+    # Write <name>-<time>.txt with the summary, and <name>-<time>.prof for pstats or snakeviz
+    def write_report(self, directory=REPORT_DIR):
+        os.makedirs(directory, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        path = os.path.join(directory, f"{self.name}-{stamp}")
+        self.profiler.dump_stats(path + ".prof")
+
+        with open(path + ".txt", "w") as f:
+            f.write(f"{self.name} pass profiled at {stamp}: {self.seconds:.3f}s, "
+                    f"peak traced memory {self.memory_peak / 1e6:.1f} MB\n\n")
+
+            f.write(f"SQL statements by time until the next statement (top {TOP_STATEMENTS})\n")
+            f.write("Seconds include whatever ran before the next statement, such as node RPC calls after a COMMIT. "
+                    "vm_steps counts only the work SQLite itself did\n")
+            f.write(f"{'count':>9} {'seconds':>10} {'vm_steps':>12}  statement\n")
+            statements = sorted(self.statements.statements.items(), key=lambda item: item[1][1], reverse=True)
+            for sql, (count, seconds, steps) in statements[:TOP_STATEMENTS]:
+                f.write(f"{count:>9} {seconds:>10.3f} {steps:>12}  {sql}\n")
+
+            f.write(f"\nMemory allocated during the pass and still held at its end (top {TOP_ALLOCATIONS})\n")
+            for stat in self.memory_after.compare_to(self.memory_before, "lineno")[:TOP_ALLOCATIONS]:
+                f.write(f"{stat}\n")
+
+            f.write(f"\nFunctions by cumulative time (top {TOP_FUNCTIONS})\n")
+            stream = io.StringIO()
+            pstats.Stats(self.profiler, stream=stream).sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+            f.write(stream.getvalue())
+        return path + ".txt"
+
+
+# Wrap one pass of an indexer loop. Unless profiling was requested this only checks for the
+# control file. Connections opened before the pass are passed in, the ones opened during it
+# register themselves
+@contextmanager
+def profile_pass(name, *connections):
+    global _session
+    if not take_request():
+        yield
+        return
+
+    print(f"Profiling this {name} pass")
+    _session = PassProfile(name)
+    _session.start(connections)
+    try:
+        yield
+    finally:
+        session, _session = _session, None
+        session.stop()
+        print(f"Profile of the {name} pass written to {session.write_report()}")
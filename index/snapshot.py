@@ -0,0 +1,286 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import time
+
+from partitions import partition_files, partition_path
+
+# Copied in this order. The stages only index blocks novo_blocks.db already holds, so copying
+# novo_blocks.db after them means every stage watermark in a snapshot is at or below its tip.
+# The transactions partition files it routes to are copied after it
+DATABASES = ["content.db", "contracts.db", "novo_blocks.db"]
+
+# The watermark each database resumes from, checked against the blocks in the snapshot
+STAGE_WATERMARKS = {"content.db": "content", "contracts.db": "contracts"}
+
+MANIFEST_NAME = "manifest.json"
+SNAPSHOT_FORMAT = 1
+
+# A reorg between copying a stage and novo_blocks.db can leave its watermark on a stale block
+EXPORT_ATTEMPTS = 3
+
+COMPRESS_LEVEL = 6
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_sync_state(conn):
+    try:
+        return {name: [height, block_hash] for name, height, block_hash in conn.execute("SELECT name, height, hash FROM sync_state")}
+    except sqlite3.OperationalError:
+        return {}
+
+
+# VACUUM INTO runs inside one read transaction, so each copy is a consistent, compacted
+# image of its database even while the indexers keep committing. PRAGMA query_only would
+# refuse it, so the source is opened read-only by URI alone
+def copy_database(source, target):
+    conn = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+    try:
+        conn.execute("VACUUM INTO ?", (target,))
+    finally:
+        conn.close()
+
+
+# Copy the partition files novo_blocks.db routes to. The extractor commits transactions before
+# the blocks holding them, so every txid in the copied tx_index is in a partition copied after
+# it. Rows of blocks saved since are trimmed. Returns None if the copies still disagree, which
+# a reorg between the copies can cause
+def copy_partitions(data_dir, work_dir, blocks_conn, tip_height):
+    names = [os.path.basename(partition_path(data_dir, start)) for (start,) in blocks_conn.execute("SELECT start_height FROM partitions ORDER BY start_height")]
+    indexed = blocks_conn.execute("SELECT COUNT(*) FROM tx_index").fetchone()[0]
+    stored = routed = 0
+    for name in names:
+        path = os.path.join(work_dir, name)
+        copy_database(os.path.join(data_dir, name), path)
+        conn = sqlite3.connect(path)
+        conn.execute("DELETE FROM transactions WHERE blockheight > ?", (tip_height,))
+        conn.commit()
+        conn.close()
+
+        blocks_conn.execute("ATTACH DATABASE ? AS partition", (path,))
+        stored += blocks_conn.execute("SELECT COUNT(*) FROM partition.transactions").fetchone()[0]
+        routed += blocks_conn.execute("""
+            SELECT COUNT(*) FROM partition.transactions p
+            JOIN tx_index t ON t.txid = p.txid AND t.blockheight = p.blockheight
+        """).fetchone()[0]
+        blocks_conn.execute("DETACH DATABASE partition")
+
+    if stored != indexed or routed != indexed:
+        print(f"Copied partitions hold {stored} transactions, {routed} of the {indexed} in the copied tx_index")
+        return None
+    return names
+
+
+# Copy every database into work_dir and describe the copies. Returns None if a stage watermark
+# points at a block that is not in the copied novo_blocks.db, or the partitions do not match it
+def copy_databases(data_dir, work_dir, names):
+    for name in names:
+        copy_database(os.path.join(data_dir, name), os.path.join(work_dir, name))
+
+    blocks_conn = sqlite3.connect(os.path.join(work_dir, "novo_blocks.db"))
+    row = blocks_conn.execute("SELECT height, hash FROM blocks ORDER BY height DESC LIMIT 1").fetchone()
+    tip_height, tip_hash = row or (0, None)
+
+    partitions = copy_partitions(data_dir, work_dir, blocks_conn, tip_height)
+    if partitions is None:
+        blocks_conn.close()
+        return None
+
+    databases = {}
+    for name in names + partitions:
+        path = os.path.join(work_dir, name)
+        conn = sqlite3.connect(path)
+        sync_state = read_sync_state(conn)
+        conn.close()
+
+        stage = STAGE_WATERMARKS.get(name)
+        if stage in sync_state:
+            height, block_hash = sync_state[stage]
+            if not blocks_conn.execute("SELECT 1 FROM blocks WHERE height = ? AND hash = ?", (height, block_hash)).fetchone():
+                print(f"{name} watermark {height} ({block_hash}) is not in the copied novo_blocks.db")
+                blocks_conn.close()
+                return None
+
+        databases[name] = {"size": os.path.getsize(path), "sha256": file_sha256(path), "sync_state": sync_state}
+    blocks_conn.close()
+
+    return {
+        "format": SNAPSHOT_FORMAT,
+        "created": int(time.time()),
+        "tip": {"height": tip_height, "hash": tip_hash},
+        "databases": databases,
+    }
+
+
+def export_snapshot(data_dir, output=None, compress_level=COMPRESS_LEVEL):
+    started = time.perf_counter()
+    # contracts.db is optional, the other databases are not
+    names = [name for name in DATABASES if name != "contracts.db" or os.path.exists(os.path.join(data_dir, name))]
+    work_dir = tempfile.mkdtemp(prefix="snapshot-", dir=os.path.dirname(os.path.abspath(output)) if output else data_dir)
+    try:
+        for _ in range(EXPORT_ATTEMPTS):
+            manifest = copy_databases(data_dir, work_dir, names)
+            if manifest is not None:
+                break
+            for name in os.listdir(work_dir):
+                os.remove(os.path.join(work_dir, name))
+        else:
+            raise RuntimeError(f"No consistent copy after {EXPORT_ATTEMPTS} attempts")
+        copied = time.perf_counter()
+
+        tip = manifest["tip"]
+        if output is None:
+            output = os.path.join(data_dir, f"snapshot-{tip['height']}-{(tip['hash'] or '')[:16]}.tar.gz")
+
+        # The manifest goes first so an import can check it before unpacking the databases
+        with tarfile.open(output, "w:gz", compresslevel=compress_level) as tar:
+            data = json.dumps(manifest, indent=2).encode()
+            info = tarfile.TarInfo(MANIFEST_NAME)
+            info.size = len(data)
+            info.mtime = manifest["created"]
+            tar.addfile(info, io.BytesIO(data))
+            for name in manifest["databases"]:
+                tar.add(os.path.join(work_dir, name), arcname=name)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    finished = time.perf_counter()
+    size = sum(database["size"] for database in manifest["databases"].values())
+    print(f"Snapshot of height {tip['height']} ({tip['hash']}) written to {output}")
+    print(f"{size / 1e6:.1f} MB of databases compressed to {os.path.getsize(output) / 1e6:.1f} MB "
+          f"(copy {copied - started:.1f}s, compress {finished - copied:.1f}s)")
+    return manifest
+
+
+def unpack_database(tar, member, path, expected):
+    digest = hashlib.sha256()
+    source = tar.extractfile(member)
+    with open(path, "wb") as f:
+        for chunk in iter(lambda: source.read(READ_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            f.write(chunk)
+    if digest.hexdigest() != expected["sha256"]:
+        raise ValueError(f"{member.name} does not match the checksum in the manifest")
+
+
+def remove_database(path):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+# contracts.db lists the addresses contracts.py imported into the old node's wallet. A new node's
+# wallet has none of them unless it was copied too, so the list and the sync_state row saying it
+# is complete are cleared, and the next contracts pass imports every address again
+def forget_imported_addresses(path):
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("DELETE FROM imported_addresses")
+        conn.execute("DELETE FROM sync_state WHERE name = 'imported_addresses'")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# Unpack a snapshot into data_dir. Every database is unpacked and checked before any existing
+# file is replaced, and existing databases are only replaced when force is set. Partition files
+# the snapshot does not have would be picked up by the new novo_blocks.db, so they are removed
+# Manifest names become file names in data_dir, so only the databases and partition files a
+# snapshot can hold are accepted; anything else could write outside the data directory
+def is_database_name(name):
+    return os.path.basename(name) == name and (name in DATABASES or re.fullmatch(r"novo_blocks_[0-9]{8}\.db", name) is not None)
+
+
+def import_snapshot(snapshot, data_dir, force=False, wallet_copied=False):
+    started = time.perf_counter()
+    stale_partitions = partition_files(data_dir)
+    existing = [name for name in DATABASES if os.path.exists(os.path.join(data_dir, name))] + [os.path.basename(path) for path in stale_partitions]
+    if existing and not force:
+        raise FileExistsError(f"{', '.join(existing)} already exist in {data_dir}, pass --force to replace them")
+
+    work_dir = tempfile.mkdtemp(prefix="snapshot-", dir=data_dir)
+    try:
+        with tarfile.open(snapshot, "r:gz") as tar:
+            member = tar.next()
+            if member is None or member.name != MANIFEST_NAME:
+                raise ValueError(f"{snapshot} does not start with a {MANIFEST_NAME}")
+            manifest = json.load(tar.extractfile(member))
+            if manifest.get("format") != SNAPSHOT_FORMAT:
+                raise ValueError(f"Unsupported snapshot format {manifest.get('format')}")
+            invalid = [name for name in manifest["databases"] if not is_database_name(name)]
+            if invalid:
+                raise ValueError(f"{snapshot} lists unexpected files {', '.join(sorted(invalid))}")
+
+            unpacked = set()
+            for member in tar:
+                expected = manifest["databases"].get(member.name)
+                if expected is None or not member.isfile():
+                    continue
+                unpack_database(tar, member, os.path.join(work_dir, member.name), expected)
+                unpacked.add(member.name)
+
+        missing = set(manifest["databases"]) - unpacked
+        if missing:
+            raise ValueError(f"{snapshot} is missing {', '.join(sorted(missing))}")
+
+        if "contracts.db" in unpacked and not wallet_copied:
+            forget_imported_addresses(os.path.join(work_dir, "contracts.db"))
+
+        for path in stale_partitions:
+            remove_database(path)
+        for name in manifest["databases"]:
+            target = os.path.join(data_dir, name)
+            remove_database(target)
+            os.replace(os.path.join(work_dir, name), target)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    tip = manifest["tip"]
+    print(f"Imported snapshot of height {tip['height']} ({tip['hash']}) in {time.perf_counter() - started:.1f}s")
+    if "contracts.db" in manifest["databases"] and not wallet_copied:
+        print("Cleared imported_addresses, the next contracts pass imports every token address into the node's wallet")
+    for name, stage in STAGE_WATERMARKS.items():
+        watermark = manifest["databases"].get(name, {}).get("sync_state", {}).get(stage)
+        if watermark:
+            print(f"{stage} resumes from height {watermark[0] + 1}")
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import a compressed snapshot of the explorer databases")
+    parser.add_argument("--data-dir", default=".", help="directory holding the databases")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="write a snapshot of the databases")
+    export_parser.add_argument("--output", help="snapshot file (default snapshot-<height>-<hash>.tar.gz in the data directory)")
+    export_parser.add_argument("--compress-level", type=int, default=COMPRESS_LEVEL, help="gzip level, 1 (fastest) to 9 (smallest)")
+
+    import_parser = subparsers.add_parser("import", help="replace the databases with a snapshot")
+    import_parser.add_argument("snapshot", help="snapshot file written by export")
+    import_parser.add_argument("--force", action="store_true", help="replace databases that already exist")
+    import_parser.add_argument("--wallet-copied", action="store_true", help="the node's wallet was copied along with the snapshot, so keep its list of imported addresses")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_snapshot(args.data_dir, args.output, args.compress_level)
+    else:
+        import_snapshot(args.snapshot, args.data_dir, args.force, args.wallet_copied)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,558 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COIN = 100000000
+BLOCK_REWARD = 50 * COIN
+GENESIS_TIME = 1690000000
+BLOCK_INTERVAL = 120
+
+# Regtest-style target, no proof of work is done for synthetic blocks
+BITS = 0x207fffff
+DIFFICULTY = 4.656542373906925e-10
+
+ADDRESS_VERSION = 0x00
+
+# Regtest message start, written in front of every block in the blk*.dat files
+NETWORK_MAGIC = bytes.fromhex("fabfb5da")
+BLOCK_FILE_SIZE = 128 * 1024 * 1024
+
+OP_RETURN = 0x6a
+OP_DROP = 0x75
+OP_DUP = 0x76
+OP_HASH160 = 0xa9
+OP_EQUALVERIFY = 0x88
+OP_CHECKSIG = 0xac
+
+BASE58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+# Relative weights of each kind of non-coinbase transaction in a block
+DEFAULT_MIX = {
+    "transfer": 70,
+    "inscription": 10,
+    "token_mint": 5,
+    "token_transfer": 10,
+    "nft_mint": 2,
+    "nft_transfer": 3,
+}
+
+
+def dsha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def varint(n):
+    if n < 0xfd:
+        return bytes([n])
+    if n <= 0xffff:
+        return b"\xfd" + struct.pack("<H", n)
+    if n <= 0xffffffff:
+        return b"\xfe" + struct.pack("<I", n)
+    return b"\xff" + struct.pack("<Q", n)
+
+
+def push_data(data):
+    if len(data) < 0x4c:
+        return bytes([len(data)]) + data
+    if len(data) <= 0xff:
+        return b"\x4c" + bytes([len(data)]) + data
+    if len(data) <= 0xffff:
+        return b"\x4d" + struct.pack("<H", len(data)) + data
+    return b"\x4e" + struct.pack("<I", len(data)) + data
+
+
+def base58check(payload):
+    data = payload + dsha256(payload)[:4]
+    number = int.from_bytes(data, "big")
+    encoded = ""
+    while number:
+        number, remainder = divmod(number, 58)
+        encoded = BASE58_ALPHABET[remainder] + encoded
+    leading_zeros = len(data) - len(data.lstrip(b"\x00"))
+    return "1" * leading_zeros + encoded
+
+
+def p2pkh_script(pubkey_hash):
+    return bytes([OP_DUP, OP_HASH160, 20]) + pubkey_hash + bytes([OP_EQUALVERIFY, OP_CHECKSIG])
+
+
+def p2pkh_asm(pubkey_hash):
+    return f"OP_DUP OP_HASH160 {pubkey_hash.hex()} OP_EQUALVERIFY OP_CHECKSIG"
+
+
+# Contract outputs carry their fields as a pushed JSON document dropped in front of a
+# P2PKH script; the node decodes them into contractID/contractType/... keys on the output
+def contract_script(pubkey_hash, fields):
+    payload = json.dumps(fields, separators=(",", ":")).encode()
+    return push_data(payload) + bytes([OP_DROP]) + p2pkh_script(pubkey_hash), payload
+
+
+class Wallet:
+    def __init__(self, rng, count):
+        self.pubkey_hashes = [rng.getrandbits(160).to_bytes(20, "big") for _ in range(count)]
+        self.addresses = [base58check(bytes([ADDRESS_VERSION]) + h) for h in self.pubkey_hashes]
+        self.by_address = dict(zip(self.addresses, self.pubkey_hashes))
+
+
+class SyntheticChain:
+    def __init__(self, num_blocks, txs_per_block=20, num_addresses=1000, seed=1, mix=None):
+        self.rng = random.Random(seed)
+        self.mix = mix or DEFAULT_MIX
+        self.wallet = Wallet(self.rng, num_addresses)
+
+        self.blocks = []
+        self.block_by_hash = {}
+        self.transactions = {}
+        self.raw_blocks = []
+
+        self.utxos = []
+        self.contract_utxos = {}
+        self.contracts = []
+        self.chunk_count = 0
+
+        for height in range(num_blocks + 1):
+            self.add_block(height, txs_per_block)
+
+    @property
+    def height(self):
+        return len(self.blocks) - 1
+
+    def serialize_tx(self, vin, outputs, locktime=0):
+        data = struct.pack("<i", 2) + varint(len(vin))
+        for prev_txid, prev_n, script_sig in vin:
+            data += bytes.fromhex(prev_txid)[::-1] + struct.pack("<I", prev_n) + varint(len(script_sig)) + script_sig + struct.pack("<I", 0xffffffff)
+        data += varint(len(outputs))
+        for value, script, _ in outputs:
+            data += struct.pack("<q", value) + varint(len(script)) + script
+        return data + struct.pack("<I", locktime)
+
+    # Build one transaction: vin is (txid, n, scriptSig) outpoints, outputs are (value, script, rpc fields)
+    def make_tx(self, vin, outputs, block_time, coinbase=None):
+        raw = self.serialize_tx(vin, outputs)
+        txid = dsha256(raw)[::-1].hex()
+
+        if coinbase is not None:
+            rpc_vin = [{"coinbase": coinbase.hex(), "sequence": 0xffffffff}]
+        else:
+            rpc_vin = [{"txid": prev_txid, "vout": prev_n, "scriptSig": {"asm": "", "hex": script_sig.hex()}, "sequence": 0xffffffff}
+                       for prev_txid, prev_n, script_sig in vin]
+
+        rpc_vout = []
+        for n, (value, script, fields) in enumerate(outputs):
+            entry = {"value": value / COIN, "n": n, "scriptPubKey": {"hex": script.hex()}}
+            entry["scriptPubKey"].update(fields.pop("scriptPubKey"))
+            entry.update(fields)
+            rpc_vout.append(entry)
+
+        tx = {
+            "hex": raw.hex(),
+            "txid": txid,
+            "hash": txid,
+            "size": len(raw),
+            "version": 2,
+            "locktime": 0,
+            "vin": rpc_vin,
+            "vout": rpc_vout,
+            "time": block_time,
+            "blocktime": block_time,
+        }
+        return tx, raw
+
+    def pay_to(self, address, value):
+        pubkey_hash = self.wallet.by_address[address]
+        return value, p2pkh_script(pubkey_hash), {"scriptPubKey": {
+            "asm": p2pkh_asm(pubkey_hash), "reqSigs": 1, "type": "pubkeyhash", "addresses": [address]}}
+
+    def contract_output(self, address, fields):
+        pubkey_hash = self.wallet.by_address[address]
+        script, payload = contract_script(pubkey_hash, fields)
+        output = {"scriptPubKey": {
+            "asm": f"{payload.hex()} OP_DROP {p2pkh_asm(pubkey_hash)}",
+            "reqSigs": 1, "type": "pubkeyhash", "addresses": [address]}}
+        output.update(fields)
+        return 0, script, output
+
+    def op_return_output(self, data):
+        script = bytes([OP_RETURN]) + push_data(data)
+        return 0, script, {"scriptPubKey": {"asm": f"OP_RETURN {data.hex()}", "type": "nulldata"}}
+
+    def take_utxo(self, min_value):
+        for _ in range(8):
+            if not self.utxos:
+                return None
+            i = self.rng.randrange(len(self.utxos))
+            utxo = self.utxos[i]
+            if utxo[2] >= min_value:
+                self.utxos[i] = self.utxos[-1]
+                self.utxos.pop()
+                return utxo
+        return None
+
+    def fee(self):
+        return self.rng.randint(500, 5000)
+
+    def random_address(self):
+        return self.rng.choice(self.wallet.addresses)
+
+    def spend(self, block_time, outputs_for, extra_vin=()):
+        fee = self.fee()
+        utxo = self.take_utxo(fee + 1000)
+        if utxo is None:
+            return None
+        txid, n, value, address = utxo
+        outputs = outputs_for(txid, n, address)
+        spent = sum(output[0] for output in outputs)
+        change = value - spent - fee
+        if change < 0:
+            self.utxos.append(utxo)
+            return None
+        outputs.append(self.pay_to(address, change))
+
+        vin = [(prev_txid, prev_n, b"") for prev_txid, prev_n in extra_vin] + [(txid, n, b"")]
+        return self.make_tx(vin, outputs, block_time)
+
+    def transfer_tx(self, block_time):
+        def outputs_for(txid, n, address):
+            return [self.pay_to(self.random_address(), self.rng.randint(1000, 100000))]
+        return self.spend(block_time, outputs_for)
+
+    def chunk_tx(self, block_time):
+        self.chunk_count += 1
+        data = self.rng.randbytes(self.rng.randint(40, 75))
+        return self.spend(block_time, lambda txid, n, address: [self.op_return_output(data)])
+
+    def inscription_tx(self, block_time, chunk_txids):
+        def outputs_for(txid, n, address):
+            payload = {
+                "genesis_address": address,
+                "genesis_fee": 0,
+                "genesis_timestamp": block_time,
+                "mime_type": "image/png",
+                "content_type": "image",
+                "content_length": 64 * len(chunk_txids),
+                "encrypted": False,
+                "licence": "",
+                "max_claims": 0,
+                "whitelist": [],
+                "chunk_txids": chunk_txids,
+            }
+            return [self.op_return_output(json.dumps(payload).encode())]
+        return self.spend(block_time, outputs_for)
+
+    def mint_tx(self, block_time, nft):
+        contract_type = "NFT" if nft else "FT"
+        created = []
+
+        def outputs_for(txid, n, address):
+            symbol = "".join(self.rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(4))
+            max_supply = 1 if nft else self.rng.choice([21000000, 100000000, 1000000000])
+            contract = {
+                "contractID": f"{txid}:{n}",
+                "contractMaxSupply": max_supply,
+                "contractMetadata": json.dumps({
+                    "name": f"Synthetic {symbol}", "symbol": symbol, "decimal": 0 if nft else 8, "icon": "",
+                    "genesis_price": 0, "limit_mint": max_supply, "limit_wallet": max_supply,
+                }),
+            }
+            receiver = self.random_address()
+            created.append((contract, receiver, max_supply))
+            return [
+                self.contract_output(address, dict(contract, contractType=f"{contract_type}_MINT", contractValue=max_supply)),
+                self.contract_output(receiver, dict(contract, contractType=contract_type, contractValue=max_supply)),
+            ]
+
+        result = self.spend(block_time, outputs_for)
+        if result:
+            contract, receiver, max_supply = created[-1]
+            self.contracts.append(contract)
+            self.add_contract_utxo(result[0]["txid"], 1, receiver, dict(contract, contractType=contract_type, contractValue=max_supply))
+        return result
+
+    def contract_transfer_tx(self, block_time, nft):
+        contract_type = "NFT" if nft else "FT"
+        candidates = [outpoint for outpoint, utxo in self.contract_utxos.items() if utxo["contractType"] == contract_type]
+        if not candidates:
+            return None
+        outpoint = self.rng.choice(candidates)
+        held = self.contract_utxos[outpoint]
+        amount = held["contractValue"] if nft else self.rng.randint(1, held["contractValue"])
+        contract = {key: held[key] for key in ("contractID", "contractMaxSupply", "contractMetadata")}
+        receiver = self.random_address()
+
+        def outputs_for(txid, n, address):
+            return [
+                self.contract_output(held["address"], dict(contract, contractType=contract_type, contractValue=held["contractValue"] - amount)),
+                self.contract_output(receiver, dict(contract, contractType=contract_type, contractValue=amount)),
+            ]
+
+        result = self.spend(block_time, outputs_for, extra_vin=[outpoint])
+        if result:
+            del self.contract_utxos[outpoint]
+            txid = result[0]["txid"]
+            if held["contractValue"] - amount > 0:
+                self.add_contract_utxo(txid, 0, held["address"], dict(contract, contractType=contract_type, contractValue=held["contractValue"] - amount))
+            self.add_contract_utxo(txid, 1, receiver, dict(contract, contractType=contract_type, contractValue=amount))
+        return result
+
+    def add_contract_utxo(self, txid, n, address, fields):
+        self.contract_utxos[(txid, n)] = dict(fields, address=address, txid=txid, vout=n)
+
+    def add_block(self, height, txs_per_block):
+        block_time = GENESIS_TIME + height * BLOCK_INTERVAL
+        miner = self.random_address()
+        coinbase, coinbase_raw = self.make_tx(
+            [("00" * 32, 0xffffffff, push_data(struct.pack("<I", height)))],
+            [self.pay_to(miner, BLOCK_REWARD)], block_time, coinbase=push_data(struct.pack("<I", height)))
+        block_txs = [(coinbase, coinbase_raw)]
+        self.utxos.append((coinbase["txid"], 0, BLOCK_REWARD, miner))
+
+        kinds = list(self.mix)
+        weights = [self.mix[kind] for kind in kinds]
+        while height > 0 and len(block_txs) < txs_per_block:
+            kind = self.rng.choices(kinds, weights)[0]
+            if kind == "inscription":
+                chunks = [self.chunk_tx(block_time) for _ in range(self.rng.randint(1, 3))]
+                chunks = [chunk for chunk in chunks if chunk]
+                for chunk in chunks:
+                    block_txs.append(chunk)
+                    self.register_outputs(chunk[0])
+                result = self.inscription_tx(block_time, [chunk[0]["txid"] for chunk in chunks]) if chunks else None
+            elif kind == "transfer":
+                result = self.transfer_tx(block_time)
+            elif kind in ("token_mint", "nft_mint"):
+                result = self.mint_tx(block_time, kind == "nft_mint")
+            else:
+                result = self.contract_transfer_tx(block_time, kind == "nft_transfer")
+
+            if result:
+                block_txs.append(result)
+                self.register_outputs(result[0])
+
+        previous = self.blocks[-1] if self.blocks else None
+        merkle = [dsha256(raw) for _, raw in block_txs]
+        while len(merkle) > 1:
+            if len(merkle) % 2:
+                merkle.append(merkle[-1])
+            merkle = [dsha256(merkle[i] + merkle[i + 1]) for i in range(0, len(merkle), 2)]
+        merkle_root = merkle[0]
+
+        prev_hash = bytes.fromhex(previous["hash"])[::-1] if previous else b"\x00" * 32
+        nonce = self.rng.getrandbits(32)
+        header = struct.pack("<i", 0x20000000) + prev_hash + merkle_root + struct.pack("<III", block_time, BITS, nonce)
+        raw_block = header + varint(len(block_txs)) + b"".join(raw for _, raw in block_txs)
+        block_hash = dsha256(header)[::-1].hex()
+
+        times = sorted([block["time"] for block in self.blocks[-10:]] + [block_time])
+        block = {
+            "hash": block_hash,
+            "size": len(raw_block),
+            "height": height,
+            "version": 0x20000000,
+            "versionHex": "20000000",
+            "merkleroot": merkle_root[::-1].hex(),
+            "tx": [tx["txid"] for tx, _ in block_txs],
+            "time": block_time,
+            "mediantime": times[len(times) // 2],
+            "nonce": nonce,
+            "bits": f"{BITS:08x}",
+            "difficulty": DIFFICULTY,
+            "chainwork": f"{(height + 1) * 2:064x}",
+        }
+        if previous:
+            block["previousblockhash"] = previous["hash"]
+            previous["nextblockhash"] = block_hash
+
+        for tx, _ in block_txs:
+            tx["blockhash"] = block_hash
+            tx["blockheight"] = height
+            self.transactions[tx["txid"]] = tx
+        self.blocks.append(block)
+        self.block_by_hash[block_hash] = block
+        self.raw_blocks.append(raw_block)
+
+    # Lay the raw blocks out the way the node stores them: magic, little-endian size and the
+    # block, in blk*.dat files of at most max_file_size bytes. With shuffle, neighbouring blocks
+    # are swapped at random, as blocks arriving out of order are stored on a real node
+    def write_block_files(self, directory, magic=NETWORK_MAGIC, max_file_size=BLOCK_FILE_SIZE, shuffle=False):
+        order = list(range(len(self.raw_blocks)))
+        if shuffle:
+            rng = random.Random(len(order))
+            for i in range(0, len(order) - 1, 2):
+                if rng.random() < 0.5:
+                    order[i], order[i + 1] = order[i + 1], order[i]
+
+        os.makedirs(directory, exist_ok=True)
+        file_number = 0
+        f = open(os.path.join(directory, f"blk{file_number:05d}.dat"), "wb")
+        try:
+            for height in order:
+                raw = self.raw_blocks[height]
+                if f.tell() and f.tell() + 8 + len(raw) > max_file_size:
+                    f.close()
+                    file_number += 1
+                    f = open(os.path.join(directory, f"blk{file_number:05d}.dat"), "wb")
+                f.write(magic + struct.pack("<I", len(raw)) + raw)
+        finally:
+            f.close()
+        return file_number + 1
+
+    def register_outputs(self, tx):
+        for entry in tx["vout"]:
+            addresses = entry["scriptPubKey"].get("addresses")
+            if addresses and "contractID" not in entry and entry["value"] > 0:
+                self.utxos.append((tx["txid"], entry["n"], round(entry["value"] * COIN), addresses[0]))
+
+
+class StubNode:
+    # JSON-RPC server answering the calls the indexers make, for heights up to visible_height;
+    # transactions of the next block are reported as the mempool
+    def __init__(self, chain, visible_height=None):
+        self.chain = chain
+        self.visible_height = chain.height if visible_height is None else visible_height
+        self.imported = set()
+        self.server = None
+
+    def confirmations(self, height):
+        return self.visible_height - height + 1
+
+    def getblockcount(self):
+        return self.visible_height
+
+    def getbestblockhash(self):
+        return self.chain.blocks[self.visible_height]["hash"]
+
+    def getblockhash(self, height):
+        if height > self.visible_height:
+            raise KeyError("Block height out of range")
+        return self.chain.blocks[height]["hash"]
+
+    def getblock(self, block_hash, verbosity=1):
+        block = self.chain.block_by_hash[block_hash]
+        if block["height"] > self.visible_height:
+            raise KeyError("Block not found")
+        result = dict(block, confirmations=self.confirmations(block["height"]))
+        if block["height"] == self.visible_height:
+            result.pop("nextblockhash", None)
+        if verbosity == 0:
+            return self.chain.raw_blocks[block["height"]].hex()
+        if verbosity == 2:
+            result["tx"] = [self.getrawtransaction(txid, True) for txid in block["tx"]]
+        return result
+
+    def getrawtransaction(self, txid, verbose=False):
+        tx = self.chain.transactions[txid]
+        if not verbose:
+            return tx["hex"]
+        result = {key: value for key, value in tx.items() if key != "blockheight"}
+        if tx["blockheight"] > self.visible_height:
+            for key in ("blockhash", "time", "blocktime"):
+                result.pop(key)
+        else:
+            result["confirmations"] = self.confirmations(tx["blockheight"])
+        return result
+
+    def getrawmempool(self, verbose=False):
+        if self.visible_height >= self.chain.height:
+            return []
+        return self.chain.blocks[self.visible_height + 1]["tx"][1:]
+
+    def listcontractunspent(self):
+        return list(self.chain.contract_utxos.values())
+
+    def listaddressgroupings(self):
+        balances = {}
+        for _, _, value, address in self.chain.utxos:
+            if address in self.imported:
+                balances[address] = balances.get(address, 0) + value
+        return [[[address, value / COIN]] for address, value in balances.items()]
+
+    def importaddress(self, address, *args):
+        self.imported.add(address)
+        return None
+
+    def call(self, request):
+        method = request.get("method")
+        params = request.get("params") or []
+        handler = getattr(self, method, None) if method in RPC_METHODS else None
+        if handler is None:
+            return {"result": None, "error": {"code": -32601, "message": "Method not found"}, "id": request.get("id")}
+        try:
+            return {"result": handler(*params), "error": None, "id": request.get("id")}
+        except (KeyError, IndexError, TypeError) as e:
+            return {"result": None, "error": {"code": -8, "message": str(e)}, "id": request.get("id")}
+
+    def start(self, host="127.0.0.1", port=0):
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if isinstance(request, list):
+                    response = [node.call(item) for item in request]
+                else:
+                    response = node.call(request)
+                body = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        # The daemon's stages call the node concurrently, more than the default backlog of 5 allows
+        class Server(ThreadingHTTPServer):
+            request_queue_size = 128
+
+        self.server = Server((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self.server.server_address[1]}"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+RPC_METHODS = {
+    "getblockcount", "getbestblockhash", "getblockhash", "getblock", "getrawtransaction",
+    "getrawmempool", "listcontractunspent", "listaddressgroupings", "importaddress",
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a generated chain over JSON-RPC in place of a Novo node")
+    parser.add_argument("--blocks", type=int, default=1000)
+    parser.add_argument("--txs-per-block", type=int, default=20)
+    parser.add_argument("--addresses", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8332)
+    parser.add_argument("--block-files", help="also write the chain as blk*.dat files to this directory")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    chain = SyntheticChain(args.blocks, args.txs_per_block, args.addresses, args.seed)
+    print(f"Generated {args.blocks} blocks, {len(chain.transactions)} transactions in {time.perf_counter() - start:.1f}s")
+    if args.block_files:
+        files = chain.write_block_files(args.block_files)
+        print(f"Wrote {files} block files to {args.block_files}")
+
+    node = StubNode(chain)
+    url = node.start(args.host, args.port)
+    print(f"Stub node listening on {url}, point novo-cli at it with NOVO_STUB_URL={url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        node.stop()
+
+
+if __name__ == "__main__":
+    main()